@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import declarative_base, sessionmaker
 from contextlib import contextmanager
 import os
@@ -18,6 +18,29 @@ engine = create_engine(
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 Base = declarative_base()
 
+
+def add_missing_columns(bind) -> None:
+    """Añade a las tablas existentes las columnas nuevas de los modelos.
+
+    ``create_all`` no modifica tablas ya creadas; para el MVP basta con añadir las
+    columnas que falten (todas las columnas nuevas admiten NULL o tienen default).
+    Solo usa ``ALTER TABLE ... ADD COLUMN`` con tipos e identificadores del dialecto
+    de ``bind``, así que vale para SQLite y para PostgreSQL.
+    """
+    inspector = inspect(bind)
+    quote = bind.dialect.identifier_preparer.quote
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name, schema=table.schema):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name, schema=table.schema)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    conn.execute(
+                        text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}")
+                    )
+
 # Create tables if not exist on import for MVP
 if DB_URL.startswith("sqlite"):
     # Avoid circular import; models will import Base after this file is executed.
@@ -29,6 +52,7 @@ if DB_URL.startswith("sqlite"):
     except ModuleNotFoundError:
         pass
     Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
 
 
 def get_db():
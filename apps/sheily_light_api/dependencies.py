@@ -12,8 +12,8 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 
 def get_db_dep():
-    with get_db() as db:
-        yield db
+    # ``get_db`` es un generador de dependencia, no un context manager
+    yield from get_db()
 
 
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db_dep)) -> User:
@@ -18,7 +18,7 @@ print(f"DATABASE_URL from .env: {os.getenv('DATABASE_URL')}")
 
 # Import models to ensure they are registered with SQLAlchemy
 from sheily_light_api.models import Base
-from sheily_light_api.core.database import DB_URL
+from sheily_light_api.core.database import DB_URL, add_missing_columns
 print(f"DB_URL from database.py: {DB_URL}")
 
 def init_db():
@@ -28,6 +28,8 @@ def init_db():
     
     print("Creating database tables...")
     Base.metadata.create_all(bind=engine)
+    # create_all no altera tablas existentes: añade las columnas nuevas de los modelos
+    add_missing_columns(engine)
     print("Database tables created successfully!")
 
 if __name__ == "__main__":
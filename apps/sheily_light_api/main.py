@@ -17,8 +17,19 @@ from redis import asyncio as aioredis
 
 # Importaciones de la aplicación
 from sheily_light_api.sheily_core.orchestrator import orchestrator_boot
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_persistence import chat_writer
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_semantic_cache import semantic_cache
+from sheily_light_api.sheily_modules.sheily_model_inference.embedding_service import embedding_service
+from sheily_light_api.sheily_modules.sheily_model_inference.model_residency import model_residency
+from sheily_light_api.sheily_modules.sheily_model_inference.model_router import model_router
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_backend_pool import ollama_backends
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import (
+    close_async_http_client,
+    init_async_http_client,
+)
 from sheily_light_api.sheily_routers.sheily_auth_router import router as auth_router
 from sheily_light_api.sheily_routers.sheily_chat_router import router as chat_router
+from sheily_light_api.sheily_routers.sheily_documents_router import router as documents_router
 from sheily_light_api.sheily_routers.sheily_status_router import router as status_router
 
 # Configuración de entorno
@@ -77,15 +88,37 @@ async def setup_redis_cache():
 async def startup():
     """Configuración inicial de la aplicación."""
     await setup_redis_cache()
+    await init_async_http_client()
+    chat_writer.start()
+    # El sondeo mantiene el estado de salud en caché y cierra los circuitos recuperados
+    ollama_backends.start_probing()
+    # Precarga de modelos en segundo plano: el arranque no espera a que terminen de cargarse
+    model_residency.start()
+    # Modelos instalados en Ollama: el enrutador solo degrada a modelos disponibles
+    model_router.start()
     await orchestrator_boot()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    """Libera los recursos compartidos al apagar la aplicación."""
+    # Vaciar la cola de escritura antes que nada: son datos de usuario
+    await chat_writer.stop()
+    semantic_cache.flush()
+    embedding_service.close()
+    await model_residency.stop()
+    await model_router.stop()
+    await ollama_backends.stop_probing()
+    await close_async_http_client()
+
+
 # --- Fin Middlewares ---
 
 # Configuración de rutas
 # Include routers
 app.include_router(auth_router, prefix="/api/auth", tags=["auth"])
 app.include_router(chat_router, prefix="/api/chat", tags=["chat"])
+app.include_router(documents_router, prefix="/api", tags=["documents"])
 app.include_router(status_router, prefix="/api/status", tags=["status"])
 
 
@@ -1,7 +1,7 @@
 """SQLAlchemy models shared across SHEILY-light backend MVP."""
 
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Float
 from sqlalchemy.orm import relationship
 
 from .core.database import Base
@@ -17,6 +17,22 @@ class User(Base):
 
     chats = relationship("ChatMessage", back_populates="user", cascade="all, delete-orphan")
     tokens = relationship("TokenBalance", back_populates="user", cascade="all, delete-orphan")
+    conversations = relationship("Conversation", back_populates="user", cascade="all, delete-orphan")
+
+
+class Conversation(Base):
+    """Hilo de conversación; sus turnos son los ``ChatMessage`` ordenados por id."""
+
+    __tablename__ = "conversations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    title = Column(String(200), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    user = relationship("User", back_populates="conversations")
+    messages = relationship("ChatMessage", back_populates="conversation", order_by="ChatMessage.id")
 
 
 class ChatMessage(Base):
@@ -27,8 +43,20 @@ class ChatMessage(Base):
     prompt = Column(Text, nullable=False)
     response = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=True, index=True)
+    # Desglose de la generación local (ms); NULL si la respuesta vino de caché o del nodo central
+    model = Column(String, nullable=True)
+    total_ms = Column(Float, nullable=True)
+    load_ms = Column(Float, nullable=True)
+    prompt_eval_count = Column(Integer, nullable=True)
+    prompt_eval_ms = Column(Float, nullable=True)
+    eval_count = Column(Integer, nullable=True)
+    eval_ms = Column(Float, nullable=True)
+    # "aborted" si el cliente se desconectó antes de recibir la respuesta (con lo generado hasta entonces)
+    status = Column(String, nullable=True)
 
     user = relationship("User", back_populates="chats")
+    conversation = relationship("Conversation", back_populates="messages")
 
 
 class TokenBalance(Base):
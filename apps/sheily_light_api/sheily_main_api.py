@@ -10,6 +10,11 @@ from sheily_routers.sheily_status_router import router as status_router
 from sheily_routers.sheily_config_router import router as config_router
 
 from fastapi.middleware.cors import CORSMiddleware
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_persistence import chat_writer
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import (
+    close_async_http_client,
+    init_async_http_client,
+)
 
 app = FastAPI(title="SHEILY-light API", version="1.0.0")
 
@@ -41,6 +46,18 @@ from sheily_light_api.sheily_routers.sheily_utils_router import router as utils_
 app.include_router(utils_router, prefix="/api", tags=["utils"])
 
 
+@app.on_event("startup")
+async def startup():
+    await init_async_http_client()
+    chat_writer.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await chat_writer.stop()
+    await close_async_http_client()
+
+
 @app.get("/")
 def root():
     return {"message": "SHEILY-light API is running"}
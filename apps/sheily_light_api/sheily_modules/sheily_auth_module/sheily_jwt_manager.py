@@ -23,3 +23,13 @@ def verify_token(token: str) -> str | None:
         return str(payload.get("sub"))
     except Exception:
         return None
+
+
+def token_expiry(token: str) -> float | None:
+    """Return the token's expiry as a UNIX timestamp, or None if invalid or without ``exp``."""
+    try:
+        payload = jwt.decode(token, settings.secret_key, algorithms=[ALGORITHM])
+    except Exception:
+        return None
+    exp = payload.get("exp")
+    return float(exp) if exp is not None else None
@@ -1,36 +1,240 @@
-"""Utilities for detecting when a prompt needs fresh web data and retrieving it via SerpAPI."""
+"""Utilities for detecting when a prompt needs fresh web data and retrieving it via SerpAPI.
+
+``web_search.search`` is the async entry point used by the chat: it goes through the shared
+HTTP pool and a TTL cache keyed on the normalized query (failures and empty result
+sets are cached for a shorter time). ``SHEILY_SEARCH_PROVIDER=stub`` swaps SerpAPI for
+a local provider with deterministic results and configurable latency, for tests and
+benchmarks. ``PendingSearch`` starts a search early and collects it under a latency
+budget, so the chat can proceed without results instead of waiting for a slow search.
+"""
 
 from __future__ import annotations
 
+import asyncio
+import logging
 import os
 import re
-from typing import List
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Protocol, Tuple
 
 import requests
 
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_intent import intent_classifier
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import get_async_http_client
+
+logger = logging.getLogger("sheily_search")
+
 _SERPAPI_KEY = os.getenv("SERPAPI_KEY")
 _SERP_ENDPOINT = "https://serpapi.com/search"
 
-# Very simple Spanish keywords indicating current/updated data
-_NEEDS_SEARCH_PATTERNS: List[re.Pattern[str]] = [
-    re.compile(r"\b(hoy|ahora|últim[ao]s?|actual|reciente|precio|cuánto vale|quién ganó)\b", re.I),
-]
+SEARCH_PROVIDER = os.getenv("SHEILY_SEARCH_PROVIDER", "serpapi")
+SEARCH_TIMEOUT = float(os.getenv("SHEILY_SEARCH_TIMEOUT", "5"))
+SEARCH_BUDGET_MS = float(os.getenv("SHEILY_SEARCH_BUDGET_MS", "1500"))
+SEARCH_CACHE_TTL = float(os.getenv("SHEILY_SEARCH_CACHE_TTL", "600"))
+SEARCH_NEGATIVE_TTL = float(os.getenv("SHEILY_SEARCH_NEGATIVE_TTL", "60"))
+SEARCH_CACHE_SIZE = int(os.getenv("SHEILY_SEARCH_CACHE_SIZE", "512"))
+SEARCH_STUB_LATENCY_MS = float(os.getenv("SHEILY_SEARCH_STUB_LATENCY_MS", "0"))
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+SearchResult = Dict[str, str]
 
 
 def needs_search(prompt: str) -> bool:
-    """Return True if the prompt likely requires up-to-date external data."""
-    return any(p.search(prompt) for p in _NEEDS_SEARCH_PATTERNS)
+    """Return True if the prompt likely requires up-to-date external data (see ``sheily_chat_intent``)."""
+    return intent_classifier.classify(prompt).needs_search
+
+
+def normalize_query(query: str) -> str:
+    """Cache key for a query: lowercase, no punctuation, single spaces."""
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", query.lower())).strip()
+
+
+def format_results(results: List[SearchResult], num: int = 5) -> str:
+    """Plain-text summary of search results, one numbered line per result."""
+    lines: List[str] = []
+    for idx, item in enumerate(results[:num], 1):
+        title = item.get("title", "")
+        link = item.get("link", "")
+        lines.append(f"{idx}. {title} – {link}")
+    return "\n".join(lines)
 
 
 def google_search(query: str, num: int = 5) -> str:
     """Return a plain-text summary of top search results using SerpAPI.
 
+    Blocking variant kept for scripts; the chat uses ``web_search``.
     If SERPAPI_KEY is not set or the request fails, returns empty string.
     """
     if not _SERPAPI_KEY:
         return ""
 
-    params = {
+    try:
+        r = requests.get(_SERP_ENDPOINT, params=_serpapi_params(query, num), timeout=20)
+        r.raise_for_status()
+        results = r.json().get("organic_results", [])
+    except Exception:
+        return ""
+    return format_results(results, num)
+
+
+class SearchProvider(Protocol):
+    async def search(self, query: str, num: int) -> List[SearchResult]: ...
+
+
+class SerpApiProvider:
+    """Google results through SerpAPI, over the shared HTTP pool."""
+
+    async def search(self, query: str, num: int) -> List[SearchResult]:
+        if not _SERPAPI_KEY:
+            return []
+        params = _serpapi_params(query, num)
+        r = await get_async_http_client().get(_SERP_ENDPOINT, params=params, timeout=SEARCH_TIMEOUT)
+        r.raise_for_status()
+        return r.json().get("organic_results", [])
+
+
+class StubSearchProvider:
+    """Local provider with deterministic results, for tests and benchmarks."""
+
+    def __init__(self, latency_ms: float = SEARCH_STUB_LATENCY_MS, results: Optional[List[SearchResult]] = None):
+        self.latency_ms = latency_ms
+        self.results = results
+        self.calls = 0
+
+    async def search(self, query: str, num: int) -> List[SearchResult]:
+        self.calls += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        if self.results is not None:
+            return self.results[:num]
+        return [
+            {"title": f"Resultado {i} para {query}", "link": f"https://example.com/{i}"} for i in range(1, num + 1)
+        ]
+
+
+class SearchCache:
+    """LRU with separate TTLs for results and for empty/failed searches."""
+
+    def __init__(
+        self,
+        ttl: float = SEARCH_CACHE_TTL,
+        negative_ttl: float = SEARCH_NEGATIVE_TTL,
+        max_entries: int = SEARCH_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        if entry[1]:
+            self.hits += 1
+        else:
+            self.negative_hits += 1
+        return entry[1]
+
+    def put(self, key: str, summary: str) -> None:
+        ttl = self.ttl if summary else self.negative_ttl
+        self._entries[key] = (time.monotonic() + ttl, summary)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+        }
+
+
+class SheilyWebSearch:
+    """Cached, concurrent-safe web search used to enrich chat prompts."""
+
+    def __init__(self, provider: Optional[SearchProvider] = None, cache: Optional[SearchCache] = None):
+        self.provider = provider or (StubSearchProvider() if SEARCH_PROVIDER == "stub" else SerpApiProvider())
+        self.cache = cache or SearchCache()
+        self._inflight: Dict[str, "asyncio.Future[str]"] = {}
+        self.errors = 0
+        self.over_budget = 0
+
+    async def search(self, query: str, num: int = 5) -> str:
+        """Summary of the top results; empty string when there are none or the search fails."""
+        key = normalize_query(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        # Identical queries in flight share one provider request
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(key, query, num))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def start(self, query: str) -> "PendingSearch":
+        return PendingSearch(self, query)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "provider": type(self.provider).__name__,
+            "cache": self.cache.stats(),
+            "inflight": len(self._inflight),
+            "errors": self.errors,
+            "over_budget": self.over_budget,
+        }
+
+    async def _fetch(self, key: str, query: str, num: int) -> str:
+        try:
+            summary = format_results(await self.provider.search(query, num), num)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Web search failed: {str(e)}")
+            summary = ""
+        self.cache.put(key, summary)
+        return summary
+
+
+class PendingSearch:
+    """A search started ahead of time and collected under a latency budget."""
+
+    def __init__(self, web: SheilyWebSearch, query: str):
+        self._web = web
+        self.started = time.monotonic()
+        self.task = asyncio.ensure_future(web.search(query))
+
+    async def result(self, budget_ms: float = SEARCH_BUDGET_MS) -> str:
+        """The summary, or an empty string if it is not ready when the budget runs out.
+
+        A late search keeps running in the background so its result reaches the cache.
+        """
+        remaining = budget_ms / 1000 - (time.monotonic() - self.started)
+        if not self.task.done() and remaining > 0:
+            await asyncio.wait({self.task}, timeout=remaining)
+        if not self.task.done():
+            self._web.over_budget += 1
+            return ""
+        return self.task.result()
+
+
+def _serpapi_params(query: str, num: int) -> Dict[str, object]:
+    return {
         "engine": "google",
         "q": query,
         "api_key": _SERPAPI_KEY,
@@ -38,17 +242,6 @@ def google_search(query: str, num: int = 5) -> str:
         "num": num,
     }
 
-    try:
-        r = requests.get(_SERP_ENDPOINT, params=params, timeout=20)
-        r.raise_for_status()
-        data = r.json()
-        results = data.get("organic_results", [])
-    except Exception:
-        return ""
 
-    lines: List[str] = []
-    for idx, item in enumerate(results[:num], 1):
-        title = item.get("title", "")
-        link = item.get("link", "")
-        lines.append(f"{idx}. {title} – {link}")
-    return "\n".join(lines)
+# Global web search instance used by the chat
+web_search = SheilyWebSearch()
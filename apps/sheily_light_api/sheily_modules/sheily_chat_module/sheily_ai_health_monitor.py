@@ -1,35 +1,59 @@
-from typing import List, Optional
-from sheily_modules.sheily_model_inference.ollama_client import OllamaClient
+import os
+import time
+from typing import List, Optional, Tuple
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_backend_pool import ollama_backends
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import get_ollama_client
 
+# Antigüedad máxima del estado publicado por el sondeo antes de comprobar en directo
+HEALTH_MAX_AGE = float(os.getenv("SHEILY_HEALTH_MAX_AGE", "30"))
+MODELS_CACHE_TTL = float(os.getenv("SHEILY_MODELS_CACHE_TTL", "60"))
 
-def check_ollama_health() -> bool:
+_models_cache: Optional[Tuple[float, List[str]]] = None
+
+
+async def check_ollama_health() -> bool:
     """Verifica si el servicio de Ollama está disponible.
 
+    Usa el estado que mantiene el sondeo en segundo plano del pool de backends y
+    solo consulta a Ollama si ese estado no existe o está desfasado.
+
     Returns:
         bool: True si el servicio está disponible, False en caso contrario.
     """
+    state = ollama_backends.health_state()
+    if state["checked_at"] is not None and time.time() - state["checked_at"] <= HEALTH_MAX_AGE:
+        return state["healthy"]
     try:
-        with OllamaClient() as client:
-            # Intenta obtener los tags para verificar la conexión
-            client._client.get("/api/tags")
-            return True
+        # Intenta obtener los tags para verificar la conexión
+        await get_ollama_client().tags()
+        return True
     except Exception as e:
         print(f"Error verificando salud de Ollama: {e}")
         return False
 
 
-def list_available_models() -> List[str]:
+async def list_available_models() -> List[str]:
     """Obtiene la lista de modelos disponibles en Ollama.
 
+    El resultado se cachea ``SHEILY_MODELS_CACHE_TTL`` segundos; los errores no se cachean.
+
     Returns:
         List[str]: Lista de nombres de modelos disponibles.
     """
+    global _models_cache
+    now = time.monotonic()
+    if _models_cache is not None and now - _models_cache[0] < MODELS_CACHE_TTL:
+        return list(_models_cache[1])
     try:
-        with OllamaClient() as client:
-            response = client._client.get("/api/tags")
-            response.raise_for_status()
-            data = response.json()
-            return [model["name"] for model in data.get("models", [])]
+        models = await get_ollama_client().list_models()
     except Exception as e:
         print(f"Error listando modelos de Ollama: {e}")
         return []
+    _models_cache = (now, models)
+    return list(models)
+
+
+def invalidate_models_cache() -> None:
+    """Olvida la lista de modelos cacheada (p. ej. tras un ``pull``)."""
+    global _models_cache
+    _models_cache = None
@@ -0,0 +1,188 @@
+"""Motor de conversación multi-turno.
+
+Cada turno se envía a Ollama junto con el ``context`` que devolvió el turno
+anterior, de modo que el modelo continúa desde su estado en lugar de volver a
+evaluar toda la transcripción: el tiempo de evaluación del prompt se mantiene
+plano a medida que la conversación crece.
+
+Cuando no hay ``context`` reutilizable (reinicio del proceso, cambio de modelo,
+otro worker atendió el turno previo o el contexto ya no cabe en la ventana) se
+reconstruye una transcripción recortada a la ventana (``num_ctx``) del modelo.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy.orm import Session
+
+from sheily_light_api.models import ChatMessage, Conversation, User
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_persistence import MESSAGE_ABORTED
+from sheily_light_api.sheily_modules.sheily_config_module.sheily_user_config_manager import config_manager
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_options import generation_options
+
+logger = logging.getLogger("sheily_chat_conversation")
+
+CONTEXT_CACHE_SIZE = int(os.getenv("SHEILY_CONTEXT_CACHE_SIZE", "256"))
+# Aproximación de caracteres por token para presupuestar sin tokenizador
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata del número de tokens de un texto."""
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class ConversationNotFound(LookupError):
+    """La conversación no existe o pertenece a otro usuario."""
+
+
+@dataclass
+class TurnInput:
+    """Lo que se envía a Ollama en un turno."""
+
+    prompt: str
+    context: Optional[List[int]] = None
+
+
+@dataclass
+class _ContextEntry:
+    model: str
+    context: List[int]
+    turns: int
+
+
+class SheilyConversationEngine:
+    """Construye el contexto de cada turno y recuerda el ``context`` de Ollama por conversación."""
+
+    def __init__(self, cache_size: int = CONTEXT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._contexts: "OrderedDict[int, _ContextEntry]" = OrderedDict()
+        self.reused = 0
+        self.rebuilt = 0
+        self.trimmed_turns = 0
+
+    def token_budget(self, model: Optional[str] = None) -> int:
+        """Tokens disponibles para la entrada: la ventana menos lo reservado a la respuesta."""
+        if model is not None:
+            # La ventana y el límite de respuesta que se envían a Ollama para ese modelo
+            options = generation_options.for_model(model)
+            context_window = int(options.get("num_ctx", 4096))
+            max_tokens = int(options.get("num_predict", 0))
+        else:
+            ai_config = config_manager.get_config("ai") or {}
+            context_window = int(ai_config.get("context_window", 4096))
+            max_tokens = int(ai_config.get("max_tokens", 1024))
+        return max(context_window - max_tokens, context_window // 2)
+
+    def prepare_turn(self, conversation_id: int, turns: Sequence[ChatMessage], prompt: str, model: str) -> TurnInput:
+        """
+        Prepara la entrada de un turno.
+
+        Args:
+            conversation_id: Conversación a la que pertenece el turno
+            turns: Turnos previos ya guardados, en orden
+            prompt: Mensaje nuevo del usuario
+            model: Modelo que responderá
+        """
+        if not turns:
+            return TurnInput(prompt)
+
+        budget = self.token_budget(model)
+        entry = self._contexts.get(conversation_id)
+        if (
+            entry is not None
+            and entry.model == model
+            and entry.turns == len(turns)
+            and len(entry.context) + estimate_tokens(prompt) <= budget
+        ):
+            self._contexts.move_to_end(conversation_id)
+            self.reused += 1
+            return TurnInput(prompt, entry.context)
+
+        self.rebuilt += 1
+        return TurnInput(self.build_transcript(turns, prompt, budget))
+
+    def build_transcript(self, turns: Sequence[ChatMessage], prompt: str, budget: int) -> str:
+        """Transcripción con los turnos más recientes que quepan en ``budget`` tokens."""
+        remaining = budget - estimate_tokens(prompt)
+        kept: List[str] = []
+        for turn in reversed(turns):
+            block = f"Usuario: {turn.prompt}\nAsistente: {turn.response}\n"
+            cost = estimate_tokens(block)
+            if cost > remaining:
+                self.trimmed_turns += len(turns) - len(kept)
+                break
+            kept.append(block)
+            remaining -= cost
+        if not kept:
+            return prompt
+        return "".join(reversed(kept)) + f"Usuario: {prompt}\nAsistente:"
+
+    def complete_turn(self, conversation_id: int, model: str, result: Dict[str, Any], turns: int) -> None:
+        """Guarda el ``context`` devuelto por Ollama; ``turns`` incluye el turno recién respondido."""
+        context = result.get("context")
+        if not context:
+            self._contexts.pop(conversation_id, None)
+            return
+        self._contexts[conversation_id] = _ContextEntry(model, list(context), turns)
+        self._contexts.move_to_end(conversation_id)
+        while len(self._contexts) > self.cache_size:
+            self._contexts.popitem(last=False)
+
+    def forget(self, conversation_id: int) -> None:
+        self._contexts.pop(conversation_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cached_contexts": len(self._contexts),
+            "context_reused": self.reused,
+            "context_rebuilt": self.rebuilt,
+            "trimmed_turns": self.trimmed_turns,
+        }
+
+
+def create_conversation(db: Session, user: User, title: Optional[str] = None) -> Conversation:
+    """Crea una conversación vacía para el usuario."""
+    conversation = Conversation(user_id=user.id, title=title)
+    db.add(conversation)
+    db.commit()
+    db.refresh(conversation)
+    return conversation
+
+
+def get_conversation(db: Session, user: User, conversation_id: int) -> Optional[Conversation]:
+    """Devuelve la conversación si existe y pertenece al usuario."""
+    return (
+        db.query(Conversation)
+        .filter(Conversation.id == conversation_id, Conversation.user_id == user.id)
+        .first()
+    )
+
+
+def list_conversations(db: Session, user: User, limit: int = 20) -> List[Conversation]:
+    return (
+        db.query(Conversation)
+        .filter(Conversation.user_id == user.id)
+        .order_by(Conversation.updated_at.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def get_turns(db: Session, conversation_id: int) -> List[ChatMessage]:
+    """Turnos de la conversación en orden, sin los abortados por el cliente."""
+    return (
+        db.query(ChatMessage)
+        .filter(ChatMessage.conversation_id == conversation_id, ChatMessage.status.is_distinct_from(MESSAGE_ABORTED))
+        .order_by(ChatMessage.id)
+        .all()
+    )
+
+
+# Instancia global del motor de conversación
+conversation_engine = SheilyConversationEngine()
@@ -0,0 +1,427 @@
+"""Documentos del usuario para el chat: ingesta en segundo plano y recuperación.
+
+La ingesta es una cadena de generadores con memoria acotada sea cual sea el tamaño
+del fichero: ``extract_text`` lee el fichero subido por bloques (texto) o por
+páginas (PDF), ``chunk_text`` corta el texto en fragmentos solapados de
+``INGEST_CHUNK_TOKENS`` palabras y cada lote de fragmentos se convierte en
+embeddings con ``embedding_service`` y se añade al índice vectorial de documentos.
+En memoria solo hay un bloque de texto y un lote de fragmentos a la vez.
+
+Cada usuario tiene su espacio de nombres en el índice; en el chat se buscan los
+fragmentos más parecidos al prompt y se añaden como contexto.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import codecs
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from sheily_light_api.sheily_modules.sheily_model_inference.embedding_service import (
+    SheilyEmbeddingService,
+    embedding_service,
+)
+from sheily_light_api.sheily_modules.sheily_vector_store.sheily_vector_index import SheilyVectorIndex, normalize
+
+try:  # Soporte de PDF opcional
+    from pypdf import PdfReader
+except ImportError:  # pragma: no cover - depende del entorno
+    PdfReader = None
+
+logger = logging.getLogger("sheily_chat_documents")
+
+DOCUMENTS_ENABLED = os.getenv("SHEILY_DOCUMENTS_ENABLED", "true").lower() == "true"
+_SHEILY_HOME = os.path.join(os.path.expanduser("~"), ".sheily")
+DOCUMENTS_INDEX_DIR = os.getenv("SHEILY_DOCUMENTS_INDEX_DIR", os.path.join(_SHEILY_HOME, "index", "documents"))
+UPLOADS_DIR = os.getenv("SHEILY_UPLOADS_DIR", os.path.join(_SHEILY_HOME, "uploads"))
+INGEST_MAX_BYTES = int(os.getenv("SHEILY_INGEST_MAX_BYTES", str(50 * 1024 * 1024)))
+# Palabras por fragmento y solapamiento entre fragmentos consecutivos (aproximación a tokens)
+INGEST_CHUNK_TOKENS = int(os.getenv("SHEILY_INGEST_CHUNK_TOKENS", "200"))
+INGEST_CHUNK_OVERLAP = int(os.getenv("SHEILY_INGEST_CHUNK_OVERLAP", "40"))
+# Fragmentos por llamada a embed_many
+INGEST_BATCH_SIZE = int(os.getenv("SHEILY_INGEST_BATCH_SIZE", "64"))
+# Ingestas que se procesan a la vez; el resto espera en cola
+INGEST_CONCURRENCY = int(os.getenv("SHEILY_INGEST_CONCURRENCY", "1"))
+DOCUMENTS_TOP_K = int(os.getenv("SHEILY_DOCUMENTS_TOP_K", "3"))
+# Similitud coseno mínima para considerar relevante un fragmento
+DOCUMENTS_MIN_SCORE = float(os.getenv("SHEILY_DOCUMENTS_MIN_SCORE", "0.5"))
+
+TEXT_EXTENSIONS = frozenset({".txt", ".md", ".markdown", ".csv", ".json", ".log", ".rst", ".html"})
+PDF_EXTENSIONS = frozenset({".pdf"})
+
+_READ_BLOCK = 64 * 1024
+# Trabajos terminados que se conservan para consultar su estado
+_FINISHED_JOBS = 256
+_WORD = re.compile(r"\S+")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class UnsupportedDocument(ValueError):
+    """El tipo de fichero no se puede ingerir en este nodo."""
+
+
+def check_supported(filename: str) -> str:
+    """Extensión del fichero si se puede ingerir.
+
+    Raises:
+        UnsupportedDocument: Si la extensión no es de texto ni PDF, o falta ``pypdf`` para un PDF
+    """
+    extension = Path(filename).suffix.lower()
+    if extension in PDF_EXTENSIONS:
+        if PdfReader is None:
+            raise UnsupportedDocument("La ingesta de PDF necesita el paquete pypdf")
+        return extension
+    if extension not in TEXT_EXTENSIONS:
+        raise UnsupportedDocument(f"Tipo de documento no soportado: {extension or filename}")
+    return extension
+
+
+ProgressCallback = Callable[[int, int], None]
+
+
+def extract_text(path: Path, progress: Optional[ProgressCallback] = None) -> Iterator[str]:
+    """Texto del fichero por bloques; ``progress(hecho, total)`` avanza en bytes o páginas."""
+    if check_supported(path.name) in PDF_EXTENSIONS:
+        reader = PdfReader(str(path))
+        pages = len(reader.pages)
+        for number, page in enumerate(reader.pages, 1):
+            yield (page.extract_text() or "") + "\n"
+            if progress:
+                progress(number, pages)
+        return
+
+    size = path.stat().st_size
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    read = 0
+    with open(path, "rb") as f:
+        while block := f.read(_READ_BLOCK):
+            read += len(block)
+            yield decoder.decode(block)
+            if progress:
+                progress(read, size)
+    yield decoder.decode(b"", final=True)
+
+
+def chunk_text(
+    blocks: Iterable[str], size: int = INGEST_CHUNK_TOKENS, overlap: int = INGEST_CHUNK_OVERLAP
+) -> Iterator[str]:
+    """Fragmentos de ``size`` palabras que repiten las ``overlap`` últimas del anterior."""
+    step = max(1, size - overlap)
+    window: List[str] = []
+    partial = ""
+    pending = False  # hay palabras en la ventana que no han salido en ningún fragmento
+    for block in blocks:
+        words = _WORD.findall(partial + block)
+        # Una palabra puede quedar partida entre dos bloques
+        partial = words.pop() if words and not block[-1:].isspace() else ""
+        for word in words:
+            window.append(word)
+            pending = True
+            if len(window) == size:
+                yield " ".join(window)
+                del window[:step]
+                pending = False
+    if partial:
+        window.append(partial)
+        pending = True
+    if pending:
+        yield " ".join(window)
+
+
+def _batched(items: Iterator[str], size: int) -> Iterator[List[str]]:
+    batch: List[str] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@dataclass
+class IngestionJob:
+    """Estado de la ingesta de un documento; su id es también el id del documento."""
+
+    id: str
+    user_id: int
+    filename: str
+    path: Path
+    size: int
+    status: str = QUEUED
+    progress: float = 0.0
+    chunks: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "size": self.size,
+            "status": self.status,
+            "progress": round(self.progress, 4),
+            "chunks": self.chunks,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+@dataclass
+class DocumentChunk:
+    """Fragmento de un documento relevante para el prompt actual."""
+
+    document_id: str
+    filename: str
+    text: str
+    score: float
+
+
+class SheilyDocumentStore:
+    """Ingesta de documentos de los usuarios y búsqueda de sus fragmentos."""
+
+    def __init__(
+        self,
+        index_dir: str = DOCUMENTS_INDEX_DIR,
+        uploads_dir: str = UPLOADS_DIR,
+        enabled: bool = DOCUMENTS_ENABLED,
+        embedder: Optional[SheilyEmbeddingService] = None,
+        chunk_tokens: int = INGEST_CHUNK_TOKENS,
+        chunk_overlap: int = INGEST_CHUNK_OVERLAP,
+        batch_size: int = INGEST_BATCH_SIZE,
+        concurrency: int = INGEST_CONCURRENCY,
+        top_k: int = DOCUMENTS_TOP_K,
+        min_score: float = DOCUMENTS_MIN_SCORE,
+    ):
+        self.index_dir = Path(index_dir)
+        self.uploads_dir = Path(uploads_dir)
+        self.enabled = enabled
+        self.embedder = embedder or embedding_service
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
+        self.top_k = top_k
+        self.min_score = min_score
+
+        self._index: Optional[SheilyVectorIndex] = None
+        # Los lotes se escriben desde hilos del executor mientras el chat busca
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._tasks: set = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        self.ingested = 0
+        self.failed = 0
+        self.lookups = 0
+        self.hits = 0
+
+    # ------------------------------------------------------------------
+    # Ingesta
+    # ------------------------------------------------------------------
+
+    def new_upload(self, user_id: int, filename: str) -> IngestionJob:
+        """Reserva el id y la ruta de una subida (``check_supported`` antes de recibir el cuerpo)."""
+        check_supported(filename)
+        job_id = uuid.uuid4().hex
+        name = Path(filename).name
+        return IngestionJob(job_id, user_id, name, self.uploads_dir / job_id / name, size=0)
+
+    def start(self, job: IngestionJob) -> IngestionJob:
+        """Encola la ingesta de un fichero ya guardado en ``job.path``."""
+        job.size = job.path.stat().st_size
+        self._jobs[job.id] = job
+        self._forget_finished()
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def discard(self, job: IngestionJob) -> None:
+        """Borra una subida que no llegará a ingerirse."""
+        _remove_upload(job.path)
+
+    def get_job(self, user_id: int, job_id: str) -> Optional[IngestionJob]:
+        job = self._jobs.get(job_id)
+        return job if job is not None and job.user_id == user_id else None
+
+    async def wait(self) -> None:
+        """Espera a que terminen las ingestas en curso (pruebas y apagado)."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self, job: IngestionJob) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            async with self._semaphore:
+                job.status = RUNNING
+                await self._ingest(job)
+            job.status = DONE
+            job.progress = 1.0
+            self.ingested += 1
+        except Exception as e:
+            logger.error(f"Ingestion {job.id} ({job.filename}) failed: {str(e)}")
+            job.status = FAILED
+            job.error = str(e)
+            self.failed += 1
+            # Los fragmentos de un documento a medias no deben aparecer en el chat
+            await asyncio.to_thread(self.delete_document, job.user_id, job.id)
+        finally:
+            job.finished_at = time.time()
+            _remove_upload(job.path)
+
+    async def _ingest(self, job: IngestionJob) -> None:
+        def progress(done: int, total: int) -> None:
+            job.progress = done / total if total else 1.0
+
+        batches = _batched(
+            chunk_text(extract_text(job.path, progress), self.chunk_tokens, self.chunk_overlap), self.batch_size
+        )
+        namespace = _namespace(job.user_id)
+        while True:
+            # Leer y trocear el fichero es bloqueante: cada lote se prepara fuera del event loop
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                return
+            vectors = await self.embedder.embed_many(batch)
+            ids, rows, metas = [], [], []
+            for text, vector in zip(batch, vectors):
+                unit = normalize(vector)
+                if unit is None:
+                    continue
+                ids.append(f"{job.user_id}:{job.id}:{job.chunks + len(ids)}")
+                rows.append(unit)
+                metas.append({"document_id": job.id, "filename": job.filename, "text": text})
+            if ids:
+                await asyncio.to_thread(self._add, ids, rows, metas, namespace)
+            job.chunks += len(ids)
+
+    def _add(self, ids: List[str], rows: List[Any], metas: List[Dict[str, Any]], ns: str) -> None:
+        with self._lock:
+            self._ensure_loaded().add_many(ids, rows, metas, ns)
+
+    def _forget_finished(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished[: max(0, len(finished) - _FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    # ------------------------------------------------------------------
+    # Documentos y búsqueda
+    # ------------------------------------------------------------------
+
+    def list_documents(self, user_id: int) -> List[Dict[str, Any]]:
+        """Documentos indexados del usuario con su número de fragmentos."""
+        documents: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            index = self._ensure_loaded()
+            index.refresh()
+            for entry_id in index.ids():
+                if _owner(entry_id) != user_id:
+                    continue
+                meta = index.get(entry_id) or {}
+                document = documents.setdefault(
+                    meta["document_id"], {"id": meta["document_id"], "filename": meta["filename"], "chunks": 0}
+                )
+                document["chunks"] += 1
+        return list(documents.values())
+
+    def delete_document(self, user_id: int, document_id: str) -> int:
+        """Borra los fragmentos de un documento del usuario; devuelve cuántos había."""
+        prefix = f"{user_id}:{document_id}:"
+        with self._lock:
+            index = self._ensure_loaded()
+            index.refresh()
+            deleted = sum(index.delete(entry_id) for entry_id in index.ids() if entry_id.startswith(prefix))
+        return deleted
+
+    async def search(self, user_id: int, query: str, k: Optional[int] = None) -> List[DocumentChunk]:
+        """Fragmentos de los documentos del usuario más parecidos a ``query``."""
+        if not self.enabled or not await asyncio.to_thread(self._has_chunks, user_id):
+            return []
+        self.lookups += 1
+        try:
+            query_vector = normalize(await self.embedder.embed(query))
+        except Exception as e:
+            logger.warning(f"Document search embedding failed: {str(e)}")
+            return []
+        if query_vector is None:
+            return []
+        hits = await asyncio.to_thread(self._search, user_id, query_vector, k or self.top_k)
+        chunks = [
+            DocumentChunk(hit.meta["document_id"], hit.meta["filename"], hit.meta["text"], hit.score)
+            for hit in hits
+            if hit.score >= self.min_score
+        ]
+        if chunks:
+            self.hits += 1
+        return chunks
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "chunks": 0 if self._index is None else len(self._index),
+            "jobs_active": sum(job.finished_at is None for job in self._jobs.values()),
+            "ingested": self.ingested,
+            "failed": self.failed,
+            "lookups": self.lookups,
+            "hits": self.hits,
+        }
+
+    def _has_chunks(self, user_id: int) -> bool:
+        # Evita calcular el embedding del prompt si el usuario no tiene documentos (en ningún worker)
+        with self._lock:
+            index = self._ensure_loaded()
+            index.refresh()
+            return index.count(_namespace(user_id)) > 0
+
+    def _search(self, user_id: int, query_vector: Any, k: int) -> List[Any]:
+        with self._lock:
+            return self._ensure_loaded().search(query_vector, k=k, namespace=_namespace(user_id))
+
+    def _ensure_loaded(self) -> SheilyVectorIndex:
+        if self._index is None:
+            # Compartido: cada worker sube documentos y ve los que suben los demás
+            self._index = SheilyVectorIndex(str(self.index_dir), shared=True)
+        return self._index
+
+
+def format_documents(chunks: Sequence[DocumentChunk]) -> str:
+    """Bloque de contexto con los fragmentos de documentos recuperados."""
+    return "\n\n".join(f"({c.filename})\n{c.text}" for c in chunks)
+
+
+def _namespace(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def _owner(entry_id: str) -> int:
+    return int(entry_id.split(":", 1)[0])
+
+
+def _remove_upload(path: Path) -> None:
+    # El texto ya está en el índice: el fichero subido no se conserva
+    try:
+        path.unlink(missing_ok=True)
+        path.parent.rmdir()
+    except OSError:
+        pass
+
+
+# Instancia global de los documentos del chat
+document_store = SheilyDocumentStore()
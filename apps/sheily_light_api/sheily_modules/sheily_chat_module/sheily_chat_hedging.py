@@ -0,0 +1,168 @@
+"""Peticiones con cobertura (hedging) frente a la central.
+
+Si la IA local no ha producido el primer token en un plazo dinámico (por defecto
+el p95 observado del tiempo hasta el primer token de ese modelo, cola incluida), se
+lanza en paralelo la misma pregunta a la central y se usa la respuesta que llegue
+antes; la otra se cancela. En el caso normal el modelo local responde dentro del
+plazo y no se genera carga adicional. Cuando gana la central, el tiempo esperado
+hasta ese momento se guarda como muestra del primer token local (es una cota
+inferior): así el plazo crece si el modelo local se vuelve lento de forma sostenida.
+
+Es opcional porque duplica carga hacia la central: se activa con
+``SHEILY_HEDGE_ENABLED=true``, solo si ``SHEILY_CENTRAL_CHAT_URL`` está configurada
+y mientras el usuario no desactive ``network.use_central_fallback``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_retry_manager import CENTRAL_CONFIGURED
+from sheily_light_api.sheily_modules.sheily_config_module.sheily_user_config_manager import config_manager
+
+logger = logging.getLogger("sheily_chat_hedging")
+
+HEDGE_ENABLED = os.getenv("SHEILY_HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("SHEILY_HEDGE_PERCENTILE", "0.95"))
+# Plazo usado hasta reunir suficientes muestras del modelo
+HEDGE_DEFAULT_DEADLINE_MS = float(os.getenv("SHEILY_HEDGE_DEFAULT_DEADLINE_MS", "5000"))
+HEDGE_MIN_DEADLINE_MS = float(os.getenv("SHEILY_HEDGE_MIN_DEADLINE_MS", "500"))
+HEDGE_MIN_SAMPLES = int(os.getenv("SHEILY_HEDGE_MIN_SAMPLES", "20"))
+
+_SAMPLES = 256
+
+
+class SheilyChatHedger:
+    """Decide cuándo cubrir una generación local con la central y cuenta el resultado."""
+
+    def __init__(
+        self,
+        percentile: float = HEDGE_PERCENTILE,
+        default_deadline_ms: float = HEDGE_DEFAULT_DEADLINE_MS,
+        min_deadline_ms: float = HEDGE_MIN_DEADLINE_MS,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        opt_in: bool = HEDGE_ENABLED,
+        central_configured: bool = CENTRAL_CONFIGURED,
+    ):
+        if opt_in and not central_configured:
+            logger.warning("SHEILY_HEDGE_ENABLED is set but SHEILY_CENTRAL_CHAT_URL is not: hedging stays off")
+        self.opt_in = opt_in and central_configured
+        self.percentile = percentile
+        self.default_deadline_ms = default_deadline_ms
+        self.min_deadline_ms = min_deadline_ms
+        self.min_samples = min_samples
+        self._first_token_ms: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=_SAMPLES))
+        self.requests = 0
+        self.hedged = 0
+        self.central_wins = 0
+        self.central_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        if not self.opt_in:
+            return False
+        network = config_manager.get_config("network") or {}
+        return bool(network.get("use_central_fallback", False))
+
+    def deadline(self, model: str) -> float:
+        """Segundos que se espera al primer token local antes de lanzar la cobertura."""
+        samples = self._first_token_ms.get(model)
+        if not samples or len(samples) < self.min_samples:
+            deadline_ms = self.default_deadline_ms
+        else:
+            ordered = sorted(samples)
+            deadline_ms = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        return max(deadline_ms, self.min_deadline_ms) / 1000
+
+    async def stream(
+        self,
+        model: str,
+        local: AsyncIterator[str],
+        central: Callable[[], Awaitable[str]],
+        outcome: Optional[Dict[str, Any]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Devuelve los tokens de ``local`` o, si la central gana la carrera, su respuesta completa.
+
+        Args:
+            model: Modelo local, para el plazo y las muestras
+            local: Generación local en streaming (incluye la espera por un hueco)
+            central: Lanza la petición a la central; solo se llama si vence el plazo
+            outcome: Recibe ``source`` (``"local"`` o ``"central"``) con la respuesta usada
+        """
+        self.requests += 1
+        started = time.monotonic()
+        first = asyncio.ensure_future(local.__anext__())
+        hedge: Optional[asyncio.Future[Any]] = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.deadline(model))
+            if not done:
+                self.hedged += 1
+                hedge = asyncio.ensure_future(central())
+                done, _ = await asyncio.wait({first, hedge}, return_when=asyncio.FIRST_COMPLETED)
+                if first not in done or _failed(first):
+                    # La central terminó antes, o la local falló mientras la central seguía en vuelo
+                    answer = await self._central_answer(hedge)
+                    if answer is not None:
+                        self.central_wins += 1
+                        if not first.done():
+                            # La local sigue sin primer token: al menos ha tardado esto
+                            self._first_token_ms[model].append((time.monotonic() - started) * 1000)
+                        if outcome is not None:
+                            outcome["source"] = "central"
+                        yield answer
+                        return
+                    await asyncio.wait({first})
+                hedge.cancel()
+
+            try:
+                token = first.result()
+            except StopAsyncIteration:
+                return
+            self._first_token_ms[model].append((time.monotonic() - started) * 1000)
+            if outcome is not None:
+                outcome["source"] = "local"
+            yield token
+            async for token in local:
+                yield token
+        finally:
+            if hedge is not None:
+                hedge.cancel()
+            if not first.done():
+                first.cancel()
+                await asyncio.gather(first, return_exceptions=True)
+            await local.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "central_wins": self.central_wins,
+            "central_errors": self.central_errors,
+            "hedge_rate": self.hedged / self.requests if self.requests else 0.0,
+            "win_rate": self.central_wins / self.hedged if self.hedged else 0.0,
+            "deadline_ms": {model: self.deadline(model) * 1000 for model in self._first_token_ms},
+        }
+
+    async def _central_answer(self, hedge: "asyncio.Future[Any]") -> Optional[str]:
+        try:
+            return await hedge
+        except Exception as e:
+            self.central_errors += 1
+            logger.warning(f"Central hedge request failed: {str(e)}")
+            return None
+
+
+def _failed(first: "asyncio.Future[Any]") -> bool:
+    error = first.exception()
+    return error is not None and not isinstance(error, StopAsyncIteration)
+
+
+# Instancia global de la cobertura del chat
+chat_hedger = SheilyChatHedger()
@@ -0,0 +1,218 @@
+"""Clasificación de la intención del prompt: ``code``, ``search`` o ``general``.
+
+Sustituye a la lista de expresiones de ``is_code_prompt`` (una ``re.search`` por
+palabra clave, sin compilar y sin límites de palabra: ``if``, ``for`` o ``log``
+casaban con casi cualquier frase) y al patrón aparte de ``needs_search``.
+
+El prompt se normaliza una vez (minúsculas, sin tildes) y una única expresión
+compilada lo recorre en una pasada reconociendo a la vez construcciones de código
+(``def f(``, ``import x``, ``archivo.py``, operadores, bloques ```) y palabras. Cada
+palabra o par de palabras suma su peso a la intención correspondiente; las palabras
+ambiguas pesan poco y solo cuentan acompañadas. Una intención se elige si su
+puntuación alcanza ``INTENT_THRESHOLD``. La búsqueda web se decide aparte
+(``needs_search``) porque un prompt de código también puede necesitar datos
+actuales. Las decisiones recientes se guardan en un LRU.
+
+``python -m sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_intent``
+mide el coste por prompt.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import re
+import time
+import unicodedata
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterable, Mapping, Optional, Sequence
+
+INTENT_CODE = "code"
+INTENT_SEARCH = "search"
+INTENT_GENERAL = "general"
+
+INTENT_THRESHOLD = float(os.getenv("SHEILY_INTENT_THRESHOLD", "1.0"))
+INTENT_CACHE_SIZE = int(os.getenv("SHEILY_INTENT_CACHE_SIZE", "2048"))
+
+# Términos (sin tildes) por peso hacia la intención de código; los ambiguos pesan poco
+# y solo alcanzan el umbral acompañados de otras señales
+_CODE_TERMS = {
+    1.5: "traceback stacktrace unittest pytest dockerfile stdout stdin stderr segfault requirements.txt",
+    1.0: "codigo programar programacion python javascript typescript bash powershell sql regex compilar "
+    "compilador compile debug debuggear depurar refactor refactorizar docstring docker kubernetes github gitlab "
+    "git conda virtualenv venv poetry npm pip endpoint django flask fastapi nodejs linter lint parsear "
+    "serializar ci/cd html css",
+    0.8: "script algoritmo bug",
+    0.6: "excepcion exception api json yaml framework library commit merge branch pipeline shell sintaxis "
+    "async await parse java react",
+    0.5: "programa libreria loop bucle terminal deploy desplegar return logging rust",
+    0.4: "funcion funciones class variable consola console print import def",
+    0.3: "clase error test config instalar install build constante ejecutar else",
+    0.2: "configuracion archivo fichero log version run if for while",
+}
+CODE_WEIGHTS: Dict[str, float] = {term: weight for weight, terms in _CODE_TERMS.items() for term in terms.split()}
+
+# Construcciones de código reconocidas sobre el texto en minúsculas (peso de cada aparición)
+CODE_SYNTAX: Sequence[str] = (
+    r"```",
+    r"\b(?:def|class|function|fn|func)\s+\w+\s*[(:{]",
+    r"\bfrom\s+[\w.]+\s+import\b",
+    r"\bimport\s+[\w.]+",
+    r"\b\w+\([^()\n]{0,40}\)",
+    r"[=!<>]=|=>|->|&&|\|\||::|\+\+",
+    r"\b[\w-]+\.(?:py|js|ts|tsx|jsx|sh|sql|java|go|rs|cpp|hpp|c|h|rb|php|yml|yaml|toml|ini|json|ipynb)\b",
+    r"(?:^|\n)\s*\$\s+\w",
+)
+CODE_SYNTAX_WEIGHT = 1.0
+
+# Palabras y pares de palabras que piden datos actuales (peso hacia la búsqueda web)
+SEARCH_WEIGHTS: Dict[str, float] = dict.fromkeys(
+    "hoy ahora ultimo ultima ultimos ultimas actual reciente recientes precio cotizacion noticias".split()
+    + ["cuanto vale", "quien gano"],
+    1.0,
+)
+
+_WORD_PATTERN = r"\w+(?:[./]\w+)*"
+_SAMPLES = 256
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Minúsculas y sin tildes."""
+    text = unicodedata.normalize("NFKD", prompt.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+@dataclass(frozen=True)
+class Intent:
+    """Decisión del clasificador para un prompt."""
+
+    label: str
+    confidence: float
+    needs_search: bool
+    scores: Mapping[str, float]
+
+
+class SheilyIntentClassifier:
+    """Clasificador de intención de una pasada con caché LRU de decisiones recientes."""
+
+    def __init__(
+        self,
+        code_weights: Mapping[str, float] = CODE_WEIGHTS,
+        search_weights: Mapping[str, float] = SEARCH_WEIGHTS,
+        code_syntax: Sequence[str] = CODE_SYNTAX,
+        threshold: float = INTENT_THRESHOLD,
+        cache_size: int = INTENT_CACHE_SIZE,
+    ):
+        self.code_weights = dict(code_weights)
+        self.search_weights = dict(search_weights)
+        self.threshold = threshold
+        self.cache_size = cache_size
+        syntax = "|".join(f"(?:{pattern})" for pattern in code_syntax)
+        # Una sola expresión: en cada posición se prueba antes la sintaxis de código que la palabra
+        self._matcher = re.compile(f"(?P<syntax>{syntax})|(?P<word>{_WORD_PATTERN})")
+        self._cache: "OrderedDict[str, Intent]" = OrderedDict()
+        self._classify_us: Deque[float] = deque(maxlen=_SAMPLES)
+        self.hits = 0
+        self.misses = 0
+        # Decisiones por intención de los prompts clasificados (sin contar aciertos de la caché)
+        self.labels: Counter = Counter()
+
+    def classify(self, prompt: str) -> Intent:
+        intent = self._cache.get(prompt)
+        if intent is not None:
+            self.hits += 1
+            self._cache.move_to_end(prompt)
+        else:
+            self.misses += 1
+            started = time.perf_counter()
+            intent = self.score(prompt)
+            self._classify_us.append((time.perf_counter() - started) * 1e6)
+            self.labels[intent.label] += 1
+            self._cache[prompt] = intent
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return intent
+
+    def score(self, prompt: str) -> Intent:
+        """Clasifica sin pasar por la caché."""
+        code = search = 0.0
+        previous: Optional[str] = None
+        for match in self._matcher.finditer(normalize_prompt(prompt)):
+            word = match.group("word")
+            if word is None:
+                code += CODE_SYNTAX_WEIGHT
+                previous = None
+                continue
+            code += self.code_weights.get(word, 0.0)
+            search += self.search_weights.get(word, 0.0)
+            if previous is not None:
+                search += self.search_weights.get(f"{previous} {word}", 0.0)
+            previous = word
+
+        scores = {INTENT_CODE: round(code, 3), INTENT_SEARCH: round(search, 3)}
+        best = max(scores, key=scores.get)
+        if scores[best] >= self.threshold:
+            # Tiende a 1 a medida que se acumulan señales por encima del umbral
+            confidence = 1 - math.exp(-scores[best] / self.threshold)
+            return Intent(best, round(confidence, 3), search >= self.threshold, scores)
+        # Sin señales suficientes: más seguro cuanto más lejos del umbral
+        confidence = 1 - 0.5 * scores[best] / self.threshold
+        return Intent(INTENT_GENERAL, round(confidence, 3), False, scores)
+
+    def stats(self) -> Dict[str, object]:
+        samples = sorted(self._classify_us)
+        lookups = self.hits + self.misses
+        return {
+            "cache_entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "labels": dict(self.labels),
+            "classify_us_avg": sum(samples) / len(samples) if samples else 0.0,
+            "classify_us_p95": samples[min(len(samples) - 1, int(0.95 * len(samples)))] if samples else 0.0,
+        }
+
+
+def benchmark(prompts: Iterable[str], rounds: int = 200) -> Dict[str, float]:
+    """Microsegundos por prompt sin caché (``score``) y con la caché ya caliente (``classify``)."""
+    prompts = list(prompts)
+    classifier = SheilyIntentClassifier(cache_size=len(prompts))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for prompt in prompts:
+            classifier.score(prompt)
+    cold = time.perf_counter() - started
+    for prompt in prompts:
+        classifier.classify(prompt)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for prompt in prompts:
+            classifier.classify(prompt)
+    warm = time.perf_counter() - started
+    calls = rounds * len(prompts)
+    return {"prompts": len(prompts), "score_us": cold / calls * 1e6, "cached_us": warm / calls * 1e6}
+
+
+BENCHMARK_PROMPTS = (
+    "¿Qué tiempo hace hoy en Madrid?",
+    "Cuéntame un chiste sobre gatos",
+    "Tengo un traceback en Python al importar numpy, ¿qué hago?",
+    "Escribe una función en JavaScript que ordene un array de objetos por fecha",
+    "Si mañana llueve, ¿para qué sirve llevar paraguas?",
+    "¿Cuál es el precio del bitcoin ahora?",
+    "Resume la historia de la Revolución Francesa en cinco párrafos para un examen de bachillerato",
+    "def suma(a, b): return a + b  # ¿por qué falla con None?",
+)
+
+
+# Instancia global del clasificador de intención del chat
+intent_classifier = SheilyIntentClassifier()
+
+
+if __name__ == "__main__":
+    result = benchmark(BENCHMARK_PROMPTS)
+    print(
+        f"{result['prompts']} prompts: {result['score_us']:.1f} µs/prompt sin caché, "
+        f"{result['cached_us']:.2f} µs/prompt con caché"
+    )
@@ -1,159 +1,148 @@
-import re
+import logging
 import os
-from typing import Optional
-from sheily_modules.sheily_model_inference.ollama_client import OllamaClient
-
-DEFAULT_MODEL = "llama3"
-CODE_MODEL = "deepseek-coder:latest"
-OLLAMA_TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "300"))
-
-CODE_KEYWORDS = [
-    r"código",
-    r"script",
-    r"programa",
-    r"función",
-    r"funciones",
-    r"class",
-    r"clase",
-    r"python",
-    r"javascript",
-    r"bash",
-    r"error",
-    r"bug",
-    r"traceback",
-    r"compilar",
-    r"compilador",
-    r"ejecutar",
-    r"algoritmo",
-    r"variable",
-    r"constante",
-    r"loop",
-    r"for",
-    r"while",
-    r"if",
-    r"else",
-    r"return",
-    r"import",
-    r"def",
-    r"print",
-    r"console",
-    r"archivo",
-    r"fichero",
-    r"archivo.py",
-    r"archivo.js",
-    r"archivo.sh",
-    r"dockerfile",
-    r"github",
-    r"test",
-    r"unittest",
-    r"pytest",
-    r"assert",
-    r"api",
-    r"endpoint",
-    r"json",
-    r"parse",
-    r"parsear",
-    r"framework",
-    r"library",
-    r"librería",
-    r"package",
-    r"paquete",
-    r"documentar",
-    r"docstring",
-    r"documentación",
-    r"comentario",
-    r"comentarios",
-    r"optimizar",
-    r"refactor",
-    r"lint",
-    r"compile",
-    r"debug",
-    r"debuggear",
-    r"automatizar",
-    r"automatización",
-    r"pipeline",
-    r"ci/cd",
-    r"deploy",
-    r"desplegar",
-    r"shell",
-    r"cmd",
-    r"prompt",
-    r"input",
-    r"output",
-    r"stdin",
-    r"stdout",
-    r"stderr",
-    r"log",
-    r"logging",
-    r"configuración",
-    r"config",
-    r"setup",
-    r"install",
-    r"instalar",
-    r"requirements",
-    r"version",
-    r"versión",
-    r"actualizar",
-    r"update",
-    r"git",
-    r"commit",
-    r"push",
-    r"pull",
-    r"branch",
-    r"merge",
-    r"conflicto",
-    r"conflict",
-    r"resolver",
-    r"resolve",
-    r"conda",
-    r"virtualenv",
-    r"venv",
-    r"env",
-    r"environment",
-    r"entorno",
-    r"pip",
-    r"poetry",
-    r"build",
-    r"run",
-    r"terminal",
-]
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_intent import INTENT_CODE, intent_classifier
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_options import generation_options
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_timings import (
+    GenerationTiming,
+    generation_metrics,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.model_residency import model_residency
+# DEFAULT_MODEL y CODE_MODEL se siguen importando desde aquí
+from sheily_light_api.sheily_modules.sheily_model_inference.model_router import (  # noqa: F401
+    CODE_MODEL,
+    DEFAULT_MODEL,
+    RouteDecision,
+    model_router,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_backend_pool import (
+    OllamaUnavailable,
+    ollama_backends,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import OLLAMA_TIMEOUT
+
+logger = logging.getLogger("sheily_chat_local_engine")
 
 
 def is_code_prompt(prompt: str) -> bool:
     """
-    Detecta si el prompt está relacionado con programación/código usando palabras clave.
+    Detecta si el prompt está relacionado con programación/código (ver ``sheily_chat_intent``).
     """
-    for pattern in CODE_KEYWORDS:
-        if re.search(pattern, prompt, re.IGNORECASE):
-            return True
-    return False
+    return intent_classifier.classify(prompt).label == INTENT_CODE
+
+
+def select_model(prompt: str, slo_ms: Optional[float] = None) -> str:
+    """Selecciona el modelo según el tipo de prompt, la carga del nodo y la latencia objetivo."""
+    return model_router.choose(intent_classifier.classify(prompt).label, slo_ms).model
+
 
+def plan_model(prompt: str, slo_ms: Optional[float] = None) -> RouteDecision:
+    """Como ``select_model`` pero sin contar la decisión: se confirma con ``model_router.commit`` al generar."""
+    return model_router.plan(intent_classifier.classify(prompt).label, slo_ms)
 
-def ask_local_ai(prompt: str, model: str = None) -> str:
-    """Envía una solicitud al modelo de lenguaje local usando OllamaClient.
+
+async def ask_local_ai(prompt: str, model: str = None, affinity_key: Optional[str] = None) -> str:
+    """Envía una solicitud al modelo de lenguaje local usando el cliente asíncrono compartido.
 
     Args:
         prompt: El mensaje del usuario
         model: Nombre del modelo a usar (opcional)
+        affinity_key: Clave de conversación para repetir backend Ollama (opcional)
 
     Returns:
         str: La respuesta del modelo
     """
+    result = await generate_local_ai(prompt, model=model, affinity_key=affinity_key)
+    return result.get("response", "").strip()
+
+
+async def generate_local_ai(
+    prompt: str,
+    model: str = None,
+    affinity_key: Optional[str] = None,
+    context: Optional[List[int]] = None,
+) -> Dict[str, Any]:
+    """Como ``ask_local_ai`` pero devuelve el JSON completo de Ollama.
+
+    Args:
+        prompt: El mensaje del usuario
+        model: Nombre del modelo a usar (opcional)
+        affinity_key: Clave de conversación para repetir backend Ollama (opcional)
+        context: ``context`` devuelto por el turno anterior; Ollama continúa desde él
+            sin volver a evaluar la conversación previa (opcional)
+
+    Returns:
+        Dict[str, Any]: Respuesta de ``/api/generate`` (``response``, ``context``, duraciones)
+    """
     if model is None:
-        # Selecciona modelo según el tipo de prompt
-        model = CODE_MODEL if is_code_prompt(prompt) else DEFAULT_MODEL
+        model = select_model(prompt)
+
+    params = model_residency.generate_params(model)
+    params["options"] = generation_options.for_model(model)
+    if context:
+        params["context"] = context
 
     try:
-        # Usar el OllamaClient para hacer la solicitud
-        with OllamaClient(timeout=OLLAMA_TIMEOUT) as client:
-            response = client.generate(
-                model=model,
-                prompt=prompt,
-                stream=False
-            )
-            return response.strip()
+        # El cliente reutiliza el pool HTTP del proceso; no hay que cerrarlo
+        async with ollama_backends.lease(affinity_key) as client:
+            result = await client.generate_raw(model=model, prompt=prompt, **params)
+        model_residency.record_generation(model, result, client.base_url)
+        model_router.record(model, result)
+        generation_metrics.record(GenerationTiming.from_ollama(model, result))
+        return result
 
+    except OllamaUnavailable:
+        # Circuito abierto: se propaga tal cual para responder 503 con Retry-After
+        raise
+    except Exception as e:
+        error_msg = f"Error al consultar Ollama: {str(e)}"
+        logger.error(error_msg)
+        raise RuntimeError(error_msg) from e
+
+
+async def stream_local_ai(
+    prompt: str,
+    model: str = None,
+    affinity_key: Optional[str] = None,
+    context: Optional[List[int]] = None,
+    on_done: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> AsyncIterator[str]:
+    """Envía una solicitud al modelo local y devuelve los tokens a medida que se generan.
+
+    Args:
+        prompt: El mensaje del usuario
+        model: Nombre del modelo a usar (opcional)
+        affinity_key: Clave de conversación para repetir backend Ollama (opcional)
+        context: ``context`` devuelto por el turno anterior (opcional)
+        on_done: Recibe el fragmento final de Ollama (con ``context`` y duraciones) (opcional)
+
+    Yields:
+        str: Fragmentos de texto de la respuesta
+    """
+    if model is None:
+        model = select_model(prompt)
+
+    params = model_residency.generate_params(model)
+    params["options"] = generation_options.for_model(model)
+    if context:
+        params["context"] = context
+
+    try:
+        async with ollama_backends.lease(affinity_key) as client:
+            async for chunk in client.generate_stream(model=model, prompt=prompt, **params):
+                token = chunk.get("response", "")
+                if token:
+                    yield token
+                if chunk.get("done"):
+                    model_residency.record_generation(model, chunk, client.base_url)
+                    model_router.record(model, chunk)
+                    generation_metrics.record(GenerationTiming.from_ollama(model, chunk))
+                    if on_done is not None:
+                        on_done(chunk)
+    except OllamaUnavailable:
+        # Circuito abierto: se propaga tal cual para responder 503 con Retry-After
+        raise
     except Exception as e:
         error_msg = f"Error al consultar Ollama: {str(e)}"
-        print(error_msg)  # Para depuración
+        logger.error(error_msg)
         raise RuntimeError(error_msg) from e
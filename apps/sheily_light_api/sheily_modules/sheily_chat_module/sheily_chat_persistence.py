@@ -0,0 +1,361 @@
+"""Persistencia write-behind de los mensajes del chat.
+
+Los intercambios terminados se encolan y una tarea en segundo plano los escribe en
+transacciones por lotes (``SHEILY_CHAT_WRITE_BATCH`` filas o
+``SHEILY_CHAT_WRITE_INTERVAL_MS`` milisegundos, lo que llegue antes), fuera de la
+ruta de la petición. Si la base de datos no está disponible el lote se guarda en un
+fichero JSONL local y se reintenta más tarde; al apagar se vacía la cola. Si un lote
+falla por sus datos se reintenta fila a fila y las filas que no se pueden guardar
+(o las líneas ilegibles del volcado) se apartan a un fichero de descartes
+(``SHEILY_CHAT_DEAD_LETTER_PATH``) para no bloquear al resto.
+
+Sin la tarea arrancada (scripts, tests) los mensajes se escriben en el momento.
+Tras cada lote guardado se avisa a los oyentes registrados (p. ej. el índice de
+recuperación) con los ids asignados.
+
+Los intercambios que el cliente abandona a medias se guardan con estado
+``MESSAGE_ABORTED``: quedan registrados, pero no cuentan como turnos de la
+conversación ni como historial.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+from sheily_light_api.core import database
+from sheily_light_api.models import ChatMessage, Conversation
+
+logger = logging.getLogger("sheily_chat_persistence")
+
+CHAT_WRITE_BATCH = int(os.getenv("SHEILY_CHAT_WRITE_BATCH", "50"))
+CHAT_WRITE_INTERVAL_MS = float(os.getenv("SHEILY_CHAT_WRITE_INTERVAL_MS", "200"))
+CHAT_SPOOL_PATH = os.getenv(
+    "SHEILY_CHAT_SPOOL_PATH", os.path.join(os.path.expanduser("~"), ".sheily", "spool", "chat_messages.jsonl")
+)
+CHAT_DEAD_LETTER_PATH = os.getenv(
+    "SHEILY_CHAT_DEAD_LETTER_PATH", os.path.join(os.path.dirname(CHAT_SPOOL_PATH), "chat_messages.dead.jsonl")
+)
+# Espera antes de reintentar cuando la base de datos falla
+CHAT_WRITE_RETRY_SECONDS = float(os.getenv("SHEILY_CHAT_WRITE_RETRY_SECONDS", "5"))
+
+_SAMPLES = 256
+
+# Errores de la propia fila (restricciones, tipos, registro mal formado): reintentarla no sirve
+_BAD_ROW_ERRORS = (IntegrityError, DataError, KeyError, TypeError, ValueError)
+
+# Estado de los mensajes cuyo cliente se desconectó antes de recibir la respuesta
+MESSAGE_ABORTED = "aborted"
+
+WrittenListener = Callable[[List[Tuple[int, Dict[str, Any]]]], None]
+
+
+class SheilyChatWriteBehind:
+    """Cola de escritura diferida de ``ChatMessage`` con volcado a disco ante fallos."""
+
+    def __init__(
+        self,
+        session_factory: Optional[Callable[[], Session]] = None,
+        batch_size: int = CHAT_WRITE_BATCH,
+        flush_interval_ms: float = CHAT_WRITE_INTERVAL_MS,
+        spool_path: str = CHAT_SPOOL_PATH,
+        dead_letter_path: str = CHAT_DEAD_LETTER_PATH,
+    ):
+        self._session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.spool_path = Path(spool_path)
+        self.dead_letter_path = Path(dead_letter_path)
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._in_flight: List[Dict[str, Any]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flush_ms: Deque[float] = deque(maxlen=_SAMPLES)
+        self._listeners: List[WrittenListener] = []
+        self.flushed = 0
+        self.batches = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.errors = 0
+        self.dead_lettered = 0
+        self.aborted = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def submit(
+        self,
+        user_id: int,
+        prompt: str,
+        response: str,
+        conversation_id: Optional[int] = None,
+        db: Optional[Session] = None,
+        timing: Optional[Dict[str, Any]] = None,
+        status: Optional[str] = None,
+    ) -> None:
+        """
+        Registra un intercambio terminado.
+
+        Con la tarea en marcha solo se encola; si no, se escribe ya con ``db``
+        (o con una sesión propia). ``timing`` son las columnas del desglose de la
+        generación (``GenerationTiming.columns``); ``status`` es ``MESSAGE_ABORTED``
+        si el cliente no esperó a la respuesta.
+        """
+        record = {
+            "user_id": user_id,
+            "prompt": prompt,
+            "response": response,
+            "conversation_id": conversation_id,
+            "created_at": datetime.utcnow().isoformat(),
+            "timing": timing,
+            "status": status,
+        }
+        if status == MESSAGE_ABORTED:
+            self.aborted += 1
+        if not self.running:
+            if db is not None:
+                self._write(db, [record])
+            else:
+                self._write_batch([record])
+            return
+
+        self._queue.append(record)
+        self._wakeup.set()
+        if len(self._queue) >= self.batch_size:
+            self._full.set()
+
+    def add_listener(self, listener: WrittenListener) -> None:
+        """Registra una función que recibe ``(id, registro)`` de cada mensaje guardado."""
+        self._listeners.append(listener)
+
+    def pending_turns(self, conversation_id: int) -> List[ChatMessage]:
+        """Turnos encolados aún no escritos de una conversación, para que el siguiente turno los vea."""
+        return [
+            _to_message(record)
+            for record in (*self._in_flight, *self._queue)
+            if record["conversation_id"] == conversation_id and not is_aborted(record)
+        ]
+
+    def start(self) -> None:
+        """Arranca la tarea de escritura; reintenta primero lo que quedó en el fichero de volcado."""
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        if self.spool_path.exists():
+            self._wakeup.set()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """Detiene la tarea y vacía la cola (al fichero de volcado si la base de datos falla)."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Escribe todo lo encolado en lotes de ``batch_size`` filas."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            await asyncio.to_thread(self._replay_spool)
+            while self._queue:
+                self._in_flight = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                try:
+                    await asyncio.to_thread(self._write_batch, self._in_flight)
+                except Exception as e:
+                    self.errors += 1
+                    logger.error(f"Chat message batch write failed, retrying {len(self._in_flight)} rows: {str(e)}")
+                    pending = await asyncio.to_thread(self._write_rows, self._in_flight)
+                    if pending:
+                        await asyncio.to_thread(self._spool, pending)
+                finally:
+                    self._in_flight = []
+
+    def stats(self) -> Dict[str, Any]:
+        samples = sorted(self._flush_ms)
+        return {
+            "running": self.running,
+            "queued": len(self._queue) + len(self._in_flight),
+            "batch_size": self.batch_size,
+            "flush_interval_ms": self.flush_interval * 1000,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "flush_ms_avg": sum(samples) / len(samples) if samples else 0.0,
+            "flush_ms_p95": samples[min(len(samples) - 1, int(0.95 * len(samples)))] if samples else 0.0,
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "errors": self.errors,
+            "dead_lettered": self.dead_lettered,
+            "aborted": self.aborted,
+        }
+
+    # ------------------------------------------------------------------
+    # Internos
+    # ------------------------------------------------------------------
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            try:
+                # Agrupar lo que llegue durante el intervalo, salvo que el lote se llene antes
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._full.clear()
+            await self.flush()
+            if self.spool_path.exists():
+                # La base de datos sigue fallando: reintentar más tarde
+                await asyncio.sleep(CHAT_WRITE_RETRY_SECONDS)
+                self._wakeup.set()
+
+    def _session(self) -> Session:
+        return (self._session_factory or database.SessionLocal)()
+
+    def _write_batch(self, records: List[Dict[str, Any]]) -> None:
+        db = self._session()
+        try:
+            self._write(db, records)
+        finally:
+            db.close()
+
+    def _write(self, db: Session, records: List[Dict[str, Any]]) -> None:
+        started = time.perf_counter()
+        try:
+            messages = [_to_message(record) for record in records]
+            db.add_all(messages)
+            db.flush()
+            # Los ids se leen antes del commit, que expira los objetos
+            written = [(message.id, record) for message, record in zip(messages, records)]
+            conversation_ids = {r["conversation_id"] for r in records if r["conversation_id"] is not None}
+            if conversation_ids:
+                db.query(Conversation).filter(Conversation.id.in_(conversation_ids)).update(
+                    {"updated_at": datetime.utcnow()}, synchronize_session=False
+                )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        self._flush_ms.append((time.perf_counter() - started) * 1000)
+        self.flushed += len(records)
+        self.batches += 1
+        for listener in self._listeners:
+            try:
+                listener(written)
+            except Exception as e:
+                # El lote ya está guardado: un fallo aquí no debe volcarlo ni reintentarlo
+                logger.error(f"Chat message listener failed: {str(e)}")
+
+    def _write_rows(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Escribe fila a fila un lote que ha fallado entero.
+
+        Las filas que fallan por sus datos van al fichero de descartes; si falla la
+        base de datos se devuelven esa fila y las siguientes para reintentarlas.
+        """
+        for position, record in enumerate(records):
+            try:
+                self._write_batch([record])
+            except _BAD_ROW_ERRORS as e:
+                logger.error(f"Chat message row cannot be written, moving it to {self.dead_letter_path}: {str(e)}")
+                self._dead_letter({"record": record, "error": str(e)})
+            except Exception:
+                return records[position:]
+        return []
+
+    def _dead_letter(self, entry: Dict[str, Any]) -> None:
+        self.dead_letter_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({**entry, "failed_at": datetime.utcnow().isoformat()}, ensure_ascii=False) + "\n")
+        self.dead_lettered += 1
+
+    def _spool(self, records: List[Dict[str, Any]]) -> None:
+        self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.spooled += len(records)
+
+    def _replay_spool(self) -> None:
+        if not self.spool_path.exists():
+            return
+        records = []
+        with open(self.spool_path, "r", encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Línea a medias de un volcado interrumpido: se aparta para no bloquear las demás
+                    logger.warning(f"Skipping unreadable line {number} of chat message spool {self.spool_path}")
+                    self._dead_letter({"line": line.rstrip("\n"), "error": "invalid JSON"})
+                    continue
+                records.append(record)
+        dead_before = self.dead_lettered
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start : start + self.batch_size]
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logger.warning(f"Chat message spool replay failed, retrying {len(batch)} rows one by one: {str(e)}")
+                pending = self._write_rows(batch)
+                if pending:
+                    # Reescribir solo lo pendiente para no duplicar las filas ya escritas
+                    self._rewrite_spool(pending + records[start + len(batch) :])
+                    self.replayed += start + len(batch) - len(pending) - (self.dead_lettered - dead_before)
+                    return
+        self.spool_path.unlink()
+        written = len(records) - (self.dead_lettered - dead_before)
+        self.replayed += written
+        logger.info(f"Replayed {written} spooled chat messages")
+
+    def _rewrite_spool(self, records: List[Dict[str, Any]]) -> None:
+        tmp = self.spool_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.spool_path)
+
+
+def is_aborted(record: Dict[str, Any]) -> bool:
+    """Si el registro de la cola corresponde a un intercambio abandonado por el cliente."""
+    return record.get("status") == MESSAGE_ABORTED
+
+
+def _to_message(record: Dict[str, Any]) -> ChatMessage:
+    return ChatMessage(
+        user_id=record["user_id"],
+        prompt=record["prompt"],
+        response=record["response"],
+        conversation_id=record["conversation_id"],
+        created_at=datetime.fromisoformat(record["created_at"]),
+        status=record.get("status"),
+        # Los volcados anteriores a esta columna no la traen
+        **(record.get("timing") or {}),
+    )
+
+
+# Instancia global de la cola de escritura del chat
+chat_writer = SheilyChatWriteBehind()
@@ -0,0 +1,191 @@
+"""Caché de respuestas exactas del chat: LRU en proceso respaldada por el Redis de FastAPICache."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    from fastapi_cache import FastAPICache
+except ImportError:  # pragma: no cover - fastapi-cache2 solo se instala con la API completa
+    FastAPICache = None
+
+from sheily_light_api.sheily_modules.sheily_chat_module.search_utils import needs_search
+
+logger = logging.getLogger("sheily_chat_cache")
+
+CHAT_CACHE_ENABLED = os.getenv("SHEILY_CHAT_CACHE_ENABLED", "true").lower() == "true"
+CHAT_CACHE_TTL = int(os.getenv("SHEILY_CHAT_CACHE_TTL", "3600"))  # segundos
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("SHEILY_CHAT_CACHE_MAX_ENTRIES", "1024"))
+
+_WHITESPACE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = "¿?¡!.,;: "
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normaliza un prompt para que variaciones triviales compartan entrada de caché."""
+    text = unicodedata.normalize("NFKC", prompt).casefold()
+    text = _WHITESPACE.sub(" ", text)
+    return text.strip(_EDGE_PUNCTUATION)
+
+
+def make_request_key(
+    prompt: str, model: str, options: Optional[Dict[str, Any]] = None, scope: Optional[str] = None
+) -> str:
+    """
+    Clave estable de una petición de generación: (prompt normalizado, modelo, opciones).
+
+    ``scope`` separa las respuestas personalizadas (p. ej. ``user:7``), que solo
+    pueden reutilizarse para el mismo usuario.
+    """
+    payload = {"prompt": normalize_prompt(prompt), "model": model, "options": options or {}}
+    if scope is not None:
+        payload["scope"] = scope
+    raw = json.dumps(
+        payload,
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SheilyChatResponseCache:
+    """
+    Caché de respuestas del chat por coincidencia exacta de (prompt normalizado, modelo, opciones).
+
+    Nivel 1: LRU en memoria del proceso con TTL.
+    Nivel 2: el backend Redis configurado en FastAPICache (si está inicializado), compartido
+    entre workers. Los fallos de Redis se registran y se tratan como fallos de caché.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CHAT_CACHE_MAX_ENTRIES,
+        ttl: int = CHAT_CACHE_TTL,
+        enabled: bool = CHAT_CACHE_ENABLED,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    def key_for(
+        self, prompt: str, model: str, options: Optional[Dict[str, Any]] = None, scope: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Calcula la clave de caché de una petición (ver ``make_request_key``).
+
+        Returns:
+            Optional[str]: La clave, o None si la petición no debe cachearse
+            (caché desactivada o prompt con datos en tiempo real).
+        """
+        if not self.enabled:
+            return None
+        if needs_search(prompt):
+            self.bypassed += 1
+            return None
+        return make_request_key(prompt, model, options, scope)
+
+    async def get(self, key: str) -> Optional[str]:
+        """Busca una respuesta en memoria y, si no está, en Redis."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        value = await self._redis_get(key)
+        if value is not None:
+            self.redis_hits += 1
+            self._store_local(key, value)
+            return value
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str) -> None:
+        """Guarda una respuesta en ambos niveles."""
+        if not value:
+            return
+        self._store_local(key, value)
+        await self._redis_set(key, value)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.redis_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.redis_hits) / lookups if lookups else 0.0,
+        }
+
+    def _store_local(self, key: str, value: str) -> None:
+        self._entries[key] = (self._clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _redis_backend(self):
+        if FastAPICache is None:
+            return None
+        try:
+            return FastAPICache.get_backend()
+        except AssertionError:
+            # FastAPICache.init no se ha llamado (tests, scripts)
+            return None
+
+    def _redis_key(self, key: str) -> str:
+        return f"{FastAPICache.get_prefix()}:sheily-chat:{key}"
+
+    async def _redis_get(self, key: str) -> Optional[str]:
+        backend = self._redis_backend()
+        if backend is None:
+            return None
+        try:
+            value = await backend.get(self._redis_key(key))
+        except Exception as e:
+            logger.warning(f"Chat cache Redis lookup failed: {str(e)}")
+            return None
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return value
+
+    async def _redis_set(self, key: str, value: str) -> None:
+        backend = self._redis_backend()
+        if backend is None:
+            return
+        try:
+            await backend.set(self._redis_key(key), value.encode("utf-8"), expire=self.ttl)
+        except Exception as e:
+            logger.warning(f"Chat cache Redis store failed: {str(e)}")
+
+
+# Instancia global de la caché de respuestas
+response_cache = SheilyChatResponseCache()
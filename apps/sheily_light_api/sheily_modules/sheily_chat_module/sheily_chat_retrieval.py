@@ -0,0 +1,359 @@
+"""Recuperación léxica (BM25) sobre el historial de chat de cada usuario.
+
+Cada usuario tiene su propio fragmento de índice invertido (término -> mensaje ->
+frecuencia) que se mantiene de forma incremental: la cola de escritura del chat
+avisa de cada lote guardado y sus mensajes se indexan al momento. Los fragmentos se
+persisten como un registro JSONL append-only por usuario con las frecuencias ya
+calculadas, así que cargarlos no vuelve a tokenizar ni a recorrer la tabla; al
+cargar solo se indexan los mensajes con id posterior al último indexado.
+
+Varios workers de uvicorn comparten los registros: cada escritura toma el cerrojo
+del fichero (``flock``) y antes incorpora lo que hayan añadido los demás, y cada
+búsqueda lee las líneas nuevas desde el último desplazamiento leído.
+
+Las respuestas pasadas más relevantes se añaden al prompt como contexto, sin
+depender de la red.
+"""
+
+from __future__ import annotations
+
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy.orm import Session
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin cerrojo entre procesos, un solo worker
+    fcntl = None
+
+from sheily_light_api.core import database
+from sheily_light_api.models import ChatMessage
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_persistence import (
+    MESSAGE_ABORTED,
+    chat_writer,
+    is_aborted,
+)
+
+logger = logging.getLogger("sheily_chat_retrieval")
+
+RETRIEVAL_ENABLED = os.getenv("SHEILY_RETRIEVAL_ENABLED", "true").lower() == "true"
+RETRIEVAL_DIR = os.getenv(
+    "SHEILY_RETRIEVAL_DIR", os.path.join(os.path.expanduser("~"), ".sheily", "index", "chat_history")
+)
+RETRIEVAL_TOP_K = int(os.getenv("SHEILY_RETRIEVAL_TOP_K", "3"))
+# Puntuación BM25 mínima para considerar relevante un mensaje pasado
+RETRIEVAL_MIN_SCORE = float(os.getenv("SHEILY_RETRIEVAL_MIN_SCORE", "1.5"))
+# Fragmentos de usuario que se mantienen en memoria a la vez
+RETRIEVAL_MAX_SHARDS = int(os.getenv("SHEILY_RETRIEVAL_MAX_SHARDS", "64"))
+RETRIEVAL_SNIPPET_CHARS = int(os.getenv("SHEILY_RETRIEVAL_SNIPPET_CHARS", "400"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_SAMPLES = 256
+_TOKEN = re.compile(r"\w+")
+_STOPWORDS = frozenset(
+    "a al algo con como cual de del el ella en era es esa ese eso esta este esto fue ha hay la las le lo los "
+    "mas me mi muy no nos o para pero por que se si sin sobre su sus te tu un una uno y ya yo the and of to is "
+    "in it for on".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Términos indexables: minúsculas, sin tildes ni palabras vacías."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in _TOKEN.findall(text) if len(t) > 1 and t not in _STOPWORDS]
+
+
+@dataclass
+class RetrievedMessage:
+    """Mensaje pasado relevante para el prompt actual."""
+
+    message_id: int
+    prompt: str
+    response: str
+    score: float
+    conversation_id: Optional[int] = None
+
+
+class _UserShard:
+    """Índice invertido BM25 del historial de un usuario."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._reset()
+
+    def refresh(self) -> None:
+        """Incorpora las líneas que otros workers hayan añadido desde la última lectura."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            # Fichero recreado: se vuelve a leer entero
+            self._reset()
+        if stat.st_size > self._offset:
+            with open(self.path, "rb") as f:
+                self._inode = os.fstat(f.fileno()).st_ino
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # línea a medio escribir: se leerá en el próximo refresh
+                    self._offset += len(line)
+                    if line.strip():
+                        self._add(json.loads(line))
+
+    def add(self, entries: List[Dict[str, Any]]) -> int:
+        """Indexa y persiste mensajes nuevos (se ignoran los ya indexados); devuelve cuántos."""
+        entries = [e for e in entries if e["id"] not in self.doc_len]
+        if not entries:
+            return 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # Otro worker pudo indexar los mismos mensajes (p. ej. al ponerse al día a la vez)
+                self.refresh()
+                entries = [e for e in entries if e["id"] not in self.doc_len]
+                if not entries:
+                    return 0
+                if os.fstat(f.fileno()).st_size > self._offset:
+                    f.truncate(self._offset)  # resto de una escritura interrumpida
+                data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries).encode("utf-8")
+                f.write(data)
+                f.flush()
+                self._inode = os.fstat(f.fileno()).st_ino
+                self._offset += len(data)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        for entry in entries:
+            self._add(entry)
+        return len(entries)
+
+    def search(self, terms: Sequence[str], k: int) -> List[Tuple[float, int]]:
+        n = len(self.doc_len)
+        if not n:
+            return []
+        avg_len = self.total_len / n
+        scores: Dict[int, float] = {}
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            df = len(postings)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for doc_id, tf in postings.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return heapq.nlargest(k, ((score, doc_id) for doc_id, score in scores.items()))
+
+    def _reset(self) -> None:
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_len: Dict[int, int] = {}
+        self.docs: Dict[int, Tuple[str, str, Optional[int]]] = {}
+        self.total_len = 0
+        self.watermark = 0
+        self._offset = 0
+        self._inode: Optional[int] = None
+
+    def _add(self, entry: Dict[str, Any]) -> None:
+        doc_id = entry["id"]
+        if doc_id in self.doc_len:
+            # Línea repetida de registros antiguos: no debe contar dos veces en la longitud media
+            return
+        for term, tf in entry["tf"].items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.doc_len[doc_id] = entry["len"]
+        self.docs[doc_id] = (entry["prompt"], entry["response"], entry.get("conversation_id"))
+        self.total_len += entry["len"]
+        self.watermark = max(self.watermark, doc_id)
+
+
+class SheilyChatRetrieval:
+    """Índice BM25 del historial de chat, fragmentado por usuario y persistido en disco."""
+
+    def __init__(
+        self,
+        index_dir: str = RETRIEVAL_DIR,
+        enabled: bool = RETRIEVAL_ENABLED,
+        top_k: int = RETRIEVAL_TOP_K,
+        min_score: float = RETRIEVAL_MIN_SCORE,
+        max_shards: int = RETRIEVAL_MAX_SHARDS,
+        session_factory: Optional[Callable[[], Session]] = None,
+    ):
+        self.index_dir = Path(index_dir)
+        self.enabled = enabled
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_shards = max_shards
+        self._session_factory = session_factory
+        self._shards: "OrderedDict[int, _UserShard]" = OrderedDict()
+        # Protege solo el LRU de fragmentos y los contadores
+        self._lock = threading.Lock()
+        # La cola de escritura indexa desde sus hilos mientras el chat consulta: cada usuario tiene su cerrojo,
+        # así cargar un fragmento (disco y base de datos) no bloquea a los demás usuarios
+        self._user_locks: Dict[int, threading.Lock] = {}
+        self._lookup_ms: Deque[float] = deque(maxlen=_SAMPLES)
+        self.indexed = 0
+        self.lookups = 0
+        self.hits = 0
+
+    def index_messages(self, messages: Iterable[Tuple[int, Dict[str, Any]]]) -> None:
+        """Indexa mensajes recién guardados: pares ``(id, registro)`` de la cola de escritura."""
+        if not self.enabled:
+            return
+        by_user: Dict[int, List[Dict[str, Any]]] = {}
+        for message_id, record in messages:
+            if is_aborted(record):
+                # Respuesta incompleta: no sirve como recuerdo
+                continue
+            by_user.setdefault(record["user_id"], []).append(_entry(message_id, record))
+        for user_id, entries in by_user.items():
+            with self._user_lock(user_id):
+                added = self._shard(user_id).add(entries)
+            with self._lock:
+                self.indexed += added
+
+    def search(
+        self, user_id: int, query: str, k: Optional[int] = None, exclude_conversation: Optional[int] = None
+    ) -> List[RetrievedMessage]:
+        """
+        Mensajes pasados del usuario más relevantes para ``query``.
+
+        Args:
+            user_id: Propietario del historial
+            query: Texto del prompt actual
+            k: Número máximo de resultados (por defecto ``top_k``)
+            exclude_conversation: Conversación cuyos turnos ya van en el contexto
+        """
+        if not self.enabled:
+            return []
+        terms = tokenize(query)
+        if not terms:
+            return []
+        started = time.perf_counter()
+        k = k or self.top_k
+        with self._user_lock(user_id):
+            shard = self._shard(user_id)
+            # Recoger lo que hayan indexado otros workers
+            shard.refresh()
+            results = []
+            # Pedir de más por si hay que descartar turnos de la conversación actual
+            for score, doc_id in shard.search(terms, k * 2 if exclude_conversation is not None else k):
+                prompt, response, conversation_id = shard.docs[doc_id]
+                if score < self.min_score or (
+                    exclude_conversation is not None and conversation_id == exclude_conversation
+                ):
+                    continue
+                results.append(RetrievedMessage(doc_id, prompt, response, score, conversation_id))
+                if len(results) == k:
+                    break
+        self._lookup_ms.append((time.perf_counter() - started) * 1000)
+        self.lookups += 1
+        if results:
+            self.hits += 1
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        samples = sorted(self._lookup_ms)
+        return {
+            "enabled": self.enabled,
+            "shards_loaded": len(self._shards),
+            "indexed": self.indexed,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "lookup_ms_avg": sum(samples) / len(samples) if samples else 0.0,
+            "lookup_ms_p95": samples[min(len(samples) - 1, int(0.95 * len(samples)))] if samples else 0.0,
+        }
+
+    def _user_lock(self, user_id: int) -> threading.Lock:
+        with self._lock:
+            return self._user_locks.setdefault(user_id, threading.Lock())
+
+    def _shard(self, user_id: int) -> _UserShard:
+        """Fragmento del usuario; se llama con su cerrojo tomado."""
+        with self._lock:
+            shard = self._shards.get(user_id)
+            if shard is not None:
+                self._shards.move_to_end(user_id)
+                return shard
+        # Cargar y ponerse al día fuera del cerrojo global
+        shard = _UserShard(self.index_dir / f"user_{user_id}.jsonl")
+        shard.refresh()
+        added = self._catch_up(user_id, shard)
+        with self._lock:
+            self.indexed += added
+            self._shards[user_id] = shard
+            while len(self._shards) > self.max_shards:
+                self._shards.popitem(last=False)
+        return shard
+
+    def _catch_up(self, user_id: int, shard: _UserShard) -> int:
+        """Indexa los mensajes guardados después del último indexado (p. ej. tras un reinicio)."""
+        try:
+            db = (self._session_factory or database.SessionLocal)()
+            try:
+                rows = (
+                    db.query(ChatMessage)
+                    .filter(
+                        ChatMessage.user_id == user_id,
+                        ChatMessage.id > shard.watermark,
+                        ChatMessage.status.is_distinct_from(MESSAGE_ABORTED),
+                    )
+                    .order_by(ChatMessage.id)
+                    .all()
+                )
+                entries = [_entry(row.id, _record(row)) for row in rows]
+            finally:
+                db.close()
+        except Exception as e:
+            logger.warning(f"Chat history catch-up failed for user {user_id}: {str(e)}")
+            return 0
+        return shard.add(entries)
+
+
+def format_memories(memories: Sequence[RetrievedMessage]) -> str:
+    """Bloque de contexto con los intercambios pasados recuperados."""
+    return "\n".join(f"Usuario: {m.prompt}\nAsistente: {m.response}" for m in memories)
+
+
+def _record(message: ChatMessage) -> Dict[str, Any]:
+    return {
+        "user_id": message.user_id,
+        "prompt": message.prompt,
+        "response": message.response,
+        "conversation_id": message.conversation_id,
+    }
+
+
+def _entry(message_id: int, record: Dict[str, Any]) -> Dict[str, Any]:
+    terms = tokenize(f"{record['prompt']} {record['response']}")
+    return {
+        "id": message_id,
+        "len": len(terms),
+        "tf": dict(Counter(terms)),
+        "prompt": record["prompt"][:RETRIEVAL_SNIPPET_CHARS],
+        "response": record["response"][:RETRIEVAL_SNIPPET_CHARS],
+        "conversation_id": record.get("conversation_id"),
+    }
+
+
+# Instancia global del índice de historial del chat
+chat_retrieval = SheilyChatRetrieval()
+# Indexar cada lote que guarda la cola de escritura del chat
+chat_writer.add_listener(chat_retrieval.index_messages)
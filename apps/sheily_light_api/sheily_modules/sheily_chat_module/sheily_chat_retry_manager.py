@@ -1,14 +1,41 @@
+import os
+
 import requests
 
-CENTRAL_URL = "https://sheily-central.example.com/api/chat"
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import get_async_http_client
+
+CENTRAL_URL = os.getenv("SHEILY_CENTRAL_CHAT_URL", "https://sheily-central.example.com/api/chat")
+# Sin URL explícita ``CENTRAL_URL`` es un marcador de posición: no hay central real a la que recurrir
+CENTRAL_CONFIGURED = bool(os.getenv("SHEILY_CENTRAL_CHAT_URL"))
+CENTRAL_TIMEOUT = float(os.getenv("SHEILY_CENTRAL_TIMEOUT", "30"))
 
 
 def chat_with_fallback(prompt: str, user: str) -> str:
     payload = {"message": prompt, "user": user}
     try:
-        r = requests.post(CENTRAL_URL, json=payload, timeout=30)
+        r = requests.post(CENTRAL_URL, json=payload, timeout=CENTRAL_TIMEOUT)
         r.raise_for_status()
         data = r.json()
         return data.get("answer", "")
     except Exception as e:
         return f"Error: No se pudo obtener respuesta de la central ({e})"
+
+
+async def ask_central(prompt: str, user: str) -> str:
+    """Pregunta a la central usando el pool HTTP compartido.
+
+    A diferencia de ``chat_with_fallback``, los errores se propagan: quien la usa
+    como cobertura de la IA local necesita distinguir un fallo de una respuesta.
+
+    Raises:
+        httpx.HTTPError: Si la central no responde o devuelve un error
+        ValueError: Si la respuesta no trae ``answer``
+    """
+    r = await get_async_http_client().post(
+        CENTRAL_URL, json={"message": prompt, "user": user}, timeout=CENTRAL_TIMEOUT
+    )
+    r.raise_for_status()
+    answer = r.json().get("answer")
+    if not answer:
+        raise ValueError("La central no devolvió respuesta")
+    return answer
@@ -0,0 +1,240 @@
+"""Caché semántica del chat: sirve respuestas previas a prompts parafraseados.
+
+Los embeddings de los prompts ya respondidos se guardan en un ``SheilyVectorIndex``
+(matriz float32 mapeada en memoria, un espacio de nombres por modelo), de modo que
+la búsqueda top-1 por coseno es un único producto matriz-vector y la caché
+sobrevive a los reinicios. El índice se abre compartido: todos los workers de
+uvicorn leen y escriben el mismo directorio y ven lo que guardan los demás. Las
+operaciones sobre el índice (carga, ``refresh``, búsqueda, altas y bajas) leen y
+escriben disco, así que se ejecutan fuera del event loop.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from sheily_light_api.sheily_modules.sheily_chat_module.search_utils import needs_search
+from sheily_light_api.sheily_modules.sheily_model_inference.embedding_service import (
+    SheilyEmbeddingService,
+    embedding_service,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_options import options_fingerprint
+from sheily_light_api.sheily_modules.sheily_vector_store.sheily_vector_index import (
+    SheilyVectorIndex,
+    VectorHit,
+    normalize,
+)
+
+logger = logging.getLogger("sheily_chat_semantic_cache")
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SHEILY_SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SHEILY_SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_CAPACITY = int(os.getenv("SHEILY_SEMANTIC_CACHE_CAPACITY", "4096"))
+SEMANTIC_CACHE_DIR = os.getenv(
+    "SHEILY_SEMANTIC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".sheily", "cache", "semantic")
+)
+EMBED_MODEL = os.getenv("SHEILY_EMBED_MODEL", "nomic-embed-text")
+
+
+@dataclass
+class SemanticLookup:
+    """Resultado de una búsqueda; el embedding se reutiliza al guardar la respuesta."""
+
+    answer: Optional[str]
+    embedding: Optional[np.ndarray]
+    score: float = 0.0
+
+
+class SheilySemanticCache:
+    """
+    Caché de respuestas por similitud de embeddings.
+
+    Cada entrada es una fila del índice vectorial con el prompt y la respuesta como
+    metadatos. Cuando la caché está llena se borra la entrada usada hace más tiempo
+    (el índice compacta las filas borradas).
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = SEMANTIC_CACHE_DIR,
+        capacity: int = SEMANTIC_CACHE_CAPACITY,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        embed_model: str = EMBED_MODEL,
+        enabled: bool = SEMANTIC_CACHE_ENABLED,
+        embedder: Optional[SheilyEmbeddingService] = None,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.capacity = capacity
+        self.threshold = threshold
+        self.embed_model = embed_model
+        self.enabled = enabled
+        self.embedder = embedder or embedding_service
+
+        self._index: Optional[SheilyVectorIndex] = None
+        # id de entrada -> None; la primera es la usada hace más tiempo
+        self._lru: "OrderedDict[str, None]" = OrderedDict()
+        # El índice y el LRU se usan desde hilos de ``asyncio.to_thread``
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.embed_errors = 0
+        self.evictions = 0
+
+    # ------------------------------------------------------------------
+    # API pública
+    # ------------------------------------------------------------------
+
+    async def lookup(
+        self, prompt: str, model: str, options: Optional[Dict[str, Any]] = None, scope: Optional[str] = None
+    ) -> SemanticLookup:
+        """
+        Busca la respuesta de un prompt similar ya respondido por el mismo modelo con las mismas opciones.
+
+        Con ``scope`` solo se consideran las respuestas guardadas con el mismo ``scope``.
+        """
+        if not self.enabled or needs_search(prompt):
+            return SemanticLookup(None, None)
+
+        embedding = await self._embed(prompt)
+        if embedding is None:
+            return SemanticLookup(None, None)
+
+        hit = await asyncio.to_thread(self._search, embedding, _namespace(model, options, scope))
+        if hit is not None and hit.score >= self.threshold:
+            self.hits += 1
+            return SemanticLookup(hit.meta["answer"], embedding, hit.score)
+
+        self.misses += 1
+        return SemanticLookup(None, embedding, max(hit.score, 0.0) if hit is not None else 0.0)
+
+    async def store(
+        self,
+        prompt: str,
+        model: str,
+        answer: str,
+        embedding: Optional[np.ndarray] = None,
+        options: Optional[Dict[str, Any]] = None,
+        scope: Optional[str] = None,
+    ) -> None:
+        """Guarda una respuesta; reutiliza el embedding calculado en ``lookup`` si existe."""
+        if not self.enabled or not answer or needs_search(prompt):
+            return
+        if embedding is None:
+            embedding = await self._embed(prompt)
+            if embedding is None:
+                return
+        await asyncio.to_thread(self._store, prompt, answer, embedding, _namespace(model, options, scope))
+
+    def flush(self) -> None:
+        """Sincroniza el índice con el disco."""
+        if self._index is not None:
+            self._index.flush()
+
+    def clear(self) -> None:
+        """Vacía la caché en memoria y en disco."""
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._lru),
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "embed_model": self.embed_model,
+            "hits": self.hits,
+            "misses": self.misses,
+            "embed_errors": self.embed_errors,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    # ------------------------------------------------------------------
+    # Internos
+    # ------------------------------------------------------------------
+
+    async def _embed(self, text: str) -> Optional[np.ndarray]:
+        try:
+            vector = await self.embedder.embed(text, self.embed_model)
+        except Exception as e:
+            self.embed_errors += 1
+            logger.warning(f"Semantic cache embedding failed: {str(e)}")
+            return None
+        return normalize(vector)
+
+    def _search(self, embedding: np.ndarray, namespace: str) -> Optional[VectorHit]:
+        with self._lock:
+            hits = self._ensure_loaded().search(embedding, k=1, namespace=namespace)
+            if hits and hits[0].score >= self.threshold:
+                # Puede ser una entrada guardada por otro worker
+                self._lru[hits[0].id] = None
+                self._lru.move_to_end(hits[0].id)
+            return hits[0] if hits else None
+
+    def _store(self, prompt: str, answer: str, embedding: np.ndarray, namespace: str) -> None:
+        with self._lock:
+            index = self._ensure_loaded()
+            if index.dim is not None and embedding.shape[0] != index.dim:
+                # Ha cambiado el modelo de embeddings: la caché anterior ya no es comparable
+                self._clear()
+
+            entry_id = hashlib.sha1(f"{namespace}\n{prompt}".encode("utf-8")).hexdigest()
+            self._sync_lru(index)
+            while entry_id not in index and self._lru and len(index) >= self.capacity:
+                oldest, _ = self._lru.popitem(last=False)
+                index.delete(oldest)
+                self.evictions += 1
+            index.add(entry_id, embedding, {"prompt": prompt, "answer": answer}, namespace=namespace)
+            self._lru[entry_id] = None
+            self._lru.move_to_end(entry_id)
+
+    def _clear(self) -> None:
+        self._ensure_loaded().clear()
+        self._lru.clear()
+
+    def _ensure_loaded(self) -> SheilyVectorIndex:
+        if self._index is None:
+            try:
+                self._index = SheilyVectorIndex(str(self.cache_dir), shared=True)
+            except Exception as e:
+                logger.error(f"Failed to load semantic cache, starting empty: {str(e)}")
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+                self._index = SheilyVectorIndex(str(self.cache_dir), shared=True)
+            # Las entradas escritas hace más tiempo se expulsan antes
+            self._lru = OrderedDict((entry_id, None) for entry_id in self._index.ids())
+            while len(self._lru) > self.capacity:
+                self._index.delete(self._lru.popitem(last=False)[0])
+            if self._lru:
+                logger.info(f"Semantic cache loaded with {len(self._lru)} entries")
+        return self._index
+
+    def _sync_lru(self, index: SheilyVectorIndex) -> None:
+        """Añade al LRU las entradas que guardaron otros workers y quita las que ya borraron."""
+        index.refresh()
+        for entry_id in [entry_id for entry_id in self._lru if entry_id not in index]:
+            del self._lru[entry_id]
+        for entry_id in index.ids():
+            self._lru.setdefault(entry_id, None)
+
+
+def _namespace(model: str, options: Optional[Dict[str, Any]], scope: Optional[str] = None) -> str:
+    """Espacio de nombres del índice: respuestas del mismo modelo generadas con las mismas opciones (y ``scope``)."""
+    namespace = f"{model}#{options_fingerprint(options)}" if options else model
+    return f"{namespace}@{scope}" if scope is not None else namespace
+
+
+# Instancia global de la caché semántica
+semantic_cache = SheilySemanticCache()
@@ -1,60 +1,512 @@
-from datetime import datetime
+import asyncio
+import os
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
 from sqlalchemy.orm import Session
 
-from sheily_light_api.models import ChatMessage, User
+from sheily_light_api.core.database import SessionLocal
+from sheily_light_api.models import ChatMessage, TokenBalance, User
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_conversation import (
+    ConversationNotFound,
+    conversation_engine,
+    get_conversation,
+    get_turns,
+)
 from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_local_engine import (
-    ask_local_ai,
+    generate_local_ai,
+    plan_model,
+    stream_local_ai,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_documents import (
+    DocumentChunk,
+    document_store,
+    format_documents,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_hedging import chat_hedger
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_persistence import MESSAGE_ABORTED, chat_writer
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_response_cache import (
+    make_request_key,
+    response_cache,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_retrieval import (
+    RetrievedMessage,
+    chat_retrieval,
+    format_memories,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_retry_manager import ask_central
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_semantic_cache import semantic_cache
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_singleflight import inflight_requests
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_options import generation_options
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_timings import GenerationTiming
+from sheily_light_api.sheily_modules.sheily_model_inference.model_router import model_router
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_backend_pool import ollama_backends
+from sheily_light_api.sheily_modules.sheily_model_inference.inference_scheduler import (
+    PRIORITY_INTERACTIVE,
+    inference_scheduler,
 )
 from sheily_light_api.sheily_modules.sheily_chat_module.search_utils import (
+    PendingSearch,
     needs_search,
-    google_search,
+    web_search,
 )
 
 
-def chat_with_local_ai(db: Session, user: User, prompt: str) -> str:
+def _parse_fair_share_tiers(raw: str) -> List[Tuple[int, float]]:
+    tiers = []
+    for item in raw.split(","):
+        if item.strip():
+            balance, weight = item.split(":")
+            tiers.append((int(balance), float(weight)))
+    return sorted(tiers)
+
+
+# Niveles "saldo mínimo:peso" para el reparto justo del modelo según el TokenBalance del usuario
+FAIR_SHARE_TIERS = _parse_fair_share_tiers(os.getenv("SHEILY_FAIR_SHARE_TIERS", "0:1,1000:2,10000:4"))
+
+
+async def chat_with_local_ai(
+    db: Session,
+    user: User,
+    prompt: str,
+    priority: int = PRIORITY_INTERACTIVE,
+    conversation_id: Optional[int] = None,
+    slo_ms: Optional[float] = None,
+) -> str:
     """
     Envía un mensaje a la IA local, almacena la conversación y devuelve la respuesta.
 
+    Si la petición se cancela (el cliente se desconectó), la cancelación aborta la
+    generación en Ollama y el intercambio se guarda como ``MESSAGE_ABORTED``.
+
     Args:
         db: Sesión de base de datos
         user: Usuario que realiza la consulta
         prompt: Mensaje del usuario
+        priority: Clase de prioridad en el planificador de inferencia
+        conversation_id: Conversación multi-turno a la que añadir el mensaje (opcional)
+        slo_ms: Latencia objetivo para elegir el modelo (opcional)
 
     Returns:
         str: Respuesta generada por la IA
+
+    Raises:
+        InferenceQueueFull: Si la cola del modelo está llena
+        ConversationNotFound: Si la conversación no existe o es de otro usuario
     """
-    # Enriquecer el prompt con búsqueda si es necesario
-    enriched_prompt = _enrich_prompt_with_search(prompt)
+    # Solo se confirma (cuenta, histéresis y registro) si hay que generar: no en los aciertos de caché
+    route = plan_model(prompt, slo_ms)
+    model = route.model
+    weight = fair_share_weight(db, user)
+    # JSON final de Ollama si la respuesta se generó para esta petición (con los tiempos)
+    final: Dict[str, Any] = {}
+
+    try:
+        if conversation_id is not None:
+            # Los turnos dependen del historial: ni caché ni coalescencia
+            turns = _load_turns(db, user, conversation_id)
+            # La búsqueda avanza mientras se recupera el contexto personal y se espera un hueco del modelo
+            search = _start_search(prompt)
+            memories = await _recall(user.id, prompt, conversation_id)
+            model_router.commit(route)
+            response = await _generate_turn(
+                turns, conversation_id, prompt, model, priority, user.id, weight, search, memories, final
+            )
+        else:
+            search = _start_search(prompt)
+            memories = await _recall(user.id, prompt)
+            scope = _personal_scope(user.id, memories)
+            # Las preguntas repetidas o parafraseadas se sirven desde la caché sin pasar por el modelo
+            cached = await _lookup_cached_response(prompt, model, scope)
+            response = cached.answer
 
-    # Obtener respuesta de la IA
-    response = ask_local_ai(enriched_prompt)
+            if response is None:
+                model_router.commit(route)
+                # Las peticiones idénticas simultáneas comparten una única generación
+                response = await inflight_requests.do(
+                    make_request_key(prompt, model, cached.options, scope),
+                    lambda: _generate_response(
+                        cached, prompt, model, priority, user.id, weight, search, memories, final
+                    ),
+                )
+    except asyncio.CancelledError:
+        # El cliente se desconectó: la generación ya se abortó por debajo y el intercambio queda como abortado
+        _save_chat_message(db, user.id, prompt, "", conversation_id, status=MESSAGE_ABORTED)
+        raise
 
     # Registrar la conversación en la base de datos
-    _save_chat_message(db, user.id, prompt, response)
+    _save_chat_message(db, user.id, prompt, response, conversation_id, _timing(model, final))
 
     return response
 
 
-def _enrich_prompt_with_search(prompt: str) -> str:
-    """Añade información de búsqueda al prompt si es necesario."""
-    if needs_search(prompt):
-        search_summary = google_search(prompt)
+async def stream_chat_with_local_ai(
+    user: User,
+    prompt: str,
+    priority: int = PRIORITY_INTERACTIVE,
+    conversation_id: Optional[int] = None,
+    slo_ms: Optional[float] = None,
+) -> AsyncIterator[str]:
+    """
+    Variante en streaming de ``chat_with_local_ai``: devuelve los tokens según llegan
+    y guarda la conversación completa cuando el modelo termina.
+
+    La sesión de la petición se libera antes de que acabe el streaming, por lo que
+    el mensaje se guarda con una sesión propia. Si el cliente cierra el stream antes
+    de tiempo se guarda lo recibido hasta entonces como ``MESSAGE_ABORTED``.
+
+    Args:
+        user: Usuario que realiza la consulta
+        prompt: Mensaje del usuario
+        priority: Clase de prioridad en el planificador de inferencia
+        conversation_id: Conversación multi-turno a la que añadir el mensaje (opcional)
+        slo_ms: Latencia objetivo para elegir el modelo (opcional)
+
+    Yields:
+        str: Fragmentos de la respuesta generada por la IA
+    """
+    route = plan_model(prompt, slo_ms)
+    model = route.model
+    final: Dict[str, Any] = {}
+    parts: List[str] = []
+
+    try:
+        if conversation_id is not None:
+            db = SessionLocal()
+            try:
+                weight = fair_share_weight(db, user)
+                turns = _load_turns(db, user, conversation_id)
+            finally:
+                db.close()
+
+            # La búsqueda avanza mientras se recupera el contexto personal y se espera un hueco del modelo
+            search = _start_search(prompt)
+            memories = await _recall(user.id, prompt, conversation_id)
+            model_router.commit(route)
+            async for token in _generate_turn_stream(
+                turns, conversation_id, prompt, model, priority, user.id, weight, search, memories, final
+            ):
+                parts.append(token)
+                yield token
+            response = "".join(parts).strip()
+        else:
+            search = _start_search(prompt)
+            memories = await _recall(user.id, prompt)
+            scope = _personal_scope(user.id, memories)
+            cached = await _lookup_cached_response(prompt, model, scope)
+            response = cached.answer
+
+            if response is not None:
+                yield response
+            else:
+                model_router.commit(route)
+                db = SessionLocal()
+                try:
+                    weight = fair_share_weight(db, user)
+                finally:
+                    db.close()
+
+                source = lambda: _generate_response_stream(  # noqa: E731
+                    cached, prompt, model, priority, user.id, weight, search, memories, final
+                )
+                key = make_request_key(prompt, model, cached.options, scope)
+                async for token in inflight_requests.stream(key, source):
+                    parts.append(token)
+                    yield token
+                response = "".join(parts).strip()
+    except (asyncio.CancelledError, GeneratorExit):
+        # El cliente cerró el stream: se guarda lo que llegó a recibir, marcado como abortado
+        _save_chat_message(None, user.id, prompt, "".join(parts).strip(), conversation_id, status=MESSAGE_ABORTED)
+        raise
+
+    # La sesión de la petición ya no está disponible: la cola de escritura usa la suya
+    _save_chat_message(None, user.id, prompt, response, conversation_id, _timing(model, final))
+
+
+@dataclass
+class _CachedResponse:
+    key: Optional[str]
+    answer: Optional[str] = None
+    embedding: Any = None
+    # Opciones de generación: respuestas con otra temperatura o límite de tokens no son intercambiables
+    options: Optional[Dict[str, Any]] = None
+    # Respuesta personalizada: solo reutilizable para el mismo usuario
+    scope: Optional[str] = None
+
+
+@dataclass
+class _Recall:
+    """Contexto personal del usuario recuperado para el prompt."""
+
+    messages: List[RetrievedMessage] = field(default_factory=list)
+    documents: List[DocumentChunk] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.messages or self.documents)
+
+
+def _personal_scope(user_id: int, memories: Optional[_Recall]) -> Optional[str]:
+    """
+    Ámbito de caché y coalescencia de la petición.
+
+    Con historial o documentos propios en el prompt la respuesta es personal: se
+    cachea y se comparte solo entre peticiones del mismo usuario.
+    """
+    return f"user:{user_id}" if memories else None
+
+
+async def _lookup_cached_response(prompt: str, model: str, scope: Optional[str] = None) -> _CachedResponse:
+    """Consulta la caché exacta y, si falla, la semántica."""
+    options = generation_options.for_model(model)
+    cached = _CachedResponse(key=response_cache.key_for(prompt, model, options, scope), options=options, scope=scope)
+    if cached.key is None:
+        # Prompt con datos en tiempo real o caché desactivada
+        return cached
+
+    cached.answer = await response_cache.get(cached.key)
+    if cached.answer is None:
+        match = await semantic_cache.lookup(prompt, model, options, scope)
+        cached.embedding = match.embedding
+        if match.answer is not None:
+            cached.answer = match.answer
+            await response_cache.set(cached.key, match.answer)
+    return cached
+
+
+async def _store_cached_response(cached: _CachedResponse, prompt: str, model: str, response: str) -> None:
+    if cached.key is None:
+        return
+    await response_cache.set(cached.key, response)
+    await semantic_cache.store(prompt, model, response, cached.embedding, cached.options, cached.scope)
+
+
+def _affinity_key(user_id: int, conversation_id: Optional[int] = None) -> str:
+    """Clave que mantiene la conversación en el mismo backend Ollama (su caché KV sigue caliente)."""
+    if conversation_id is not None:
+        return f"conversation:{conversation_id}"
+    return f"user:{user_id}"
+
+
+def _load_turns(db: Session, user: User, conversation_id: int) -> List[ChatMessage]:
+    if get_conversation(db, user, conversation_id) is None:
+        raise ConversationNotFound(conversation_id)
+    # Incluir los turnos que la cola de escritura aún no ha guardado
+    return get_turns(db, conversation_id) + chat_writer.pending_turns(conversation_id)
+
+
+def fair_share_weight(db: Session, user: User) -> float:
+    """Peso del usuario en el reparto justo del modelo, según su nivel de TokenBalance."""
+    row = db.query(TokenBalance).filter(TokenBalance.user_id == user.id).first()
+    balance = row.balance if row else 0
+    weight = 1.0
+    for min_balance, tier_weight in FAIR_SHARE_TIERS:
+        if balance >= min_balance:
+            weight = tier_weight
+    return weight
+
+
+async def _generate_response(
+    cached: _CachedResponse,
+    prompt: str,
+    model: str,
+    priority: int,
+    user_id: int,
+    weight: float,
+    search: Optional[PendingSearch] = None,
+    memories: Optional[_Recall] = None,
+    final: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Genera la respuesta (una vez por grupo de peticiones idénticas) y la cachea.
+
+    ``final`` recibe el JSON final de Ollama si la respuesta es local.
+    """
+    ollama_backends.ensure_available()
+
+    if chat_hedger.enabled:
+        # Con cobertura hace falta ver el primer token, así que la generación local va en streaming
+        local = _local_tokens(prompt, search, memories, model, priority, user_id, weight, final)
+        outcome: Dict[str, Any] = {}
+        tokens = [token async for token in _hedged(model, local, prompt, user_id, outcome)]
+        response = "".join(tokens).strip()
+        if outcome.get("source") == "central":
+            # La respuesta no es de ``model``: no se cachea con su clave
+            return response
+    else:
+        # Obtener respuesta de la IA sin bloquear el event loop, respetando la concurrencia del modelo
+        async with inference_scheduler.slot(model, priority, flow=user_id, weight=weight):
+            enriched_prompt = await _enrich_prompt(prompt, search, memories)
+            result = await generate_local_ai(enriched_prompt, model=model, affinity_key=_affinity_key(user_id))
+        response = result.get("response", "").strip()
+        if final is not None:
+            final.update(result)
+    await _store_cached_response(cached, prompt, model, response)
+    return response
+
+
+async def _generate_response_stream(
+    cached: _CachedResponse,
+    prompt: str,
+    model: str,
+    priority: int,
+    user_id: int,
+    weight: float,
+    search: Optional[PendingSearch] = None,
+    memories: Optional[_Recall] = None,
+    final: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[str]:
+    """Variante en streaming de ``_generate_response``; cachea al terminar."""
+    ollama_backends.ensure_available()
+
+    parts = []
+    outcome: Dict[str, Any] = {}
+    local = _local_tokens(prompt, search, memories, model, priority, user_id, weight, final)
+    async for token in _hedged(model, local, prompt, user_id, outcome) if chat_hedger.enabled else local:
+        parts.append(token)
+        yield token
+    if outcome.get("source") == "central":
+        # La respuesta no es de ``model``: no se cachea con su clave
+        return
+    await _store_cached_response(cached, prompt, model, "".join(parts).strip())
+
+
+async def _local_tokens(
+    prompt: str,
+    search: Optional[PendingSearch],
+    memories: Optional[_Recall],
+    model: str,
+    priority: int,
+    user_id: int,
+    weight: float,
+    final: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[str]:
+    # El hueco se mantiene mientras el modelo sigue generando tokens
+    async with inference_scheduler.slot(model, priority, flow=user_id, weight=weight):
+        enriched_prompt = await _enrich_prompt(prompt, search, memories)
+        on_done = final.update if final is not None else None
+        async for token in stream_local_ai(
+            enriched_prompt, model=model, affinity_key=_affinity_key(user_id), on_done=on_done
+        ):
+            yield token
+
+
+def _hedged(
+    model: str, local: AsyncIterator[str], prompt: str, user_id: int, outcome: Optional[Dict[str, Any]] = None
+) -> AsyncIterator[str]:
+    """Cubre la generación local con la central si el primer token tarda más de lo habitual."""
+    return chat_hedger.stream(model, local, lambda: ask_central(prompt, str(user_id)), outcome)
+
+
+async def _generate_turn(
+    turns: List[ChatMessage],
+    conversation_id: int,
+    prompt: str,
+    model: str,
+    priority: int,
+    user_id: int,
+    weight: float,
+    search: Optional[PendingSearch] = None,
+    memories: Optional[_Recall] = None,
+    final: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Genera un turno de conversación reutilizando el ``context`` de Ollama del turno anterior."""
+    ollama_backends.ensure_available()
+    async with inference_scheduler.slot(model, priority, flow=user_id, weight=weight):
+        enriched_prompt = await _enrich_prompt(prompt, search, memories)
+        turn = conversation_engine.prepare_turn(conversation_id, turns, enriched_prompt, model)
+        result = await generate_local_ai(
+            turn.prompt, model=model, affinity_key=_affinity_key(user_id, conversation_id), context=turn.context
+        )
+    conversation_engine.complete_turn(conversation_id, model, result, len(turns) + 1)
+    if final is not None:
+        final.update(result)
+    return result.get("response", "").strip()
+
+
+async def _generate_turn_stream(
+    turns: List[ChatMessage],
+    conversation_id: int,
+    prompt: str,
+    model: str,
+    priority: int,
+    user_id: int,
+    weight: float,
+    search: Optional[PendingSearch] = None,
+    memories: Optional[_Recall] = None,
+    final: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[str]:
+    """Variante en streaming de ``_generate_turn``."""
+    ollama_backends.ensure_available()
+    final = final if final is not None else {}
+    async with inference_scheduler.slot(model, priority, flow=user_id, weight=weight):
+        enriched_prompt = await _enrich_prompt(prompt, search, memories)
+        turn = conversation_engine.prepare_turn(conversation_id, turns, enriched_prompt, model)
+        async for token in stream_local_ai(
+            turn.prompt,
+            model=model,
+            affinity_key=_affinity_key(user_id, conversation_id),
+            context=turn.context,
+            on_done=final.update,
+        ):
+            yield token
+    conversation_engine.complete_turn(conversation_id, model, final, len(turns) + 1)
+
+
+def _start_search(prompt: str) -> Optional[PendingSearch]:
+    """Lanza la búsqueda web en segundo plano si el prompt la necesita.
+
+    Se lanza antes de recuperar el contexto personal para que ambas esperas se solapen.
+    """
+    return web_search.start(prompt) if needs_search(prompt) else None
+
+
+async def _recall(user_id: int, prompt: str, conversation_id: Optional[int] = None) -> _Recall:
+    """Intercambios pasados (índice BM25 local) y fragmentos de documentos del usuario relevantes para el prompt."""
+    messages, documents = await asyncio.gather(
+        # Fuera del event loop: la primera consulta de un usuario carga su fragmento del índice
+        asyncio.to_thread(chat_retrieval.search, user_id, prompt, exclude_conversation=conversation_id),
+        document_store.search(user_id, prompt),
+    )
+    return _Recall(messages, documents)
+
+
+async def _enrich_prompt(prompt: str, search: Optional[PendingSearch], memories: Optional[_Recall] = None) -> str:
+    """Añade al prompt el contexto personal y la búsqueda web, si llega dentro del presupuesto de latencia."""
+    enriched = prompt
+    if memories and memories.documents:
+        enriched = f"{enriched}\n\n[DOCUMENTOS DEL USUARIO]\n{format_documents(memories.documents)}"
+    if memories and memories.messages:
+        enriched = f"{enriched}\n\n[CONVERSACIONES ANTERIORES RELEVANTES]\n{format_memories(memories.messages)}"
+    if search is not None:
+        search_summary = await search.result()
         if search_summary:
-            return f"{prompt}\n\n[DATO EN TIEMPO REAL]\n{search_summary}"
-    return prompt
+            enriched = f"{enriched}\n\n[DATO EN TIEMPO REAL]\n{search_summary}"
+    return enriched
+
 
+def _timing(model: str, final: Dict[str, Any]) -> Optional[GenerationTiming]:
+    """Desglose de la generación de la petición; ``None`` si se sirvió de la caché, del nodo central o de otra."""
+    return GenerationTiming.from_ollama(model, final) if final.get("done") else None
 
-def _save_chat_message(db: Session, user_id: int, prompt: str, response: str) -> None:
-    """Guarda un mensaje de chat en la base de datos."""
-    chat = ChatMessage(user_id=user_id, prompt=prompt, response=response, created_at=datetime.utcnow())
-    db.add(chat)
-    db.commit()
+
+def _save_chat_message(
+    db: Optional[Session],
+    user_id: int,
+    prompt: str,
+    response: str,
+    conversation_id: Optional[int] = None,
+    timing: Optional[GenerationTiming] = None,
+    status: Optional[str] = None,
+) -> None:
+    """Guarda un mensaje de chat mediante la cola de escritura diferida (fuera de la ruta de la petición)."""
+    chat_writer.submit(
+        user_id, prompt, response, conversation_id, db=db, timing=timing.columns() if timing else None, status=status
+    )
 
 
 def get_chat_history(db: Session, user: User, limit: int = 20):
     return (
         db.query(ChatMessage)
-        .filter(ChatMessage.user_id == user.id)
+        .filter(ChatMessage.user_id == user.id, ChatMessage.status.is_distinct_from(MESSAGE_ABORTED))
         .order_by(ChatMessage.created_at.desc())
         .limit(limit)
         .all()
@@ -0,0 +1,133 @@
+"""Coalescencia de peticiones idénticas en vuelo (single-flight) para el chat.
+
+Cuando varias peticiones con la misma clave (prompt, modelo, opciones) llegan a la
+vez, solo la primera lanza la generación; el resto espera el mismo resultado.
+En streaming, todos los suscriptores reciben el mismo flujo de tokens desde el
+principio, aunque se unan tarde.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class _Flight:
+    def __init__(self, task: "asyncio.Future[Any]"):
+        self.task = task
+        self.waiters = 0
+
+
+class _StreamFlight:
+    """Generación en streaming compartida: un productor y N suscriptores."""
+
+    def __init__(self, source_factory: Callable[[], AsyncIterator[T]]):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(source_factory))
+
+    async def _pump(self, source_factory: Callable[[], AsyncIterator[T]]) -> None:
+        try:
+            async for chunk in source_factory():
+                self.chunks.append(chunk)
+                self._notify()
+        except BaseException as e:  # incluye CancelledError: los suscriptores deben enterarse
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                if position < len(self.chunks):
+                    position += 1
+                    yield self.chunks[position - 1]
+                    continue
+                if self.done:
+                    if isinstance(self.error, asyncio.CancelledError):
+                        raise RuntimeError("La generación compartida fue cancelada")
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.task.done():
+                # Nadie escucha ya: abortar la generación libera el modelo
+                self.task.cancel()
+
+
+class SheilyChatSingleFlight:
+    """Registro de generaciones en vuelo indexadas por clave de petición."""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Ejecuta ``fn`` una sola vez por clave mientras haya peticiones esperando.
+
+        La generación corre en su propia tarea: si un llamante se cancela, el resto
+        sigue esperando; solo se cancela cuando no queda ninguno.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _task: self._forget(self._flights, key, flight))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    async def stream(self, key: str, source_factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """Suscribe al flujo en vuelo de ``key`` o lo inicia con ``source_factory``."""
+        flight = self._streams.get(key)
+        if flight is None or flight.done:
+            flight = _StreamFlight(source_factory)
+            self._streams[key] = flight
+            flight.task.add_done_callback(lambda _task: self._forget(self._streams, key, flight))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        async for chunk in flight.subscribe():
+            yield chunk
+
+    @staticmethod
+    def _forget(registry: Dict[str, Any], key: str, flight: Any) -> None:
+        if registry.get(key) is flight:
+            del registry[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._flights) + len(self._streams),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+# Instancia global de coalescencia del chat
+inflight_requests = SheilyChatSingleFlight()
@@ -1,8 +1,9 @@
 from typing import Dict, Union
-from sheily_modules.sheily_model_inference.ollama_client import OllamaClient
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_ai_health_monitor import invalidate_models_cache
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import get_ollama_client
 
 
-def download_model(model_name: str) -> Dict[str, str]:
+async def download_model(model_name: str) -> Dict[str, str]:
     """Descarga un modelo de Ollama.
 
     Args:
@@ -12,15 +13,11 @@ def download_model(model_name: str) -> Dict[str, str]:
         Dict[str, str]: Diccionario con el estado de la operación o un mensaje de error
     """
     try:
-        with OllamaClient() as client:
-            # Usar el cliente para hacer la solicitud de descarga
-            response = client._client.post(
-                "/api/pull",
-                json={"name": model_name},
-                timeout=600
-            )
-            response.raise_for_status()
-            return {"status": "downloaded", "model": model_name}
+        # Usar el cliente compartido para hacer la solicitud de descarga
+        await get_ollama_client().pull(model_name, timeout=600)
+        # El modelo nuevo debe aparecer ya en la lista cacheada
+        invalidate_models_cache()
+        return {"status": "downloaded", "model": model_name}
     except Exception as e:
         error_msg = f"Error al descargar el modelo {model_name}: {str(e)}"
         print(error_msg)  # Para depuración
@@ -0,0 +1,327 @@
+"""Canal WebSocket del chat: varias generaciones multiplexadas en una conexión.
+
+El cliente se autentica una sola vez al abrir el socket, con el mismo JWT que el
+resto de la API (``/api/chat/ws?token=...`` o un primer mensaje
+``{"type": "auth", "token": "..."}``). El usuario se busca en la base de datos al
+conectar y no en cada mensaje; cuando vence el ``exp`` del token el servidor cierra
+el socket con 4401 y el cliente debe reconectar con uno nuevo.
+
+Mensajes del cliente (JSON):
+
+- ``{"type": "chat", "id": "a1", "prompt": "...", "conversation_id": 3, "priority": "interactive",
+  "slo_ms": 800}``: inicia una generación; ``id`` la identifica en el resto de mensajes.
+- ``{"type": "stop", "id": "a1"}``: cancela la generación; se guarda como abortada.
+- ``{"type": "ping"}`` y ``{"type": "pong"}``: latido.
+
+Mensajes del servidor: ``ready``, ``token`` (``id``, ``token``), ``done`` (``id``,
+``answer``), ``stopped`` (``id``), ``error`` (``id``, ``status``, ``detail`` y, con
+503, ``retry_after``), ``ping`` y ``pong``.
+
+Los tokens de varias generaciones se intercalan en la misma conexión. El servidor
+envía ``ping`` cada ``SHEILY_CHAT_WS_HEARTBEAT_SECONDS`` y cierra el socket tras
+``SHEILY_CHAT_WS_IDLE_SECONDS`` sin mensajes en ninguno de los dos sentidos (los
+latidos no cuentan) ni generaciones en curso: quien solo escucha tokens no está
+inactivo. Al cerrarse se cancelan las generaciones pendientes, igual que al
+desconectarse un cliente SSE.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Literal, Optional, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy.orm import Session
+
+from sheily_light_api.core import database
+from sheily_light_api.models import User
+from sheily_light_api.sheily_modules.sheily_auth_module.sheily_jwt_manager import token_expiry, verify_token
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_conversation import ConversationNotFound
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_service import stream_chat_with_local_ai
+from sheily_light_api.sheily_modules.sheily_model_inference.inference_scheduler import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    InferenceQueueFull,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_backend_pool import OllamaUnavailable
+
+logger = logging.getLogger("sheily_chat_websocket")
+
+CHAT_WS_HEARTBEAT_SECONDS = float(os.getenv("SHEILY_CHAT_WS_HEARTBEAT_SECONDS", "20"))
+CHAT_WS_IDLE_SECONDS = float(os.getenv("SHEILY_CHAT_WS_IDLE_SECONDS", "60"))
+# Plazo para el mensaje ``auth`` cuando el token no viene en la URL
+CHAT_WS_AUTH_SECONDS = float(os.getenv("SHEILY_CHAT_WS_AUTH_SECONDS", "10"))
+CHAT_WS_MAX_STREAMS = int(os.getenv("SHEILY_CHAT_WS_MAX_STREAMS", "4"))
+
+# Códigos de cierre propios (rango 4000-4999 de RFC 6455)
+WS_CLOSE_UNAUTHORIZED = 4401
+WS_CLOSE_IDLE = 4408
+
+_PRIORITIES = {"interactive": PRIORITY_INTERACTIVE, "batch": PRIORITY_BATCH}
+
+
+class ChatFrame(BaseModel):
+    """Mensaje ``chat`` del cliente."""
+
+    id: str = Field(..., min_length=1, max_length=64)
+    prompt: str
+    conversation_id: Optional[int] = None
+    priority: Literal["interactive", "batch"] = "interactive"
+    slo_ms: Optional[float] = Field(None, gt=0)
+
+
+def authenticate(token: Optional[str], session_factory: Optional[Callable[[], Session]] = None) -> Optional[User]:
+    """Usuario del JWT, o ``None`` si el token no es válido o el usuario no existe."""
+    username = verify_token(token) if token else None
+    if not username:
+        return None
+    db = (session_factory or database.SessionLocal)()
+    try:
+        return db.query(User).filter(User.username == username).first()
+    finally:
+        db.close()
+
+
+def _error(frame_id: Optional[str], status: int, detail: Any, **extra: Any) -> Dict[str, Any]:
+    return {"type": "error", "id": frame_id, "status": status, "detail": detail, **extra}
+
+
+class _ChatConnection:
+    """Una conexión autenticada y sus generaciones en curso, indexadas por ``id``."""
+
+    def __init__(
+        self, sockets: "SheilyChatSockets", websocket: WebSocket, user: User, expires_at: Optional[float] = None
+    ):
+        self.sockets = sockets
+        self.websocket = websocket
+        self.user = user
+        # ``exp`` del JWT (epoch): la autenticación única vale hasta entonces
+        self.expires_at = expires_at
+        self.streams: Dict[str, asyncio.Task] = {}
+        # Varias generaciones escriben en el mismo socket
+        self._send_lock = asyncio.Lock()
+        self._last_activity = asyncio.get_running_loop().time()
+
+    async def send(self, frame: Dict[str, Any]) -> None:
+        async with self._send_lock:
+            await self.websocket.send_json(frame)
+        if frame["type"] != "ping":
+            self._last_activity = asyncio.get_running_loop().time()
+
+    async def run(self) -> None:
+        heartbeat = asyncio.ensure_future(self._heartbeat())
+        try:
+            while True:
+                try:
+                    text = await asyncio.wait_for(
+                        self.websocket.receive_text(), timeout=min(self._idle_left(), self._auth_left())
+                    )
+                except asyncio.TimeoutError:
+                    if self._auth_left() <= 0:
+                        await self._close_expired()
+                        return
+                    if self._idle_left() > 0:
+                        continue
+                    logger.info(f"Closing idle chat socket of user {self.user.id}")
+                    await self.websocket.close(code=WS_CLOSE_IDLE)
+                    return
+                if self._auth_left() <= 0:
+                    await self._close_expired()
+                    return
+                self._last_activity = asyncio.get_running_loop().time()
+                try:
+                    frame = json.loads(text)
+                except ValueError:
+                    await self.send(_error(None, 400, "Invalid JSON frame"))
+                    continue
+                await self._handle(frame if isinstance(frame, dict) else {})
+        except WebSocketDisconnect:
+            pass
+        finally:
+            heartbeat.cancel()
+            # Sin cliente no hay a quién entregar: abortar libera el modelo
+            pending = list(self.streams.values())
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    def _idle_left(self) -> float:
+        """Segundos hasta cerrar por inactividad; con generaciones en curso el plazo vuelve a empezar."""
+        if self.streams:
+            return self.sockets.idle_seconds
+        return self.sockets.idle_seconds - (asyncio.get_running_loop().time() - self._last_activity)
+
+    def _auth_left(self) -> float:
+        """Segundos hasta que caduca el JWT de la conexión (un token sin ``exp`` no caduca)."""
+        if self.expires_at is None:
+            return self.sockets.idle_seconds
+        return self.expires_at - time.time()
+
+    async def _close_expired(self) -> None:
+        logger.info(f"Closing chat socket of user {self.user.id}: token expired")
+        await self.websocket.close(code=WS_CLOSE_UNAUTHORIZED)
+
+    async def _handle(self, frame: Dict[str, Any]) -> None:
+        kind = frame.get("type")
+        if kind == "chat":
+            await self._start(frame)
+        elif kind == "stop":
+            await self._stop(frame.get("id"))
+        elif kind == "ping":
+            await self.send({"type": "pong"})
+        elif kind != "pong":
+            await self.send(_error(frame.get("id"), 400, f"Unknown frame type: {kind}"))
+
+    async def _start(self, frame: Dict[str, Any]) -> None:
+        try:
+            chat = ChatFrame(**{key: value for key, value in frame.items() if key != "type"})
+        except ValidationError as e:
+            await self.send(_error(frame.get("id"), 422, e.errors(include_url=False, include_context=False)))
+            return
+        if chat.id in self.streams:
+            await self.send(_error(chat.id, 409, "Generation id already in use"))
+            return
+        if len(self.streams) >= self.sockets.max_streams:
+            await self.send(_error(chat.id, 429, f"At most {self.sockets.max_streams} generations per connection"))
+            return
+        self.sockets.generations += 1
+        task = asyncio.ensure_future(self._generate(chat))
+        task.add_done_callback(lambda done: self._finished(chat.id, done))
+        self.streams[chat.id] = task
+
+    def _finished(self, frame_id: str, task: asyncio.Task) -> None:
+        # Tras salir de ``streams`` nadie espera la tarea: su excepción (p. ej. un envío a un socket
+        # ya cerrado) se recoge aquí en lugar de acabar en "Task exception was never retrieved"
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                f"Chat socket generation {frame_id} of user {self.user.id} could not reach the client: "
+                f"{task.exception()!r}"
+            )
+
+    async def _stop(self, frame_id: Optional[str]) -> None:
+        task = self.streams.get(frame_id)
+        if task is None:
+            await self.send(_error(frame_id, 404, "Unknown generation id"))
+            return
+        if task.done():
+            # Ya terminó: el cliente recibe (o ya recibió) ``done`` o ``error`` en lugar de ``stopped``
+            return
+        task.cancel()
+        # Esperar a que la cancelación llegue a Ollama: después de ``stopped`` no llegan más tokens
+        await asyncio.wait({task})
+        if not task.cancelled():
+            return
+        self.sockets.stopped += 1
+        await self.send({"type": "stopped", "id": frame_id})
+
+    async def _generate(self, chat: ChatFrame) -> None:
+        parts = []
+        try:
+            async for token in stream_chat_with_local_ai(
+                self.user, chat.prompt, _PRIORITIES[chat.priority], chat.conversation_id, chat.slo_ms
+            ):
+                parts.append(token)
+                await self.send({"type": "token", "id": chat.id, "token": token})
+        except (InferenceQueueFull, OllamaUnavailable) as e:
+            await self.send(_error(chat.id, 503, str(e), retry_after=e.retry_after))
+            return
+        except ConversationNotFound:
+            await self.send(_error(chat.id, 404, "Conversation not found"))
+            return
+        except RuntimeError as e:
+            await self.send(_error(chat.id, 500, str(e)))
+            return
+        except Exception as e:
+            # Sin ``error`` el cliente esperaría para siempre el ``done`` de esta generación
+            logger.error(f"Chat socket generation {chat.id} of user {self.user.id} failed: {str(e)}")
+            await self.send(_error(chat.id, 500, "Generation failed"))
+            return
+        finally:
+            self.streams.pop(chat.id, None)
+        await self.send({"type": "done", "id": chat.id, "answer": "".join(parts).strip()})
+
+    async def _heartbeat(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.sockets.heartbeat_seconds)
+                await self.send({"type": "ping"})
+        except Exception:
+            # El socket se cerró: el bucle de lectura se entera por su lado
+            return
+
+
+class SheilyChatSockets:
+    """Atiende las conexiones WebSocket del chat y lleva sus contadores."""
+
+    def __init__(
+        self,
+        heartbeat_seconds: float = CHAT_WS_HEARTBEAT_SECONDS,
+        idle_seconds: float = CHAT_WS_IDLE_SECONDS,
+        auth_seconds: float = CHAT_WS_AUTH_SECONDS,
+        max_streams: int = CHAT_WS_MAX_STREAMS,
+        session_factory: Optional[Callable[[], Session]] = None,
+    ):
+        self.heartbeat_seconds = heartbeat_seconds
+        self.idle_seconds = idle_seconds
+        self.auth_seconds = auth_seconds
+        self.max_streams = max_streams
+        self._session_factory = session_factory
+        self.open = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.generations = 0
+        self.stopped = 0
+
+    async def serve(self, websocket: WebSocket) -> None:
+        """Autentica la conexión y atiende sus mensajes hasta que se cierre."""
+        await websocket.accept()
+        try:
+            user, expires_at = await self._authenticate(websocket)
+            if user is None:
+                self.rejected += 1
+                await websocket.close(code=WS_CLOSE_UNAUTHORIZED)
+                return
+            await websocket.send_json(
+                {"type": "ready", "heartbeat_seconds": self.heartbeat_seconds, "max_streams": self.max_streams}
+            )
+        except WebSocketDisconnect:
+            return
+
+        self.accepted += 1
+        self.open += 1
+        try:
+            await _ChatConnection(self, websocket, user, expires_at).run()
+        finally:
+            self.open -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "open": self.open,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "generations": self.generations,
+            "stopped": self.stopped,
+        }
+
+    async def _authenticate(self, websocket: WebSocket) -> Tuple[Optional[User], Optional[float]]:
+        """Usuario del JWT y su caducidad (epoch)."""
+        token = websocket.query_params.get("token")
+        if token is None:
+            try:
+                frame = json.loads(await asyncio.wait_for(websocket.receive_text(), timeout=self.auth_seconds))
+            except (asyncio.TimeoutError, ValueError):
+                return None, None
+            if isinstance(frame, dict) and frame.get("type") == "auth":
+                token = frame.get("token")
+        user = authenticate(token, self._session_factory)
+        return user, token_expiry(token) if user is not None else None
+
+
+# Instancia global del canal WebSocket del chat
+chat_sockets = SheilyChatSockets()
@@ -0,0 +1,98 @@
+"""Circuit breaker para los backends de inferencia.
+
+- ``closed``: las peticiones pasan; ``failure_threshold`` fallos seguidos lo abren.
+- ``open``: las peticiones se rechazan al instante durante ``reset_timeout`` segundos.
+- ``half_open``: pasado ese tiempo se deja pasar una única petición de prueba; si
+  funciona el circuito se cierra y si falla vuelve a abrirse con el doble de espera
+  (hasta ``max_reset_timeout``).
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Any, Callable, Dict
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+        max_reset_timeout: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._clock = clock
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.consecutive_failures = 0
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def can_attempt(self) -> bool:
+        """Indica si se admitiría una petición ahora, sin reservarla."""
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and not self._trial_in_flight)
+
+    def on_attempt(self) -> None:
+        """Registra el inicio de una petición; en ``half_open`` reserva la prueba."""
+        if self.state == HALF_OPEN:
+            self._state = HALF_OPEN
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        self._state = CLOSED
+        self._trial_in_flight = False
+        self.consecutive_failures = 0
+        self.reset_timeout = self.base_reset_timeout
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self._state == HALF_OPEN:
+            # Falló la prueba: reabrir con más espera
+            self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            self._open()
+        elif self._state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._open()
+
+    def trip(self) -> None:
+        """Abre el circuito de inmediato (p. ej. si falla un sondeo activo)."""
+        if self.state != OPEN:
+            self._open()
+
+    def release_trial(self) -> None:
+        """Libera la prueba de ``half_open`` sin veredicto (petición cancelada o error del cliente)."""
+        self._trial_in_flight = False
+
+    def retry_after(self) -> float:
+        """Segundos hasta que el circuito admita una petición de prueba."""
+        if self._state != OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (self._clock() - self._opened_at))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opens": self.opens,
+            "reset_timeout_s": self.reset_timeout,
+        }
+
+    def _open(self) -> None:
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._trial_in_flight = False
+        self.opens += 1
@@ -0,0 +1,247 @@
+"""Embeddings por lotes con caché por contenido.
+
+``SheilyEmbeddingService.embed_many`` recibe una lista de textos, descarta los
+repetidos, busca cada uno en una caché SQLite indexada por el hash del modelo y el
+texto, y solo pide a Ollama los que faltan. Los pendientes se envían en lotes al
+endpoint multi-entrada ``/api/embed``; si el servidor es anterior y no lo tiene
+(404), se recurre a ``/api/embeddings`` texto a texto. En ambos casos las peticiones
+van en paralelo con un límite de concurrencia común a todos los llamantes.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import httpx
+import numpy as np
+
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import get_ollama_client
+
+logger = logging.getLogger("sheily_embeddings")
+
+EMBED_MODEL = os.getenv("SHEILY_EMBED_MODEL", "nomic-embed-text")
+EMBED_CACHE_ENABLED = os.getenv("SHEILY_EMBED_CACHE_ENABLED", "true").lower() == "true"
+EMBED_CACHE_PATH = os.getenv(
+    "SHEILY_EMBED_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".sheily", "cache", "embeddings.sqlite")
+)
+# Textos por petición a /api/embed
+EMBED_BATCH_SIZE = int(os.getenv("SHEILY_EMBED_BATCH_SIZE", "64"))
+# Peticiones de embeddings simultáneas contra Ollama
+EMBED_CONCURRENCY = int(os.getenv("SHEILY_EMBED_CONCURRENCY", "4"))
+
+# Parámetros por consulta SQL (SQLite admite 999 en versiones antiguas)
+_SQL_CHUNK = 500
+
+
+def embedding_key(model: str, text: str) -> str:
+    """Clave de caché: hash del modelo y del contenido exacto del texto."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class SheilyEmbeddingService:
+    """Embeddings de Ollama con deduplicación, caché en disco y peticiones por lotes."""
+
+    def __init__(
+        self,
+        model: str = EMBED_MODEL,
+        cache_path: str = EMBED_CACHE_PATH,
+        batch_size: int = EMBED_BATCH_SIZE,
+        concurrency: int = EMBED_CONCURRENCY,
+        cache_enabled: bool = EMBED_CACHE_ENABLED,
+    ):
+        self.model = model
+        self.cache_path = Path(cache_path)
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.cache_enabled = cache_enabled
+
+        self._db: Optional[sqlite3.Connection] = None
+        # Las consultas a la caché se ejecutan en hilos del executor
+        self._db_lock = threading.Lock()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+        # None hasta saber si el servidor tiene /api/embed
+        self._multi_input: Optional[bool] = None
+
+        self.requests = 0
+        self.texts = 0
+        self.duplicates = 0
+        self.cache_hits = 0
+        self.embedded = 0
+        self.batches = 0
+        self.single_requests = 0
+        self.errors = 0
+
+    # ------------------------------------------------------------------
+    # API pública
+    # ------------------------------------------------------------------
+
+    async def embed(self, text: str, model: Optional[str] = None) -> np.ndarray:
+        """Embedding de un solo texto (pasa por la misma caché que ``embed_many``)."""
+        return (await self.embed_many([text], model))[0]
+
+    async def embed_many(self, texts: Sequence[str], model: Optional[str] = None) -> List[np.ndarray]:
+        """
+        Embeddings de ``texts`` en el mismo orden, como vectores ``float32``.
+
+        Los lotes que se completan se guardan en la caché aunque otro falle, así que
+        repetir una indexación interrumpida solo pide lo que faltaba.
+
+        Raises:
+            httpx.HTTPError: Si Ollama no responde o devuelve un error
+            ValueError: Si Ollama devuelve un número de embeddings distinto del pedido
+        """
+        model = model or self.model
+        self.requests += 1
+        self.texts += len(texts)
+        keys = [embedding_key(model, text) for text in texts]
+        unique: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            unique.setdefault(key, text)
+        self.duplicates += len(texts) - len(unique)
+
+        found = await asyncio.to_thread(self._cache_get, list(unique)) if unique else {}
+        self.cache_hits += len(found)
+        missing = [(key, text) for key, text in unique.items() if key not in found]
+        if missing:
+            batches = [missing[i : i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+            results = await asyncio.gather(
+                *(self._embed_batch(model, [text for _, text in batch]) for batch in batches), return_exceptions=True
+            )
+            fresh: Dict[str, np.ndarray] = {}
+            error: Optional[BaseException] = None
+            for batch, vectors in zip(batches, results):
+                if isinstance(vectors, BaseException):
+                    error = error or vectors
+                    continue
+                fresh.update((key, vector) for (key, _), vector in zip(batch, vectors))
+            self.embedded += len(fresh)
+            if fresh:
+                await asyncio.to_thread(self._cache_put, fresh)
+            if error is not None:
+                self.errors += 1
+                raise error
+            found.update(fresh)
+        return [found[key] for key in keys]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.cache_hits + self.embedded
+        return {
+            "model": self.model,
+            "cache_enabled": self.cache_enabled,
+            "multi_input": self._multi_input,
+            "requests": self.requests,
+            "texts": self.texts,
+            "duplicates": self.duplicates,
+            "cache_hits": self.cache_hits,
+            "embedded": self.embedded,
+            "batches": self.batches,
+            "single_requests": self.single_requests,
+            "errors": self.errors,
+            "hit_ratio": self.cache_hits / lookups if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # ------------------------------------------------------------------
+    # Peticiones a Ollama
+    # ------------------------------------------------------------------
+
+    async def _embed_batch(self, model: str, texts: List[str]) -> List[np.ndarray]:
+        if self._multi_input is not False:
+            try:
+                async with self._limiter():
+                    vectors = await get_ollama_client().embed_batch(model, texts)
+            except httpx.HTTPStatusError as e:
+                # 404 en un servidor que ya aceptó /api/embed es un modelo inexistente
+                if e.response.status_code != 404 or self._multi_input:
+                    raise
+            else:
+                self._multi_input = True
+                self.batches += 1
+                return _as_vectors(vectors, len(texts))
+
+        vectors = await asyncio.gather(*(self._embed_one(model, text) for text in texts))
+        if self._multi_input is None:
+            logger.info("Ollama server has no /api/embed, falling back to one request per text")
+            self._multi_input = False
+        return vectors
+
+    async def _embed_one(self, model: str, text: str) -> np.ndarray:
+        async with self._limiter():
+            vector = await get_ollama_client().embed(model, text)
+        self.single_requests += 1
+        return _as_vectors([vector], 1)[0]
+
+    def _limiter(self) -> asyncio.Semaphore:
+        # El semáforo pertenece al bucle de eventos en el que se creó
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    # ------------------------------------------------------------------
+    # Caché en disco
+    # ------------------------------------------------------------------
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self._db is None and self.cache_enabled:
+            try:
+                self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+                db = sqlite3.connect(str(self.cache_path), check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+                self._db = db
+            except Exception as e:
+                logger.error(f"Failed to open embedding cache, continuing without it: {str(e)}")
+                self.cache_enabled = False
+        return self._db
+
+    def _cache_get(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        with self._db_lock:
+            db = self._connect()
+            if db is None:
+                return found
+            for i in range(0, len(keys), _SQL_CHUNK):
+                chunk = keys[i : i + _SQL_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for key, blob in db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk):
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def _cache_put(self, vectors: Dict[str, np.ndarray]) -> None:
+        with self._db_lock:
+            db = self._connect()
+            if db is None:
+                return
+            try:
+                with db:
+                    db.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                        ((key, vector.tobytes()) for key, vector in vectors.items()),
+                    )
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to store embeddings in cache: {str(e)}")
+
+
+def _as_vectors(vectors: Sequence[Sequence[float]], expected: int) -> List[np.ndarray]:
+    if len(vectors) != expected or any(not len(vector) for vector in vectors):
+        raise ValueError(f"Ollama devolvió {len(vectors)} embeddings para {expected} textos")
+    return [np.asarray(vector, dtype=np.float32) for vector in vectors]
+
+
+# Instancia global del servicio de embeddings
+embedding_service = SheilyEmbeddingService()
@@ -0,0 +1,171 @@
+"""Opciones de generación de Ollama (``options`` de ``/api/generate``) por modelo.
+
+Se combinan, de menor a mayor prioridad:
+
+1. El perfil del nodo: las claves de ``ollama-config.json`` que tienen equivalente en
+   Ollama (``num_ctx``, ``num_thread``, ``batch_size`` -> ``num_batch``, ``temp`` ->
+   ``temperature``...). Las de llama.cpp sin equivalente se ignoran.
+2. El perfil medido en el nodo por ``ollama_tuner`` para el modelo, si existe.
+3. El perfil del modelo: ``model_options`` de ``ollama-config.json``, ya con los
+   nombres de Ollama.
+4. La configuración del usuario (sección ``ai``): ``temperature``, ``max_tokens`` ->
+   ``num_predict`` y ``context_window`` -> ``num_ctx``.
+
+El ``num_ctx`` medido es además un techo: es la ventana mayor que el hardware sirve
+sin perder rendimiento, y la que pida el usuario se recorta a ella.
+
+El resultado se compila una vez por modelo y se reutiliza mientras no cambie la
+configuración del usuario. Las mismas opciones se envían en la precarga y en cada
+petición: si ``num_ctx`` o ``num_batch`` cambiaran entre peticiones, Ollama tendría
+que recargar el modelo.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+from sheily_light_api.sheily_modules.sheily_config_module.sheily_user_config_manager import config_manager
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_config import get_tuned_profile, load_ollama_config
+
+logger = logging.getLogger("sheily_generation_options")
+
+# Clave de ollama-config.json -> (opción de Ollama, tipo)
+NODE_OPTION_KEYS: Dict[str, Tuple[str, type]] = {
+    "num_ctx": ("num_ctx", int),
+    "num_thread": ("num_thread", int),
+    "batch_size": ("num_batch", int),
+    "n_gpu_layers": ("num_gpu", int),
+    "main_gpu": ("main_gpu", int),
+    "use_mlock": ("use_mlock", bool),
+    "mmap": ("use_mmap", bool),
+    "n_predict": ("num_predict", int),
+    "temp": ("temperature", float),
+    "top_k": ("top_k", int),
+    "top_p": ("top_p", float),
+    "repeat_penalty": ("repeat_penalty", float),
+    "typical_p": ("typical_p", float),
+    "seed": ("seed", int),
+}
+# Clave de la sección ``ai`` del usuario -> opción de Ollama
+USER_OPTION_KEYS: Dict[str, str] = {
+    "temperature": "temperature",
+    "max_tokens": "num_predict",
+    "context_window": "num_ctx",
+}
+# Tipos de las opciones de Ollama conocidas, para validar los perfiles por modelo
+OPTION_TYPES: Dict[str, type] = {option: kind for option, kind in NODE_OPTION_KEYS.values()}
+
+
+def options_fingerprint(options: Mapping[str, Any]) -> str:
+    """Huella corta de unas opciones, para separar cachés de respuestas generadas con opciones distintas."""
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def _coerce(option: str, value: Any) -> Any:
+    """Valor convertido al tipo de la opción, o ``None`` si no es válido."""
+    kind = OPTION_TYPES.get(option)
+    if kind is None:
+        return value
+    if kind is bool:
+        return value if isinstance(value, bool) else None
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SheilyGenerationOptions:
+    """Compila y guarda en caché las ``options`` de Ollama de cada modelo."""
+
+    def __init__(
+        self,
+        config: Optional[Dict[str, Any]] = None,
+        user_config: Optional[Callable[[], Dict[str, Any]]] = None,
+        tuned: Optional[Callable[[str], Dict[str, Any]]] = None,
+    ):
+        self._config = config
+        self._tuned = tuned or get_tuned_profile
+        self._user_config = user_config or (lambda: config_manager.get_config("ai") or {})
+        self._node: Optional[Dict[str, Any]] = None
+        self._compiled: Dict[Tuple[str, Tuple[Any, ...]], Dict[str, Any]] = {}
+        self.compilations = 0
+        self.lookups = 0
+
+    @property
+    def config(self) -> Dict[str, Any]:
+        return self._config if self._config is not None else load_ollama_config()
+
+    def for_model(self, model: str) -> Dict[str, Any]:
+        """
+        ``options`` para una petición a ``model``.
+
+        El diccionario devuelto se comparte entre peticiones: no debe modificarse.
+        """
+        self.lookups += 1
+        user = self._user_config()
+        overrides = tuple(user.get(key) for key in USER_OPTION_KEYS)
+        options = self._compiled.get((model, overrides))
+        if options is None:
+            options = self._compile(model, dict(zip(USER_OPTION_KEYS, overrides)))
+            # Solo se guarda la compilación vigente de cada modelo
+            self._compiled = {key: value for key, value in self._compiled.items() if key[0] != model}
+            self._compiled[(model, overrides)] = options
+        return options
+
+    def invalidate(self) -> None:
+        """Descarta lo compilado (tras cambiar ``ollama-config.json``)."""
+        self._node = None
+        self._compiled.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "compilations": self.compilations,
+            "lookups": self.lookups,
+            "models": {model: options for (model, _), options in self._compiled.items()},
+        }
+
+    def _node_options(self) -> Dict[str, Any]:
+        if self._node is None:
+            self._node = {}
+            for key, (option, _) in NODE_OPTION_KEYS.items():
+                value = _coerce(option, self.config.get(key))
+                if value is not None:
+                    self._node[option] = value
+            if self._node.get("seed", 0) < 0:
+                # Semilla aleatoria: es lo que hace Ollama si no se indica
+                del self._node["seed"]
+        return self._node
+
+    def _compile(self, model: str, user: Dict[str, Any]) -> Dict[str, Any]:
+        self.compilations += 1
+        options = dict(self._node_options())
+        tuned = dict(self._tuned(model).get("options") or {})
+        for option, value in tuned.items():
+            self._set(options, option, value, f"tuned.{model}")
+        for option, value in (self.config.get("model_options") or {}).get(model, {}).items():
+            self._set(options, option, value, f"model_options.{model}")
+        for key, option in USER_OPTION_KEYS.items():
+            if user.get(key) is not None:
+                self._set(options, option, user[key], f"ai.{key}")
+        tuned_ctx = _coerce("num_ctx", tuned.get("num_ctx"))
+        if tuned_ctx and options.get("num_ctx", 0) > tuned_ctx:
+            options["num_ctx"] = tuned_ctx
+        if options.get("num_predict", -1) <= 0:
+            # 0 o negativo es "sin límite" para Ollama
+            options.pop("num_predict", None)
+        return options
+
+    @staticmethod
+    def _set(options: Dict[str, Any], option: str, value: Any, source: str) -> None:
+        coerced = _coerce(option, value)
+        if coerced is None:
+            logger.warning(f"Ignoring invalid generation option {source}={value!r}")
+        else:
+            options[option] = coerced
+
+
+# Instancia global de las opciones de generación
+generation_options = SheilyGenerationOptions()
@@ -0,0 +1,182 @@
+"""Desglose de la latencia de cada generación a partir de los tiempos que devuelve Ollama.
+
+El JSON final de ``/api/generate`` trae ``total_duration``, ``load_duration``,
+``prompt_eval_count``, ``prompt_eval_duration``, ``eval_count`` y ``eval_duration``
+(en nanosegundos). ``GenerationTiming`` los pasa a milisegundos y deriva:
+
+- TTFT (tiempo hasta el primer token): carga del modelo + evaluación del prompt.
+- Tokens/s de la generación (``eval_count / eval_duration``).
+
+Cada generación se guarda con su ``ChatMessage`` y se acumula en histogramas por
+modelo, de modo que se puede distinguir si la lentitud viene de cargar el modelo,
+de prompts largos o de la velocidad de decodificación.
+"""
+
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass, fields
+from itertools import accumulate
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+_NS_PER_MS = 1_000_000
+
+# Límites superiores de los intervalos de cada histograma
+TTFT_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+TOKENS_PER_SEC_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150)
+LOAD_BUCKETS_MS = (10, 100, 500, 1000, 2500, 5000, 10000, 30000)
+PROMPT_EVAL_BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+@dataclass(frozen=True)
+class GenerationTiming:
+    """Tiempos de una generación de Ollama, en milisegundos."""
+
+    model: str
+    total_ms: float = 0.0
+    load_ms: float = 0.0
+    prompt_eval_count: int = 0
+    prompt_eval_ms: float = 0.0
+    eval_count: int = 0
+    eval_ms: float = 0.0
+
+    @classmethod
+    def from_ollama(cls, model: str, result: Mapping[str, Any]) -> "GenerationTiming":
+        """Construye el desglose a partir del JSON final de ``/api/generate``."""
+        return cls(
+            model=model,
+            total_ms=result.get("total_duration", 0) / _NS_PER_MS,
+            load_ms=result.get("load_duration", 0) / _NS_PER_MS,
+            prompt_eval_count=result.get("prompt_eval_count", 0),
+            prompt_eval_ms=result.get("prompt_eval_duration", 0) / _NS_PER_MS,
+            eval_count=result.get("eval_count", 0),
+            eval_ms=result.get("eval_duration", 0) / _NS_PER_MS,
+        )
+
+    @classmethod
+    def from_row(cls, row: Any) -> "GenerationTiming":
+        """Reconstruye el desglose guardado en un ``ChatMessage``."""
+        return cls(**{name: getattr(row, name) or 0 for name in TIMING_COLUMNS})
+
+    @property
+    def ttft_ms(self) -> float:
+        return self.load_ms + self.prompt_eval_ms
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return self.eval_count / (self.eval_ms / 1000) if self.eval_ms else 0.0
+
+    def columns(self) -> Dict[str, Any]:
+        """Valores de las columnas de ``ChatMessage``."""
+        return asdict(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**self.columns(), "ttft_ms": self.ttft_ms, "tokens_per_sec": self.tokens_per_sec}
+
+
+# Columnas de ``ChatMessage`` con el desglose
+TIMING_COLUMNS = tuple(f.name for f in fields(GenerationTiming))
+
+
+class Histogram:
+    """Histograma de intervalos fijos con cuantiles interpolados dentro de cada intervalo."""
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds: List[float] = sorted(bounds)
+        self.counts: List[int] = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        index = next((i for i, bound in enumerate(self.bounds) if value <= bound), len(self.bounds))
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction: float) -> float:
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        labels = [str(bound) for bound in self.bounds] + ["+Inf"]
+        return {
+            "count": self.count,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+            # Recuento acumulado por límite superior, como los histogramas de Prometheus
+            "buckets": dict(zip(labels, accumulate(self.counts))),
+        }
+
+
+class _ModelTimings:
+    def __init__(self):
+        self.ttft_ms = Histogram(TTFT_BUCKETS_MS)
+        self.tokens_per_sec = Histogram(TOKENS_PER_SEC_BUCKETS)
+        self.load_ms = Histogram(LOAD_BUCKETS_MS)
+        self.prompt_eval_ms = Histogram(PROMPT_EVAL_BUCKETS_MS)
+        self.load_total = 0.0
+        self.prompt_eval_total = 0.0
+        self.eval_total = 0.0
+
+    def add(self, timing: GenerationTiming) -> None:
+        self.ttft_ms.add(timing.ttft_ms)
+        self.load_ms.add(timing.load_ms)
+        self.prompt_eval_ms.add(timing.prompt_eval_ms)
+        if timing.eval_ms:
+            self.tokens_per_sec.add(timing.tokens_per_sec)
+        self.load_total += timing.load_ms
+        self.prompt_eval_total += timing.prompt_eval_ms
+        self.eval_total += timing.eval_ms
+
+    def summary(self) -> Dict[str, Any]:
+        spent = self.load_total + self.prompt_eval_total + self.eval_total
+        return {
+            "generations": self.ttft_ms.count,
+            "ttft_ms": self.ttft_ms.summary(),
+            "tokens_per_sec": self.tokens_per_sec.summary(),
+            "load_ms": self.load_ms.summary(),
+            "prompt_eval_ms": self.prompt_eval_ms.summary(),
+            # Qué parte del tiempo de Ollama se va en cargar, evaluar el prompt y generar
+            "share": {
+                "load": self.load_total / spent if spent else 0.0,
+                "prompt_eval": self.prompt_eval_total / spent if spent else 0.0,
+                "eval": self.eval_total / spent if spent else 0.0,
+            },
+        }
+
+
+class SheilyGenerationMetrics:
+    """Histogramas por modelo de TTFT, tokens/s, carga y evaluación del prompt."""
+
+    def __init__(self):
+        self._models: Dict[str, _ModelTimings] = {}
+
+    def record(self, timing: GenerationTiming) -> None:
+        model = self._models.get(timing.model)
+        if model is None:
+            model = self._models[timing.model] = _ModelTimings()
+        model.add(timing)
+
+    def stats(self, model: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            name: timings.summary() for name, timings in self._models.items() if model is None or name == model
+        }
+
+    def clear(self) -> None:
+        self._models.clear()
+
+
+# Instancia global de las métricas de generación
+generation_metrics = SheilyGenerationMetrics()
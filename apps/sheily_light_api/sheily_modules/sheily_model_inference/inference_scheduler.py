@@ -0,0 +1,266 @@
+"""Planificador de peticiones de inferencia entre el chat y Ollama.
+
+Cada modelo tiene su propio carril con un límite de concurrencia (``n_parallel`` de
+``ollama-config.json``) y una cola acotada ordenada por prioridad. Cuando la cola
+está llena la petición se rechaza al instante con ``InferenceQueueFull`` en lugar de
+acumularse en la cola interna de Ollama hasta que salte ``OLLAMA_TIMEOUT``.
+
+Dentro de cada clase de prioridad los huecos se reparten entre usuarios con
+deficit round-robin ponderado, de modo que un cliente que lanza peticiones en bucle
+no retrasa a los demás más allá de una ronda.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Hashable, Optional, Tuple
+
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_config import get_parallel_slots
+
+logger = logging.getLogger("sheily_inference_scheduler")
+
+# Clases de prioridad: un número menor se atiende antes
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+SCHEDULER_MAX_QUEUE = int(os.getenv("SHEILY_SCHEDULER_MAX_QUEUE", "32"))
+# Un solo usuario no puede ocupar toda la cola y dejar sin sitio a los demás
+SCHEDULER_MAX_QUEUE_PER_USER = int(os.getenv("SHEILY_SCHEDULER_MAX_QUEUE_PER_USER", "8"))
+# Por defecto se respeta n_parallel de ollama-config.json
+SCHEDULER_CONCURRENCY = os.getenv("SHEILY_SCHEDULER_CONCURRENCY")
+# Estimación inicial de la duración de una generación, antes de tener medidas
+SCHEDULER_INITIAL_SERVICE_TIME = float(os.getenv("SHEILY_SCHEDULER_INITIAL_SERVICE_TIME", "10"))
+
+_EWMA_ALPHA = 0.2
+_WAIT_SAMPLES = 256
+
+
+class InferenceQueueFull(Exception):
+    """La cola del modelo está llena; el cliente debe reintentar pasados ``retry_after`` segundos."""
+
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(f"La cola de inferencia de {model} está llena")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class _FairQueue:
+    """
+    Cola de una clase de prioridad con deficit round-robin por usuario.
+
+    Cada usuario con peticiones pendientes es un flujo; en su turno recibe ``peso``
+    créditos y cada petición atendida consume uno. Los flujos rotan en orden circular.
+    """
+
+    def __init__(self):
+        self.flows: "OrderedDict[Hashable, Deque[asyncio.Future[None]]]" = OrderedDict()
+        self.deficits: Dict[Hashable, float] = {}
+        self.weights: Dict[Hashable, float] = {}
+
+    def push(self, flow: Hashable, weight: float, future: "asyncio.Future[None]") -> None:
+        self.weights[flow] = weight
+        if flow not in self.flows:
+            self.flows[flow] = deque()
+            self.deficits[flow] = weight
+        self.flows[flow].append(future)
+
+    def pop(self) -> Optional[Tuple[Hashable, "asyncio.Future[None]"]]:
+        while self.flows:
+            flow, waiters = next(iter(self.flows.items()))
+            while waiters and waiters[0].cancelled():
+                waiters.popleft()
+            if not waiters:
+                self._drop(flow)
+                continue
+            if self.deficits[flow] >= 1:
+                self.deficits[flow] -= 1
+                future = waiters.popleft()
+                if not waiters:
+                    self._drop(flow)
+                return flow, future
+            # Turno agotado: el flujo pasa al final con nuevos créditos
+            self.flows.move_to_end(flow)
+            self.deficits[flow] += self.weights[flow]
+        return None
+
+    def _drop(self, flow: Hashable) -> None:
+        del self.flows[flow]
+        del self.deficits[flow]
+        del self.weights[flow]
+
+
+class _ModelLane:
+    """Estado de planificación de un modelo."""
+
+    def __init__(self, max_concurrency: int, max_queue: int, max_queue_per_flow: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_flow = max_queue_per_flow
+        self.active = 0
+        self.classes: Dict[int, _FairQueue] = {}
+        self.queued = 0
+        self.queued_by_priority: Dict[int, int] = {}
+        self.queued_by_flow: Dict[Hashable, int] = {}
+        self.service_time = SCHEDULER_INITIAL_SERVICE_TIME
+        self.waits: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+        self.admitted = 0
+        self.rejected = 0
+
+    def retry_after(self) -> int:
+        """Segundos estimados hasta que se libere un hueco en la cola."""
+        rounds = (self.queued + self.active) / self.max_concurrency
+        return max(1, math.ceil(rounds * self.service_time))
+
+
+class SheilyInferenceScheduler:
+    """Limita la concurrencia por modelo y ordena las esperas por prioridad y usuario."""
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        max_queue: int = SCHEDULER_MAX_QUEUE,
+        max_queue_per_flow: int = SCHEDULER_MAX_QUEUE_PER_USER,
+    ):
+        # Sin valor fijo, cada modelo usa su n_parallel ajustado al nodo (ver ollama_tuner)
+        self._per_model_concurrency = max_concurrency is None and not SCHEDULER_CONCURRENCY
+        if max_concurrency is None:
+            max_concurrency = int(SCHEDULER_CONCURRENCY) if SCHEDULER_CONCURRENCY else get_parallel_slots()
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self.max_queue_per_flow = max_queue_per_flow
+        self._lanes: Dict[str, _ModelLane] = {}
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        model: str,
+        priority: int = PRIORITY_INTERACTIVE,
+        flow: Hashable = None,
+        weight: float = 1.0,
+    ) -> AsyncIterator[None]:
+        """
+        Reserva un hueco de inferencia para ``model`` durante el bloque ``async with``.
+
+        Args:
+            model: Modelo que atenderá la petición
+            priority: Clase de prioridad (``PRIORITY_INTERACTIVE`` o ``PRIORITY_BATCH``)
+            flow: Clave de reparto justo, normalmente ``User.id``
+            weight: Peso del flujo; con peso 2 se atienden dos peticiones por ronda
+
+        Raises:
+            InferenceQueueFull: Si no hay hueco libre y la cola del modelo está llena
+        """
+        lane = self._lane(model)
+        await self._acquire(model, lane, priority, flow, max(weight, 0.1))
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            lane.service_time += _EWMA_ALPHA * (elapsed - lane.service_time)
+            self._release(lane)
+
+    def estimated_wait(self, model: str) -> float:
+        """Segundos que esperaría en cola una petición nueva a ``model``."""
+        lane = self._lanes.get(model)
+        if lane is None or lane.active + lane.queued < lane.max_concurrency:
+            return 0.0
+        rounds = (lane.queued + lane.active - lane.max_concurrency + 1) / lane.max_concurrency
+        return rounds * lane.service_time
+
+    def stats(self) -> Dict[str, Any]:
+        return {model: self._lane_stats(lane) for model, lane in self._lanes.items()}
+
+    # ------------------------------------------------------------------
+    # Internos
+    # ------------------------------------------------------------------
+
+    def _lane(self, model: str) -> _ModelLane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            max_concurrency = get_parallel_slots(model=model) if self._per_model_concurrency else self.max_concurrency
+            lane = self._lanes[model] = _ModelLane(max_concurrency, self.max_queue, self.max_queue_per_flow)
+        return lane
+
+    async def _acquire(self, model: str, lane: _ModelLane, priority: int, flow: Hashable, weight: float) -> None:
+        if lane.active < lane.max_concurrency and not lane.queued:
+            lane.active += 1
+            lane.admitted += 1
+            lane.waits.append(0.0)
+            return
+
+        if lane.queued >= lane.max_queue or lane.queued_by_flow.get(flow, 0) >= lane.max_queue_per_flow:
+            lane.rejected += 1
+            retry_after = lane.retry_after()
+            logger.warning(f"Inference queue full for {model}, rejecting (retry after {retry_after}s)")
+            raise InferenceQueueFull(model, retry_after)
+
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        lane.classes.setdefault(priority, _FairQueue()).push(flow, weight, future)
+        lane.queued += 1
+        lane.queued_by_priority[priority] = lane.queued_by_priority.get(priority, 0) + 1
+        lane.queued_by_flow[flow] = lane.queued_by_flow.get(flow, 0) + 1
+        enqueued = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # El hueco ya se había cedido a esta petición: devolverlo
+                self._release(lane)
+            else:
+                future.cancel()
+                self._dequeued(lane, priority, flow)
+            raise
+        lane.admitted += 1
+        lane.waits.append(time.monotonic() - enqueued)
+
+    def _release(self, lane: _ModelLane) -> None:
+        for priority in sorted(lane.classes):
+            popped = lane.classes[priority].pop()
+            if popped is not None:
+                flow, future = popped
+                # El hueco pasa directamente a la siguiente petición: ``active`` no cambia
+                self._dequeued(lane, priority, flow)
+                future.set_result(None)
+                return
+        lane.active -= 1
+
+    @staticmethod
+    def _dequeued(lane: _ModelLane, priority: int, flow: Hashable) -> None:
+        lane.queued -= 1
+        lane.queued_by_priority[priority] -= 1
+        lane.queued_by_flow[flow] -= 1
+        if not lane.queued_by_flow[flow]:
+            del lane.queued_by_flow[flow]
+
+    @staticmethod
+    def _lane_stats(lane: _ModelLane) -> Dict[str, Any]:
+        waits = sorted(lane.waits)
+        return {
+            "active": lane.active,
+            "queued": lane.queued,
+            "queued_by_priority": {
+                PRIORITY_NAMES.get(priority, str(priority)): count
+                for priority, count in lane.queued_by_priority.items()
+            },
+            "users_waiting": len(lane.queued_by_flow),
+            "max_concurrency": lane.max_concurrency,
+            "max_queue": lane.max_queue,
+            "max_queue_per_user": lane.max_queue_per_flow,
+            "admitted": lane.admitted,
+            "rejected": lane.rejected,
+            "wait_ms_avg": 1000 * sum(waits) / len(waits) if waits else 0.0,
+            "wait_ms_p95": 1000 * waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else 0.0,
+            "service_time_s": lane.service_time,
+        }
+
+
+# Instancia global del planificador de inferencia
+inference_scheduler = SheilyInferenceScheduler()
@@ -0,0 +1,233 @@
+"""Gestión de qué modelos están cargados en cada backend Ollama del pool.
+
+- Precarga los modelos de ``preload_models`` (``ollama-config.json``) en todos los
+  backends al arrancar, para que la primera petición no pague la carga completa del
+  modelo.
+- Aplica el ``keep_alive`` configurado por modelo en cada generación y precarga con
+  las mismas ``options`` que las peticiones (ver ``generation_options``).
+- Sigue los modelos residentes de cada backend con ``/api/ps`` y, si
+  ``SheilyMonitoringManager`` indica presión de memoria, descarga el usado hace más
+  tiempo para que llama3 y deepseek-coder no se expulsen mutuamente en nodos de
+  8-16 GB.
+- Separa la latencia de carga en frío de la latencia de generación.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Union
+
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_options import generation_options
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_backend_pool import (
+    OllamaBackendPool,
+    ollama_backends,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import model_tag
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_config import load_ollama_config
+from sheily_light_api.sheily_modules.sheily_monitoring_module.sheily_monitoring_manager import monitoring_manager
+
+logger = logging.getLogger("sheily_model_residency")
+
+RESIDENCY_CHECK_INTERVAL = float(os.getenv("SHEILY_RESIDENCY_CHECK_INTERVAL", "30"))
+# Por encima de este tiempo de carga la generación se cuenta como arranque en frío
+COLD_LOAD_THRESHOLD_MS = float(os.getenv("SHEILY_COLD_LOAD_THRESHOLD_MS", "1000"))
+
+_SAMPLES = 256
+_NS_PER_MS = 1_000_000
+
+
+def _percentile(samples: Deque[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class _LatencyStats:
+    def __init__(self):
+        self.samples: Deque[float] = deque(maxlen=_SAMPLES)
+        self.count = 0
+
+    def add(self, value_ms: float) -> None:
+        self.samples.append(value_ms)
+        self.count += 1
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg_ms": sum(self.samples) / len(self.samples) if self.samples else 0.0,
+            "p50_ms": _percentile(self.samples, 0.5),
+            "p95_ms": _percentile(self.samples, 0.95),
+        }
+
+
+class ModelResidencyManager:
+    """Controla la residencia en memoria de los modelos en los backends Ollama."""
+
+    def __init__(self, pool: Optional[OllamaBackendPool] = None, config: Optional[Dict[str, Any]] = None):
+        self._pool = pool
+        self._config = config
+        # URL del backend -> (modelo -> último uso (monotonic)); el primero es el menos reciente
+        self.loaded: Dict[str, "OrderedDict[str, float]"] = {}
+        self.cold_load = _LatencyStats()
+        self.generation = _LatencyStats()
+        self.preloaded: List[str] = []
+        self.unloads = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pool(self) -> OllamaBackendPool:
+        return self._pool or ollama_backends
+
+    @property
+    def config(self) -> Dict[str, Any]:
+        return self._config if self._config is not None else load_ollama_config()
+
+    def keep_alive_for(self, model: str) -> Optional[Union[str, int]]:
+        """``keep_alive`` configurado para el modelo, o None para usar el de Ollama."""
+        keep_alive = self.config.get("keep_alive")
+        if isinstance(keep_alive, dict):
+            return keep_alive.get(model, keep_alive.get("default"))
+        return keep_alive
+
+    def generate_params(self, model: str) -> Dict[str, Any]:
+        """Parámetros extra de ``/api/generate`` que dependen de la residencia."""
+        keep_alive = self.keep_alive_for(model)
+        return {} if keep_alive is None else {"keep_alive": keep_alive}
+
+    def is_loaded(self, model: str) -> bool:
+        """Si el modelo está cargado en algún backend que admite peticiones."""
+        tag = model_tag(model)
+        return any(
+            tag in map(model_tag, self.loaded.get(backend.url, ()))
+            for backend in self.pool.backends
+            if backend.breaker.can_attempt()
+        )
+
+    def record_generation(self, model: str, result: Dict[str, Any], backend_url: Optional[str] = None) -> None:
+        """
+        Registra una generación terminada a partir del JSON final de Ollama.
+
+        ``backend_url`` es el backend que la atendió (por defecto el primero del
+        pool). ``load_duration`` se contabiliza como carga en frío si supera el
+        umbral; el resto de ``total_duration`` es latencia de generación.
+        """
+        loaded = self.loaded.setdefault(backend_url or self.pool.backends[0].url, OrderedDict())
+        key = _loaded_key(loaded, model)
+        loaded[key] = time.monotonic()
+        loaded.move_to_end(key)
+        load_ms = result.get("load_duration", 0) / _NS_PER_MS
+        total_ms = result.get("total_duration", 0) / _NS_PER_MS
+        if load_ms >= COLD_LOAD_THRESHOLD_MS:
+            self.cold_load.add(load_ms)
+            logger.info(f"Cold load of {model} took {load_ms:.0f} ms")
+        if total_ms:
+            self.generation.add(max(total_ms - load_ms, 0.0))
+
+    async def preload(self, models: Optional[List[str]] = None) -> None:
+        """Carga los modelos configurados en cada backend enviando una generación vacía."""
+        for model in models if models is not None else self.config.get("preload_models", []):
+            # Con las mismas opciones que las peticiones: otro num_ctx obligaría a recargar el modelo
+            params = {"options": generation_options.for_model(model), **self.generate_params(model)}
+            results = await asyncio.gather(
+                *(backend.client.generate_raw(model, "", **params) for backend in self.pool.backends),
+                return_exceptions=True,
+            )
+            for backend, result in zip(self.pool.backends, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Failed to preload model {model} on {backend.url}: {str(result)}")
+                    continue
+                self.record_generation(model, result, backend.url)
+            if any(not isinstance(result, Exception) for result in results):
+                self.preloaded.append(model)
+                logger.info(f"Model {model} preloaded")
+
+    async def refresh(self) -> None:
+        """Sincroniza los modelos residentes de cada backend con su ``/api/ps``."""
+        backends = self.pool.backends
+        responses = await asyncio.gather(*(backend.client.ps() for backend in backends), return_exceptions=True)
+        for backend, models in zip(backends, responses):
+            if isinstance(models, Exception):
+                # Backend caído: se conserva lo último conocido y el circuit breaker lo aparta
+                logger.warning(f"Failed to list loaded models on {backend.url}: {str(models)}")
+                continue
+            # ``/api/ps`` informa ``llama3:latest`` para el ``llama3`` de la configuración
+            resident = {model_tag(m["name"]): m["name"] for m in models}
+            loaded = self.loaded.setdefault(backend.url, OrderedDict())
+            for model in list(loaded):
+                if model_tag(model) not in resident:
+                    del loaded[model]
+            known = set(map(model_tag, loaded))
+            for tag, model in resident.items():
+                if tag not in known:
+                    # Cargado por otro cliente: se considera el menos reciente
+                    loaded[model] = 0.0
+                    loaded.move_to_end(model, last=False)
+
+    async def relieve_memory_pressure(self) -> Optional[str]:
+        """
+        Descarga un modelo si hay presión de memoria: el usado hace más tiempo entre
+        los backends con más de un modelo cargado.
+        """
+        crowded = [backend for backend in self.pool.backends if len(self.loaded.get(backend.url, ())) >= 2]
+        if not crowded or not monitoring_manager.is_memory_pressure():
+            return None
+        backend = min(crowded, key=lambda b: next(iter(self.loaded[b.url].values())))
+        model = next(iter(self.loaded[backend.url]))
+        try:
+            await backend.client.generate_raw(model, "", keep_alive=0)
+        except Exception as e:
+            logger.warning(f"Failed to unload model {model} on {backend.url}: {str(e)}")
+            return None
+        del self.loaded[backend.url][model]
+        self.unloads += 1
+        logger.warning(f"Memory pressure: unloaded least recently used model {model} on {backend.url}")
+        return model
+
+    def start(self, interval: float = RESIDENCY_CHECK_INTERVAL) -> None:
+        """Precarga los modelos y vigila la memoria en segundo plano."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(interval))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loaded": list(dict.fromkeys(model for loaded in self.loaded.values() for model in loaded)),
+            "backends": {url: list(loaded) for url, loaded in self.loaded.items()},
+            "preloaded": self.preloaded,
+            "unloads": self.unloads,
+            "cold_load": self.cold_load.summary(),
+            "generation": self.generation.summary(),
+        }
+
+    async def _run(self, interval: float) -> None:
+        await self.preload()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+                await self.relieve_memory_pressure()
+            except Exception as e:
+                logger.error(f"Model residency check failed: {str(e)}")
+
+
+def _loaded_key(loaded: "OrderedDict[str, float]", model: str) -> str:
+    """Nombre con el que ``loaded`` ya sigue a ``model`` (con o sin ``:latest``), o el propio ``model``."""
+    tag = model_tag(model)
+    return next((name for name in loaded if model_tag(name) == tag), model)
+
+
+# Instancia global del gestor de residencia de modelos
+model_residency = ModelResidencyManager()
@@ -0,0 +1,346 @@
+"""Elección del modelo local según la intención, la carga del nodo y un SLO de latencia.
+
+El catálogo (``model_catalog`` en ``ollama-config.json``) lista, para cada intención,
+los modelos en orden de preferencia con una estimación inicial de tokens/s (la
+medida por ``ollama_tuner`` si el nodo se ha ajustado) y de tiempo de carga; ambas
+se sustituyen por medias móviles de lo medido en cada generación. Para cada
+petición se estima la latencia de cada candidato:
+
+    espera en la cola del planificador + carga (si no está residente) + tokens esperados / tokens/s
+
+con la generación penalizada si la CPU supera el umbral de ``SheilyMonitoringManager``
+y la carga en frío descartada si hay presión de memoria. Se elige el modelo más
+preferido que cumple el SLO; si ninguno lo cumple, el de menor latencia estimada.
+Tras degradar, el preferido solo vuelve cuando su estimación baja de
+``SLO x ROUTER_RECOVER_RATIO``, para no alternar en cada petición; esta histéresis
+solo se aplica a las peticiones con el SLO por defecto, porque un SLO propio de una
+petición no debe cambiar el modelo de las demás.
+
+``plan`` calcula la decisión sin efectos y ``commit`` la cuenta y la registra: el
+chat consulta la caché con el modelo planificado y solo confirma la decisión cuando
+de verdad va a generar.
+
+Los modelos alternativos solo se consideran si están instalados en Ollama (se
+consulta ``/api/tags`` en segundo plano). Cada decisión se registra en un fichero
+JSONL para analizarla después.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from sheily_light_api.sheily_modules.sheily_model_inference.inference_scheduler import inference_scheduler
+from sheily_light_api.sheily_modules.sheily_model_inference.model_residency import model_residency
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import get_ollama_client
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_config import get_tuned_profile, load_ollama_config
+from sheily_light_api.sheily_modules.sheily_monitoring_module.sheily_monitoring_manager import monitoring_manager
+
+logger = logging.getLogger("sheily_model_router")
+
+DEFAULT_MODEL = "llama3"
+CODE_MODEL = "deepseek-coder:latest"
+
+# Latencia objetivo de una respuesta completa cuando la petición no indica otra
+ROUTER_SLO_MS = float(os.getenv("SHEILY_ROUTER_SLO_MS", "20000"))
+# Tokens de respuesta con los que se estima la duración de la generación
+ROUTER_EXPECTED_TOKENS = int(os.getenv("SHEILY_ROUTER_EXPECTED_TOKENS", "256"))
+ROUTER_RECOVER_RATIO = float(os.getenv("SHEILY_ROUTER_RECOVER_RATIO", "0.8"))
+ROUTER_REFRESH_INTERVAL = float(os.getenv("SHEILY_ROUTER_REFRESH_INTERVAL", "60"))
+# Las lecturas de CPU y memoria se reutilizan durante este tiempo
+ROUTER_LOAD_TTL = float(os.getenv("SHEILY_ROUTER_LOAD_TTL", "1"))
+ROUTER_LOG_ENABLED = os.getenv("SHEILY_ROUTER_LOG_ENABLED", "true").lower() == "true"
+ROUTER_LOG_PATH = os.getenv(
+    "SHEILY_ROUTER_LOG_PATH", os.path.join(os.path.expanduser("~"), ".sheily", "logs", "model_router.jsonl")
+)
+
+_EWMA_ALPHA = 0.2
+_NS_PER_MS = 1_000_000
+_DEFAULT_TOKENS_PER_SEC = 20.0
+_DEFAULT_LOAD_MS = 5000.0
+_DEFAULT_CATALOG = {
+    "general": [{"name": DEFAULT_MODEL}],
+    "code": [{"name": CODE_MODEL}],
+}
+
+
+@dataclass
+class ModelProfile:
+    """Modelo del catálogo con su rendimiento estimado (inicial o medido)."""
+
+    name: str
+    tokens_per_sec: float = _DEFAULT_TOKENS_PER_SEC
+    load_ms: float = _DEFAULT_LOAD_MS
+    samples: int = 0
+
+
+@dataclass
+class RouteDecision:
+    """Modelo elegido para una petición y por qué."""
+
+    model: str
+    intent: str
+    reason: str
+    estimated_ms: float
+    slo_ms: float
+    # Contexto de la decisión para ``commit``: preferido de la intención, estimaciones y carga del nodo
+    preferred: str = ""
+    estimates: Dict[str, float] = field(default_factory=dict, repr=False)
+    load: Dict[str, float] = field(default_factory=dict, repr=False)
+    memory_pressure: bool = False
+
+
+class SheilyModelRouter:
+    """Elige el modelo de cada petición a partir del catálogo, la carga del nodo y el SLO."""
+
+    def __init__(
+        self,
+        catalog: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+        slo_ms: float = ROUTER_SLO_MS,
+        expected_tokens: int = ROUTER_EXPECTED_TOKENS,
+        recover_ratio: float = ROUTER_RECOVER_RATIO,
+        log_path: Optional[str] = ROUTER_LOG_PATH if ROUTER_LOG_ENABLED else None,
+    ):
+        self._catalog_config = catalog
+        self.slo_ms = slo_ms
+        self.expected_tokens = expected_tokens
+        self.recover_ratio = recover_ratio
+        self.log_path = log_path
+
+        self._catalog: Optional[Dict[str, List[str]]] = None
+        self._profiles: Dict[str, ModelProfile] = {}
+        # None mientras no se sepa qué modelos tiene Ollama: solo se usan los preferidos
+        self.installed: Optional[Set[str]] = None
+        self._degraded: Dict[str, bool] = {}
+        self._load: Dict[str, float] = {}
+        self._load_at = 0.0
+        self._decision_log: Optional[logging.Logger] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.decisions: Counter = Counter()
+        self.degradations = 0
+        self.recoveries = 0
+        self.slo_misses = 0
+
+    # ------------------------------------------------------------------
+    # API pública
+    # ------------------------------------------------------------------
+
+    def choose(self, intent: str, slo_ms: Optional[float] = None) -> RouteDecision:
+        """Modelo para una petición que se va a generar: ``plan`` seguido de ``commit``."""
+        decision = self.plan(intent, slo_ms)
+        self.commit(decision)
+        return decision
+
+    def plan(self, intent: str, slo_ms: Optional[float] = None) -> RouteDecision:
+        """
+        Modelo para una petición, sin contarlo ni registrarlo.
+
+        Args:
+            intent: ``code`` usa el catálogo de código; cualquier otra, el general
+            slo_ms: Latencia objetivo de la petición (por defecto ``slo_ms``)
+        """
+        catalog = self.catalog()
+        kind = _kind(intent)
+        slo = slo_ms or self.slo_ms
+        load = self._system_load()
+        memory_pressure = load["memory_percent"] > monitoring_manager.alert_thresholds["memory_percent"]
+        candidates = [m for i, m in enumerate(catalog[kind]) if i == 0 or self._is_installed(m)]
+        estimates = {model: self.estimate_ms(model, load, memory_pressure) for model in candidates}
+
+        preferred = candidates[0]
+        degraded = slo == self.slo_ms and self._degraded.get(kind, False)
+        chosen, reason = None, "slo"
+        for model in candidates:
+            target = slo * self.recover_ratio if degraded and model == preferred else slo
+            if estimates[model] <= target:
+                chosen = model
+                break
+        if chosen is None:
+            chosen, reason = min(candidates, key=estimates.get), "best_effort"
+
+        return RouteDecision(
+            chosen, intent, reason, round(estimates[chosen], 1), slo, preferred, estimates, load, memory_pressure
+        )
+
+    def commit(self, decision: RouteDecision) -> None:
+        """Cuenta y registra una decisión de ``plan`` y, con el SLO por defecto, actualiza la histéresis."""
+        kind = _kind(decision.intent)
+        if decision.reason == "best_effort":
+            self.slo_misses += 1
+        if decision.slo_ms == self.slo_ms:
+            degraded = self._degraded.get(kind, False)
+            if decision.model != decision.preferred and not degraded:
+                self.degradations += 1
+                preferred_ms = decision.estimates.get(decision.preferred, 0.0)
+                logger.warning(
+                    f"Routing {kind} requests to {decision.model}: {decision.preferred} estimated {preferred_ms:.0f} ms"
+                )
+            elif decision.model == decision.preferred and degraded:
+                self.recoveries += 1
+                logger.info(f"Routing {kind} requests back to {decision.preferred}")
+            self._degraded[kind] = decision.model != decision.preferred
+        self.decisions[decision.model] += 1
+        self._log(decision)
+
+    def estimate_ms(self, model: str, load: Optional[Dict[str, float]] = None, memory_pressure: bool = False) -> float:
+        """Latencia estimada de una respuesta de ``expected_tokens`` tokens con ``model``."""
+        load = load or self._system_load()
+        profile = self._profile(model)
+        wait_ms = inference_scheduler.estimated_wait(model) * 1000
+        generation_ms = self.expected_tokens / max(profile.tokens_per_sec, 0.1) * 1000
+        cpu_limit = monitoring_manager.alert_thresholds["cpu_percent"]
+        if load["cpu_percent"] > cpu_limit:
+            # La generación se reparte la CPU con el resto del nodo: hasta el doble de lenta
+            generation_ms *= 1 + (load["cpu_percent"] - cpu_limit) / max(100 - cpu_limit, 1)
+        load_ms = 0.0
+        if not model_residency.is_loaded(model):
+            # Cargar otro modelo con la memoria al límite expulsaría a los residentes
+            load_ms = profile.load_ms if not memory_pressure else float("inf")
+        return wait_ms + load_ms + generation_ms
+
+    def record(self, model: str, result: Dict[str, Any]) -> None:
+        """Actualiza tokens/s y tiempo de carga con el JSON final de una generación de Ollama."""
+        profile = self._profile(model)
+        eval_count = result.get("eval_count", 0)
+        eval_ms = result.get("eval_duration", 0) / _NS_PER_MS
+        if eval_count and eval_ms:
+            tokens_per_sec = eval_count / (eval_ms / 1000)
+            alpha = 1.0 if not profile.samples else _EWMA_ALPHA
+            profile.tokens_per_sec += alpha * (tokens_per_sec - profile.tokens_per_sec)
+            profile.samples += 1
+        load_ms = result.get("load_duration", 0) / _NS_PER_MS
+        if load_ms >= 1000:
+            profile.load_ms += _EWMA_ALPHA * (load_ms - profile.load_ms)
+
+    def catalog(self) -> Dict[str, List[str]]:
+        """Modelos por intención en orden de preferencia."""
+        if self._catalog is None:
+            config = self._catalog_config or load_ollama_config().get("model_catalog") or _DEFAULT_CATALOG
+            self._catalog = {}
+            for kind in ("general", "code"):
+                entries = config.get(kind) or _DEFAULT_CATALOG[kind]
+                for entry in entries:
+                    profile = self._profile(entry["name"])
+                    profile.tokens_per_sec = float(entry.get("tokens_per_sec", profile.tokens_per_sec))
+                    profile.load_ms = float(entry.get("load_ms", profile.load_ms))
+                    # Lo medido en este nodo por ollama_tuner es mejor punto de partida que el catálogo
+                    tuned = get_tuned_profile(entry["name"]).get("eval_tokens_per_sec")
+                    if tuned:
+                        profile.tokens_per_sec = float(tuned)
+                self._catalog[kind] = [entry["name"] for entry in entries]
+        return self._catalog
+
+    async def refresh(self) -> None:
+        """Actualiza la lista de modelos instalados en Ollama."""
+        self.installed = set(await get_ollama_client().list_models())
+
+    def start(self, interval: float = ROUTER_REFRESH_INTERVAL) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(interval))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "catalog": self.catalog(),
+            "slo_ms": self.slo_ms,
+            "degraded": {kind: degraded for kind, degraded in self._degraded.items() if degraded},
+            "decisions": dict(self.decisions),
+            "degradations": self.degradations,
+            "recoveries": self.recoveries,
+            "slo_misses": self.slo_misses,
+            "profiles": {
+                name: {"tokens_per_sec": round(p.tokens_per_sec, 1), "load_ms": round(p.load_ms), "samples": p.samples}
+                for name, p in self._profiles.items()
+            },
+        }
+
+    # ------------------------------------------------------------------
+    # Internos
+    # ------------------------------------------------------------------
+
+    def _profile(self, model: str) -> ModelProfile:
+        profile = self._profiles.get(model)
+        if profile is None:
+            profile = self._profiles[model] = ModelProfile(model)
+        return profile
+
+    def _is_installed(self, model: str) -> bool:
+        return self.installed is not None and model in self.installed
+
+    def _system_load(self) -> Dict[str, float]:
+        now = time.monotonic()
+        if not self._load or now - self._load_at >= ROUTER_LOAD_TTL:
+            self._load = monitoring_manager.get_load()
+            self._load_at = now
+        return self._load
+
+    def _log(self, decision: RouteDecision) -> None:
+        if not self.log_path:
+            return
+        estimates, load = decision.estimates, decision.load
+        try:
+            if self._decision_log is None:
+                self._decision_log = _decision_logger(self.log_path)
+            record = {
+                "ts": time.time(),
+                "intent": decision.intent,
+                "model": decision.model,
+                "reason": decision.reason,
+                "slo_ms": decision.slo_ms,
+                "estimates_ms": {m: (round(v, 1) if v != float("inf") else None) for m, v in estimates.items()},
+                "queue_wait_s": {m: round(inference_scheduler.estimated_wait(m), 3) for m in estimates},
+                "loaded": [m for m in estimates if model_residency.is_loaded(m)],
+                "cpu_percent": load["cpu_percent"],
+                "memory_percent": load["memory_percent"],
+                "memory_pressure": decision.memory_pressure,
+            }
+            self._decision_log.info(json.dumps(record))
+        except Exception as e:
+            logger.warning(f"Failed to log routing decision: {str(e)}")
+            self.log_path = None
+
+    async def _run(self, interval: float) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Failed to refresh installed models: {str(e)}")
+            await asyncio.sleep(interval)
+
+
+def _kind(intent: str) -> str:
+    return "code" if intent == "code" else "general"
+
+
+def _decision_logger(path: str) -> logging.Logger:
+    """Logger que escribe una decisión JSON por línea, con rotación por tamaño."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    decision_log = logging.getLogger(f"sheily_model_router.decisions.{path}")
+    decision_log.propagate = False
+    decision_log.setLevel(logging.INFO)
+    if not decision_log.handlers:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=10 * 1024 * 1024, backupCount=3)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        decision_log.addHandler(handler)
+    return decision_log
+
+
+# Instancia global del enrutador de modelos
+model_router = SheilyModelRouter()
@@ -0,0 +1,257 @@
+"""Pool de backends Ollama con balanceo por carga y afinidad de conversación.
+
+``OLLAMA_URLS`` (lista separada por comas) define los nodos Ollama; si no existe se
+usa ``OLLAMA_URL``. Cada petición se envía al backend con menor
+``(peticiones en curso + 1) x latencia EWMA``. Las peticiones con clave de afinidad
+(la conversación) se fijan a un backend mediante hashing rendezvous, para que la
+caché KV/de prompt del modelo siga caliente, salvo que ese backend esté caído o
+mucho más cargado que el resto.
+
+Cada backend tiene un circuit breaker: los fallos seguidos (o un sondeo fallido de
+``/api/tags``) lo abren y las peticiones dejan de enviársele; pasado el tiempo de
+espera se deja pasar una petición de prueba, y un sondeo correcto lo cierra. Si
+todos los circuitos están abiertos se lanza ``OllamaUnavailable`` al instante, en
+lugar de esperar al timeout de conexión.
+
+El sondeo periódico publica además un estado de salud en caché (``health_state``).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from sheily_light_api.sheily_modules.sheily_model_inference.circuit_breaker import CircuitBreaker
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import (
+    DEFAULT_OLLAMA_URL,
+    AsyncOllamaClient,
+)
+
+logger = logging.getLogger("sheily_ollama_pool")
+
+OLLAMA_POOL_MAX_FAILURES = int(os.getenv("OLLAMA_POOL_MAX_FAILURES", "3"))
+OLLAMA_POOL_EJECT_SECONDS = float(os.getenv("OLLAMA_POOL_EJECT_SECONDS", "30"))
+OLLAMA_POOL_PROBE_INTERVAL = float(os.getenv("OLLAMA_POOL_PROBE_INTERVAL", "15"))
+OLLAMA_POOL_PROBE_TIMEOUT = float(os.getenv("OLLAMA_POOL_PROBE_TIMEOUT", "3"))
+# Peticiones en curso de margen antes de romper la afinidad hacia un backend más libre
+OLLAMA_POOL_AFFINITY_SLACK = int(os.getenv("OLLAMA_POOL_AFFINITY_SLACK", "4"))
+
+_EWMA_ALPHA = 0.3
+# Latencia supuesta de un backend sin medidas: lo bastante baja para que reciba tráfico
+_INITIAL_LATENCY = 1.0
+
+
+def configured_ollama_urls() -> List[str]:
+    """URLs de Ollama configuradas (``OLLAMA_URLS`` o, en su defecto, ``OLLAMA_URL``)."""
+    raw = os.getenv("OLLAMA_URLS") or os.getenv("OLLAMA_URL", DEFAULT_OLLAMA_URL)
+    return [url.strip().rstrip("/") for url in raw.split(",") if url.strip()]
+
+
+class OllamaUnavailable(RuntimeError):
+    """Ningún backend Ollama admite peticiones (todos los circuitos abiertos)."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("El servicio de IA local no está disponible")
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+def _is_backend_failure(error: BaseException) -> bool:
+    """Distingue los fallos del nodo (red, 5xx) de los errores de la petición."""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return False
+
+
+class _Backend:
+    def __init__(self, url: str, breaker: CircuitBreaker):
+        self.url = url
+        self.client = AsyncOllamaClient(url)
+        self.breaker = breaker
+        self.outstanding = 0
+        self.latency = _INITIAL_LATENCY
+        self.requests = 0
+        self.failures = 0
+        self.last_probe: Optional[float] = None
+        self.last_probe_ok: Optional[bool] = None
+
+    def load_score(self) -> float:
+        return (self.outstanding + 1) * self.latency
+
+    def affinity_score(self, key: str) -> int:
+        digest = hashlib.blake2b(f"{key}|{self.url}".encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+
+class OllamaBackendPool:
+    """Reparte las peticiones de inferencia entre varios nodos Ollama."""
+
+    def __init__(
+        self,
+        urls: Optional[List[str]] = None,
+        *,
+        max_failures: int = OLLAMA_POOL_MAX_FAILURES,
+        eject_seconds: float = OLLAMA_POOL_EJECT_SECONDS,
+        affinity_slack: int = OLLAMA_POOL_AFFINITY_SLACK,
+    ):
+        self.backends = [
+            _Backend(url, CircuitBreaker(failure_threshold=max_failures, reset_timeout=eject_seconds))
+            for url in (urls or configured_ollama_urls())
+        ]
+        self.affinity_slack = affinity_slack
+        self.rejected = 0
+        self.affinity_breaks = 0
+        self._probe_task: Optional[asyncio.Task] = None
+
+    def choose(self, affinity_key: Optional[str] = None) -> _Backend:
+        """
+        Elige el backend para una petición.
+
+        Args:
+            affinity_key: Clave de la conversación; las peticiones con la misma clave
+                van al mismo backend mientras esté sano y no sobrecargado
+
+        Raises:
+            OllamaUnavailable: Si todos los circuitos están abiertos
+        """
+        candidates = [b for b in self.backends if b.breaker.can_attempt()]
+        if not candidates:
+            raise self._unavailable()
+
+        least_loaded = min(candidates, key=lambda b: b.load_score())
+        if affinity_key is None:
+            return least_loaded
+
+        preferred = max(candidates, key=lambda b: b.affinity_score(affinity_key))
+        if preferred.outstanding - least_loaded.outstanding > self.affinity_slack:
+            self.affinity_breaks += 1
+            return least_loaded
+        return preferred
+
+    def ensure_available(self) -> None:
+        """Falla al instante si ningún backend admite peticiones, antes de hacer cola por un hueco."""
+        if not any(b.breaker.can_attempt() for b in self.backends):
+            raise self._unavailable()
+
+    @asynccontextmanager
+    async def lease(self, affinity_key: Optional[str] = None) -> AsyncIterator[AsyncOllamaClient]:
+        """Reserva un backend durante el bloque y registra su latencia y sus fallos."""
+        backend = self.choose(affinity_key)
+        backend.breaker.on_attempt()
+        backend.outstanding += 1
+        backend.requests += 1
+        started = time.monotonic()
+        try:
+            yield backend.client
+        except BaseException as e:
+            if _is_backend_failure(e):
+                self._record_failure(backend, e)
+            else:
+                # Cancelación o error de la petición: no dice nada de la salud del backend
+                backend.breaker.release_trial()
+            raise
+        else:
+            backend.latency += _EWMA_ALPHA * (time.monotonic() - started - backend.latency)
+            self._record_success(backend)
+        finally:
+            backend.outstanding -= 1
+
+    async def probe_all(self) -> None:
+        """Sondea ``/api/tags`` en todos los backends y expulsa o readmite según el resultado."""
+        await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+
+    def health_state(self) -> Dict[str, Any]:
+        """Último estado de salud publicado por el sondeo, sin hacer peticiones."""
+        probes = [b.last_probe for b in self.backends if b.last_probe is not None]
+        return {
+            "healthy": any(b.breaker.can_attempt() for b in self.backends),
+            "checked_at": max(probes) if probes else None,
+            "backends": {b.url: b.breaker.state for b in self.backends},
+        }
+
+    def start_probing(self, interval: float = OLLAMA_POOL_PROBE_INTERVAL) -> None:
+        """Lanza el sondeo periódico en segundo plano."""
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.ensure_future(self._probe_loop(interval))
+
+    async def stop_probing(self) -> None:
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "affinity_breaks": self.affinity_breaks,
+            "rejected": self.rejected,
+            "backends": [
+                {
+                    "url": b.url,
+                    "available": b.breaker.can_attempt(),
+                    "circuit": b.breaker.state,
+                    "outstanding": b.outstanding,
+                    "latency_ewma_s": b.latency,
+                    "requests": b.requests,
+                    "failures": b.failures,
+                    "ejections": b.breaker.opens,
+                    "last_probe_ok": b.last_probe_ok,
+                }
+                for b in self.backends
+            ],
+        }
+
+    # ------------------------------------------------------------------
+    # Internos
+    # ------------------------------------------------------------------
+
+    def _unavailable(self) -> OllamaUnavailable:
+        self.rejected += 1
+        return OllamaUnavailable(min(b.breaker.retry_after() for b in self.backends))
+
+    def _record_failure(self, backend: _Backend, error: BaseException) -> None:
+        backend.failures += 1
+        was_open = backend.breaker.state != "closed"
+        backend.breaker.record_failure()
+        if not was_open and backend.breaker.state == "open":
+            logger.warning(f"Circuit opened for Ollama backend {backend.url}: {error!r}")
+
+    def _record_success(self, backend: _Backend) -> None:
+        if backend.breaker.state != "closed":
+            logger.info(f"Circuit closed for Ollama backend {backend.url}")
+        backend.breaker.record_success()
+
+    async def _probe(self, backend: _Backend) -> None:
+        try:
+            resp = await backend.client.http.get(f"{backend.url}/api/tags", timeout=OLLAMA_POOL_PROBE_TIMEOUT)
+            resp.raise_for_status()
+        except Exception as e:
+            backend.last_probe, backend.last_probe_ok = time.time(), False
+            if backend.breaker.state == "closed":
+                logger.warning(f"Circuit opened for Ollama backend {backend.url}: probe failed ({e!r})")
+            backend.breaker.trip()
+            return
+        backend.last_probe, backend.last_probe_ok = time.time(), True
+        self._record_success(backend)
+
+    async def _probe_loop(self, interval: float) -> None:
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"Ollama backend probe failed: {str(e)}")
+            await asyncio.sleep(interval)
+
+
+# Pool global de backends Ollama
+ollama_backends = OllamaBackendPool()
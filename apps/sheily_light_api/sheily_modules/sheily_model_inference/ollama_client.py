@@ -2,17 +2,43 @@
 
 from __future__ import annotations
 
+import importlib.util
+import json
 import os
-from typing import Any, Dict, Generator, Optional
+from typing import Any, AsyncIterator, Dict, Generator, List, Optional
 
 import httpx
 
-__all__ = ["OllamaClient"]
+__all__ = [
+    "OllamaClient",
+    "AsyncOllamaClient",
+    "init_async_http_client",
+    "get_async_http_client",
+    "close_async_http_client",
+    "get_ollama_client",
+    "model_tag",
+]
+
+DEFAULT_OLLAMA_URL = "http://localhost:11434"
+OLLAMA_TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "300"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+
+# Límites del pool de conexiones compartido por todo el proceso
+OLLAMA_POOL_MAX_CONNECTIONS = int(os.getenv("OLLAMA_POOL_MAX_CONNECTIONS", "64"))
+OLLAMA_POOL_MAX_KEEPALIVE = int(os.getenv("OLLAMA_POOL_MAX_KEEPALIVE", "32"))
+OLLAMA_POOL_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_POOL_KEEPALIVE_EXPIRY", "60"))
+# "auto" activa HTTP/2 solo si el paquete h2 está instalado
+OLLAMA_HTTP2 = os.getenv("OLLAMA_HTTP2", "auto").lower()
+
+
+def model_tag(model: str) -> str:
+    """Nombre con etiqueta explícita: ``/api/ps`` informa ``llama3`` como ``llama3:latest``."""
+    return model if ":" in model.rsplit("/", 1)[-1] else f"{model}:latest"
 
 
 class OllamaClient:
     def __init__(self, base_url: Optional[str] = None, *, timeout: int = 300):
-        self.base_url = base_url or os.getenv("OLLAMA_URL", "http://localhost:11434")
+        self.base_url = base_url or os.getenv("OLLAMA_URL", DEFAULT_OLLAMA_URL)
         self._client = httpx.Client(base_url=self.base_url, timeout=timeout)
 
     def generate(self, model: str, prompt: str, **params: Any) -> str:
@@ -32,3 +58,156 @@ class OllamaClient:
 
     def __exit__(self, exc_type, exc_value, traceback):
         self._client.close()
+
+
+# ---------------------------------------------------------------------------
+# Cliente asíncrono con pool de conexiones compartido
+# ---------------------------------------------------------------------------
+
+_shared_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_enabled() -> bool:
+    if OLLAMA_HTTP2 in ("1", "true", "yes"):
+        return True
+    if OLLAMA_HTTP2 == "auto":
+        return importlib.util.find_spec("h2") is not None
+    return False
+
+
+def _build_async_http_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=OLLAMA_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=OLLAMA_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=OLLAMA_POOL_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT)
+    kwargs: Dict[str, Any] = {"limits": limits, "timeout": timeout}
+    if transport is not None:
+        kwargs["transport"] = transport
+    else:
+        kwargs["http2"] = _http2_enabled()
+    return httpx.AsyncClient(**kwargs)
+
+
+async def init_async_http_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    """Crea el cliente HTTP compartido. Se llama desde el arranque de la aplicación.
+
+    Args:
+        transport: Transporte alternativo (p. ej. ``httpx.MockTransport`` en tests)
+
+    Returns:
+        httpx.AsyncClient: Cliente con pool de conexiones y keep-alive
+    """
+    global _shared_http_client
+    if _shared_http_client is not None and not _shared_http_client.is_closed:
+        await _shared_http_client.aclose()
+    _shared_http_client = _build_async_http_client(transport)
+    return _shared_http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Devuelve el cliente HTTP compartido, creándolo si el arranque no lo hizo."""
+    global _shared_http_client
+    if _shared_http_client is None or _shared_http_client.is_closed:
+        _shared_http_client = _build_async_http_client()
+    return _shared_http_client
+
+
+async def close_async_http_client() -> None:
+    """Cierra el cliente HTTP compartido. Se llama al apagar la aplicación."""
+    global _shared_http_client
+    if _shared_http_client is not None:
+        await _shared_http_client.aclose()
+        _shared_http_client = None
+
+
+class AsyncOllamaClient:
+    """Cliente asíncrono de Ollama que reutiliza el pool HTTP del proceso.
+
+    Las instancias son ligeras: no abren conexiones propias, por lo que pueden
+    crearse por petición sin coste y no necesitan cerrarse.
+    """
+
+    def __init__(self, base_url: Optional[str] = None, *, http: Optional[httpx.AsyncClient] = None):
+        self.base_url = (base_url or os.getenv("OLLAMA_URL", DEFAULT_OLLAMA_URL)).rstrip("/")
+        self._http = http
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        return self._http or get_async_http_client()
+
+    def _url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    async def generate(self, model: str, prompt: str, **params: Any) -> str:
+        return (await self.generate_raw(model, prompt, **params)).get("response", "")
+
+    async def generate_raw(self, model: str, prompt: str, **params: Any) -> Dict[str, Any]:
+        """Como ``generate`` pero devuelve el JSON completo (duraciones de carga y evaluación incluidas)."""
+        data = {"model": model, "prompt": prompt, "stream": False, **params}
+        resp = await self.http.post(self._url("/api/generate"), json=data)
+        resp.raise_for_status()
+        return resp.json()
+
+    async def generate_stream(self, model: str, prompt: str, **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        """Itera sobre los fragmentos NDJSON de ``/api/generate`` a medida que llegan.
+
+        Cerrar el iterador antes de ``done`` cierra la conexión, lo que aborta la
+        generación en Ollama.
+        """
+        data = {"model": model, "prompt": prompt, **params, "stream": True}
+        async with self.http.stream("POST", self._url("/api/generate"), json=data) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"])
+                yield chunk
+                if chunk.get("done"):
+                    break
+
+    async def embed(self, model: str, prompt: str) -> list[float]:
+        data = {"model": model, "prompt": prompt}
+        resp = await self.http.post(self._url("/api/embeddings"), json=data)
+        resp.raise_for_status()
+        return resp.json().get("embedding", [])
+
+    async def embed_batch(self, model: str, inputs: List[str]) -> List[List[float]]:
+        """Embeddings de varios textos en una sola petición (``/api/embed``, Ollama >= 0.3)."""
+        resp = await self.http.post(self._url("/api/embed"), json={"model": model, "input": inputs})
+        resp.raise_for_status()
+        return resp.json().get("embeddings", [])
+
+    async def tags(self) -> Dict[str, Any]:
+        resp = await self.http.get(self._url("/api/tags"))
+        resp.raise_for_status()
+        return resp.json()
+
+    async def ps(self) -> List[Dict[str, Any]]:
+        """Modelos cargados actualmente en memoria (``/api/ps``)."""
+        resp = await self.http.get(self._url("/api/ps"))
+        resp.raise_for_status()
+        return resp.json().get("models", [])
+
+    async def list_models(self) -> List[str]:
+        data = await self.tags()
+        return [model["name"] for model in data.get("models", [])]
+
+    async def pull(self, name: str, *, timeout: float = 600) -> Dict[str, Any]:
+        resp = await self.http.post(self._url("/api/pull"), json={"name": name, "stream": False}, timeout=timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+
+_default_client: Optional[AsyncOllamaClient] = None
+
+
+def get_ollama_client() -> AsyncOllamaClient:
+    """Devuelve el cliente asíncrono por defecto del proceso (``OLLAMA_URL``)."""
+    global _default_client
+    if _default_client is None:
+        _default_client = AsyncOllamaClient()
+    return _default_client
@@ -0,0 +1,78 @@
+"""Lectura de ``ollama-config.json``, la configuración de Ollama compartida por el nodo,
+y del perfil ajustado al hardware del nodo que genera ``ollama_tuner``."""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger("sheily_ollama_config")
+
+# apps/sheily_light_api/sheily_modules/sheily_model_inference -> raíz del repositorio
+_REPO_ROOT = Path(__file__).resolve().parents[4]
+OLLAMA_CONFIG_PATH = os.getenv("OLLAMA_CONFIG_PATH", str(_REPO_ROOT / "ollama-config.json"))
+# Perfil por modelo medido en este nodo; tiene prioridad sobre ollama-config.json
+TUNED_CONFIG_PATH = os.getenv(
+    "SHEILY_TUNED_CONFIG_PATH", os.path.join(os.path.expanduser("~"), ".sheily", "config", "ollama-tuned.json")
+)
+
+
+@lru_cache(maxsize=8)
+def load_ollama_config(path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Carga la configuración de Ollama.
+
+    Args:
+        path: Ruta del fichero (por defecto ``OLLAMA_CONFIG_PATH``)
+
+    Returns:
+        Dict[str, Any]: La configuración, o un diccionario vacío si no existe o es inválida
+    """
+    config_path = Path(path or OLLAMA_CONFIG_PATH)
+    try:
+        with open(config_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.info(f"Ollama config not found at {config_path}, using defaults")
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Failed to load Ollama config {config_path}: {str(e)}")
+    return {}
+
+
+@lru_cache(maxsize=8)
+def load_tuned_config(path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Carga el perfil ajustado del nodo (``models`` -> ``options`` y ``n_parallel`` por modelo).
+
+    Returns:
+        Dict[str, Any]: El perfil, o un diccionario vacío si el nodo no se ha ajustado
+    """
+    tuned_path = Path(path or TUNED_CONFIG_PATH)
+    try:
+        with open(tuned_path, "r", encoding="utf-8") as f:
+            tuned = json.load(f)
+        logger.info(f"Loaded tuned Ollama profile for {len(tuned.get('models', {}))} models from {tuned_path}")
+        return tuned
+    except FileNotFoundError:
+        pass
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Failed to load tuned Ollama profile {tuned_path}: {str(e)}")
+    return {}
+
+
+def get_tuned_profile(model: str, path: Optional[str] = None) -> Dict[str, Any]:
+    """Perfil ajustado de ``model`` en este nodo (vacío si no se ha medido)."""
+    return load_tuned_config(path).get("models", {}).get(model, {})
+
+
+def get_parallel_slots(path: Optional[str] = None, model: Optional[str] = None) -> int:
+    """Peticiones simultáneas que Ollama atiende por modelo (``n_parallel``, o el valor ajustado de ``model``)."""
+    try:
+        tuned = get_tuned_profile(model).get("n_parallel") if model else None
+        return max(1, int(tuned or load_ollama_config(path).get("n_parallel", 1)))
+    except (TypeError, ValueError):
+        return 1
@@ -0,0 +1,345 @@
+"""Ajuste de los parámetros de Ollama al hardware del nodo.
+
+Los valores de ``ollama-config.json`` (``num_thread``, ``batch_size``...) se eligieron
+a mano para una máquina concreta. Este comando lanza un conjunto fijo de prompts
+contra el Ollama local (o cualquier servidor compatible en ``--url``) probando
+valores de ``num_thread``, ``num_batch``, ``num_ctx`` y de peticiones simultáneas,
+mide los tokens/s de evaluación del prompt y de generación y la memoria que ocupa
+el modelo (``/api/ps``), y guarda el mejor perfil de cada modelo en
+``SHEILY_TUNED_CONFIG_PATH``. Al arrancar, ``generation_options`` aplica sus opciones
+por encima de ``ollama-config.json`` y el planificador usa su ``n_parallel``.
+
+La rejilla se recorre por coordenadas: cada parámetro se prueba con los demás fijos
+en el mejor valor hallado, de modo que el coste es la suma de los tamaños de la
+rejilla y no su producto (``--exhaustive`` prueba todas las combinaciones). Cada
+prueba empieza con una petición de calentamiento sin medir, porque cambiar
+``num_ctx``, ``num_batch`` o ``num_thread`` obliga a Ollama a recargar el modelo.
+
+Se elige el mayor rendimiento agregado (tokens generados por segundo sumando las
+peticiones simultáneas) dentro del presupuesto de memoria. En ``num_ctx`` se elige
+la ventana más grande cuyo rendimiento queda dentro de ``--tolerance`` del mejor:
+más contexto no acelera, pero conviene tenerlo mientras salga casi gratis.
+
+    python -m sheily_light_api.sheily_modules.sheily_model_inference.ollama_tuner --model llama3
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import psutil
+
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import (
+    AsyncOllamaClient,
+    close_async_http_client,
+    get_ollama_client,
+    init_async_http_client,
+    model_tag,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_config import (
+    TUNED_CONFIG_PATH,
+    load_ollama_config,
+)
+
+logger = logging.getLogger("sheily_ollama_tuner")
+
+TUNER_PROMPTS = (
+    "Explica en tres frases qué es una red neuronal.",
+    "Escribe una función en Python que devuelva los números primos menores que n.",
+    "Resume las causas principales de la Revolución Francesa.",
+    "Traduce al inglés: 'El servidor responde más rápido desde que ajustamos la caché.'",
+)
+# Tokens generados por prompt en cada prueba
+TUNER_MAX_TOKENS = 128
+# Fracción del mejor rendimiento que se acepta a cambio de una ventana de contexto mayor
+TUNER_TOLERANCE = 0.9
+# Fracción de la memoria del nodo que puede ocupar el modelo
+TUNER_MEMORY_FRACTION = 0.8
+
+# Parámetros en el orden en que se ajustan por coordenadas
+TUNED_PARAMETERS = ("num_thread", "num_batch", "num_ctx", "parallel")
+
+_NS_PER_SEC = 1_000_000_000
+
+
+@dataclass
+class TrialResult:
+    """Medidas de una combinación de parámetros."""
+
+    options: Dict[str, int]
+    parallel: int
+    prompt_eval_tokens_per_sec: float = 0.0
+    # Velocidad de generación de cada petición
+    eval_tokens_per_sec: float = 0.0
+    # Tokens generados por segundo sumando las peticiones simultáneas
+    throughput: float = 0.0
+    memory_bytes: int = 0
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class TuningResult:
+    """Mejor perfil de un modelo y las pruebas que llevaron a él."""
+
+    model: str
+    best: TrialResult
+    trials: List[TrialResult] = field(default_factory=list)
+
+    def profile(self) -> Dict[str, Any]:
+        """Entrada del modelo en el fichero de perfil ajustado."""
+        return {
+            "options": dict(self.best.options),
+            "n_parallel": self.best.parallel,
+            "prompt_eval_tokens_per_sec": round(self.best.prompt_eval_tokens_per_sec, 1),
+            "eval_tokens_per_sec": round(self.best.eval_tokens_per_sec, 1),
+            "throughput_tokens_per_sec": round(self.best.throughput, 1),
+            "memory_bytes": self.best.memory_bytes,
+            "trials": len(self.trials),
+        }
+
+
+def default_grid(config: Optional[Dict[str, Any]] = None) -> Dict[str, List[int]]:
+    """Valores a probar según los núcleos del nodo y lo que ya hay en ``ollama-config.json``."""
+    config = config if config is not None else load_ollama_config()
+    logical = os.cpu_count() or 1
+    physical = psutil.cpu_count(logical=False) or logical
+    threads = {max(1, physical // 2), physical, logical}
+    batches = {128, 256, 512, 1024}
+    contexts = {2048, 4096, 8192}
+    if isinstance(config.get("num_thread"), int):
+        threads.add(config["num_thread"])
+    if isinstance(config.get("batch_size"), int):
+        batches.add(config["batch_size"])
+    if isinstance(config.get("num_ctx"), int):
+        contexts.add(config["num_ctx"])
+    return {
+        "num_thread": sorted(threads),
+        "num_batch": sorted(batches),
+        "num_ctx": sorted(contexts),
+        "parallel": [1, 2, 4],
+    }
+
+
+class SheilyOllamaTuner:
+    """Mide combinaciones de parámetros de Ollama y elige la mejor para cada modelo."""
+
+    def __init__(
+        self,
+        client: Optional[AsyncOllamaClient] = None,
+        prompts: Sequence[str] = TUNER_PROMPTS,
+        max_tokens: int = TUNER_MAX_TOKENS,
+        tolerance: float = TUNER_TOLERANCE,
+        memory_budget_bytes: Optional[int] = None,
+    ):
+        self.client = client or get_ollama_client()
+        self.prompts = list(prompts)
+        self.max_tokens = max_tokens
+        self.tolerance = tolerance
+        if memory_budget_bytes is None:
+            memory_budget_bytes = int(psutil.virtual_memory().total * TUNER_MEMORY_FRACTION)
+        self.memory_budget_bytes = memory_budget_bytes
+        self._runs = 0
+
+    async def measure(self, model: str, options: Dict[str, int], parallel: int) -> TrialResult:
+        """Ejecuta los prompts con ``parallel`` peticiones simultáneas por prompt y mide el resultado."""
+        trial = TrialResult(dict(options), parallel)
+        # Temperatura 0 y límite fijo: todas las pruebas generan un trabajo comparable
+        request_options = {**options, "num_predict": self.max_tokens, "temperature": 0}
+        self._runs += 1
+        try:
+            await self.client.generate_raw(model, "Hola", options=request_options)
+            results = []
+            started = time.perf_counter()
+            for prompt in self.prompts:
+                # Un prefijo distinto en cada prueba evita que Ollama reutilice el prompt ya evaluado
+                tagged = f"[{self._runs}] {prompt}"
+                results += await asyncio.gather(
+                    *(self.client.generate_raw(model, tagged, options=request_options) for _ in range(parallel))
+                )
+            elapsed = time.perf_counter() - started
+            trial.memory_bytes = sum(
+                m.get("size", 0) for m in await self.client.ps() if model_tag(m.get("name", "")) == model_tag(model)
+            )
+        except Exception as e:
+            trial.error = str(e) or type(e).__name__
+            logger.warning(f"Trial {options} x{parallel} on {model} failed: {trial.error}")
+            return trial
+
+        prompt_ns = sum(r.get("prompt_eval_duration", 0) for r in results)
+        eval_ns = sum(r.get("eval_duration", 0) for r in results)
+        eval_tokens = sum(r.get("eval_count", 0) for r in results)
+        if prompt_ns:
+            trial.prompt_eval_tokens_per_sec = sum(r.get("prompt_eval_count", 0) for r in results) / (
+                prompt_ns / _NS_PER_SEC
+            )
+        if eval_ns:
+            trial.eval_tokens_per_sec = eval_tokens / (eval_ns / _NS_PER_SEC)
+        trial.throughput = eval_tokens / elapsed if elapsed else 0.0
+        if self.memory_budget_bytes and trial.memory_bytes > self.memory_budget_bytes:
+            trial.error = f"model uses {trial.memory_bytes} bytes, budget is {self.memory_budget_bytes}"
+        return trial
+
+    async def tune(
+        self,
+        model: str,
+        grid: Optional[Dict[str, List[int]]] = None,
+        start: Optional[Dict[str, int]] = None,
+        exhaustive: bool = False,
+    ) -> TuningResult:
+        """
+        Busca el mejor perfil de ``model``.
+
+        Args:
+            model: Modelo de Ollama a ajustar
+            grid: Valores por parámetro (``num_thread``, ``num_batch``, ``num_ctx``, ``parallel``)
+            start: Punto de partida de la búsqueda por coordenadas (por defecto, el primer valor)
+            exhaustive: Probar todas las combinaciones en lugar de recorrer por coordenadas
+
+        Raises:
+            RuntimeError: Si ninguna combinación funciona
+        """
+        grid = grid or default_grid()
+        measured: Dict[Tuple[int, ...], TrialResult] = {}
+
+        async def trial(point: Dict[str, int]) -> TrialResult:
+            key = tuple(point[name] for name in TUNED_PARAMETERS)
+            if key not in measured:
+                options = {name: point[name] for name in TUNED_PARAMETERS if name != "parallel"}
+                measured[key] = await self.measure(model, options, point["parallel"])
+            return measured[key]
+
+        if exhaustive:
+            combinations = itertools.product(*(grid[name] for name in TUNED_PARAMETERS))
+            points = [dict(zip(TUNED_PARAMETERS, values)) for values in combinations]
+            best = self._pick([(point, await trial(point)) for point in points], "num_ctx")
+        else:
+            start = start or {}
+            best = {name: start[name] if start.get(name) in grid[name] else grid[name][0] for name in TUNED_PARAMETERS}
+            for name in TUNED_PARAMETERS:
+                candidates = [{**best, name: value} for value in grid[name]]
+                best = self._pick([(point, await trial(point)) for point in candidates], name) or best
+
+        result = measured.get(tuple(best[name] for name in TUNED_PARAMETERS)) if best else None
+        if result is None or not result.ok:
+            raise RuntimeError(f"No parameter combination worked for {model}")
+        return TuningResult(model, result, list(measured.values()))
+
+    def _pick(self, results: List[Tuple[Dict[str, int], TrialResult]], name: str) -> Optional[Dict[str, int]]:
+        ok = [(point, trial) for point, trial in results if trial.ok]
+        if not ok:
+            return None
+        if name != "num_ctx":
+            return max(ok, key=lambda item: item[1].throughput)[0]
+        top = max(trial.throughput for _, trial in ok)
+        near = [(point, trial) for point, trial in ok if trial.throughput >= top * self.tolerance]
+        return max(near, key=lambda item: (item[0]["num_ctx"], item[1].throughput))[0]
+
+
+def write_tuned_config(results: Sequence[TuningResult], path: str = TUNED_CONFIG_PATH) -> Dict[str, Any]:
+    """Guarda los perfiles conservando los de otros modelos ya ajustados en el nodo."""
+    target = Path(path)
+    try:
+        tuned = json.loads(target.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        tuned = {}
+    tuned.setdefault("models", {})
+    for result in results:
+        tuned["models"][result.model] = result.profile()
+    tuned["host"] = platform.node()
+    tuned["updated_at"] = datetime.now(timezone.utc).isoformat()
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_suffix(".tmp")
+    tmp.write_text(json.dumps(tuned, indent=2), encoding="utf-8")
+    os.replace(tmp, target)
+    return tuned
+
+
+def _int_list(value: str) -> List[int]:
+    return sorted({int(item) for item in value.split(",") if item.strip()})
+
+
+async def _main(args: argparse.Namespace) -> int:
+    config = load_ollama_config()
+    grid = default_grid(config)
+    for name in TUNED_PARAMETERS:
+        if getattr(args, name):
+            grid[name] = getattr(args, name)
+    # La búsqueda parte de los valores puestos a mano
+    start = {
+        "num_thread": config.get("num_thread"),
+        "num_batch": config.get("batch_size"),
+        "num_ctx": config.get("num_ctx"),
+    }
+    models = args.model or config.get("preload_models") or ["llama3"]
+
+    await init_async_http_client()
+    try:
+        tuner = SheilyOllamaTuner(AsyncOllamaClient(args.url), max_tokens=args.max_tokens, tolerance=args.tolerance)
+        results = []
+        for model in models:
+            print(f"Tuning {model} over {', '.join(f'{k}={v}' for k, v in grid.items())}")
+            try:
+                result = await tuner.tune(model, grid, start, exhaustive=args.exhaustive)
+            except RuntimeError as e:
+                print(f"  {e}")
+                continue
+            profile = result.profile()
+            print(f"  best: {profile['options']} n_parallel={profile['n_parallel']}")
+            print(
+                f"  prompt eval {profile['prompt_eval_tokens_per_sec']} tok/s, eval {profile['eval_tokens_per_sec']} "
+                f"tok/s, {profile['throughput_tokens_per_sec']} tok/s aggregate, {profile['memory_bytes']} bytes "
+                f"({profile['trials']} trials)"
+            )
+            results.append(result)
+    finally:
+        await close_async_http_client()
+
+    if not results:
+        return 1
+    if args.dry_run:
+        return 0
+    write_tuned_config(results, args.output)
+    print(f"Profile written to {args.output}")
+    parallel = max(result.best.parallel for result in results)
+    if parallel > 1:
+        print(f"Start Ollama with OLLAMA_NUM_PARALLEL>={parallel} to serve the concurrency measured here")
+    return 0
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Tune Ollama runtime parameters for this node")
+    parser.add_argument("--model", action="append", help="Model to tune (repeatable; default: preload_models)")
+    parser.add_argument("--url", default=None, help="Ollama server (default: OLLAMA_URL)")
+    parser.add_argument("--output", default=TUNED_CONFIG_PATH, help="Node-local profile file")
+    parser.add_argument("--num-thread", dest="num_thread", type=_int_list, help="Comma-separated values")
+    parser.add_argument("--num-batch", dest="num_batch", type=_int_list, help="Comma-separated values")
+    parser.add_argument("--num-ctx", dest="num_ctx", type=_int_list, help="Comma-separated values")
+    parser.add_argument("--parallel", type=_int_list, help="Comma-separated concurrent request counts")
+    parser.add_argument("--max-tokens", type=int, default=TUNER_MAX_TOKENS, help="Tokens generated per prompt")
+    parser.add_argument("--tolerance", type=float, default=TUNER_TOLERANCE, help="Throughput kept for a larger num_ctx")
+    parser.add_argument("--exhaustive", action="store_true", help="Try every combination instead of one axis at a time")
+    parser.add_argument("--dry-run", action="store_true", help="Measure without writing the profile")
+    return asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
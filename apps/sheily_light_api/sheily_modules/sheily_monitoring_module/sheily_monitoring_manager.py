@@ -166,6 +166,22 @@ class SheilyMonitoringManager:
             self.logger.error(f"Error getting current metrics: {str(e)}")
             return {"error": str(e)}
 
+    def get_load(self) -> Dict[str, float]:
+        """Uso actual de CPU y memoria (lectura instantánea, sin intervalo de muestreo)"""
+        try:
+            return {"cpu_percent": psutil.cpu_percent(), "memory_percent": psutil.virtual_memory().percent}
+        except Exception as e:
+            self.logger.error(f"Error reading system load: {str(e)}")
+            return {"cpu_percent": 0.0, "memory_percent": 0.0}
+
+    def is_memory_pressure(self) -> bool:
+        """Indica si el uso de memoria supera el umbral de alerta"""
+        try:
+            return psutil.virtual_memory().percent > self.alert_thresholds["memory_percent"]
+        except Exception as e:
+            self.logger.error(f"Error reading memory usage: {str(e)}")
+            return False
+
     def get_metrics_history(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
         """Obtiene el historial de métricas"""
         history = self.metrics_history
@@ -0,0 +1,518 @@
+"""Índice vectorial del nodo: embeddings en una matriz mapeada en memoria con búsqueda top-k.
+
+Ficheros del directorio del índice:
+
+- ``index.json``: dimensión y tipo de almacenamiento (``float32`` o ``int8``).
+- ``vectors.bin``: matriz append-only (filas x dimensión) mapeada en memoria; con
+  ``int8`` cada fila se cuantiza con su propia escala, guardada en ``scales.bin``.
+- ``entries.jsonl``: registro append-only de altas (fila, id, espacio de nombres,
+  metadatos) y bajas. Una fila solo existe cuando su alta está en el registro, así
+  que un vector escrito sin registrar (caída a medias) se descarta al abrir.
+
+Las bajas dejan una lápida; ``compact`` reescribe los ficheros sin ellas cuando
+superan ``compact_ratio`` de las filas. Con ``nlist`` > 0 las filas se reparten en
+particiones IVF (k-means sobre los vectores) y la búsqueda solo recorre las
+``nprobe`` particiones más cercanas a la consulta.
+
+Varios workers de uvicorn pueden abrir el mismo directorio con ``read_only=True``:
+comparten las páginas del mapeo y ``refresh`` (automático en cada búsqueda) recoge
+lo que añada el proceso escritor. Con ``shared=True`` el índice también se abre de
+solo lectura, pero cualquier proceso puede escribir: cada escritura toma el cerrojo
+``index.lock`` (``flock``), incorpora antes lo escrito por los demás y solo mientras
+lo tiene se permiten altas, bajas y compactaciones.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin cerrojo entre procesos, un solo worker
+    fcntl = None
+
+logger = logging.getLogger("sheily_vector_index")
+
+VECTOR_NPROBE = int(os.getenv("SHEILY_VECTOR_NPROBE", "4"))
+VECTOR_COMPACT_RATIO = float(os.getenv("SHEILY_VECTOR_COMPACT_RATIO", "0.3"))
+# Filas por partición necesarias para entrenar el IVF
+IVF_MIN_ROWS_PER_LIST = 16
+IVF_ITERATIONS = 10
+# Filas por bloque al puntuar, para acotar la memoria al descuantizar
+_CHUNK_ROWS = 65536
+_DTYPES = {"float32": np.float32, "int8": np.int8}
+
+
+@dataclass
+class VectorHit:
+    """Resultado de una búsqueda."""
+
+    id: str
+    score: float
+    meta: Dict[str, Any]
+
+
+def normalize(vector: Sequence[float]) -> Optional[np.ndarray]:
+    """Vector float32 de norma 1 (None si es nulo), para que el producto escalar sea el coseno."""
+    array = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(array))
+    return array / norm if norm else None
+
+
+class SheilyVectorIndex:
+    """Almacén de embeddings append-only con búsqueda top-k por coseno."""
+
+    def __init__(
+        self,
+        path: str,
+        dtype: str = "float32",
+        nlist: int = 0,
+        nprobe: int = VECTOR_NPROBE,
+        read_only: bool = False,
+        compact_ratio: float = VECTOR_COMPACT_RATIO,
+        shared: bool = False,
+    ):
+        if dtype not in _DTYPES:
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        self.path = Path(path)
+        self.dtype = dtype
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.shared = shared
+        # Compartido: solo se escribe con el cerrojo tomado (ver ``_writing``)
+        self.read_only = read_only or shared
+        self.compact_ratio = compact_ratio
+        self._writer_depth = 0
+        self.dim: Optional[int] = None
+        self.vectors_file = self.path / "vectors.bin"
+        self.scales_file = self.path / "scales.bin"
+        self.entries_file = self.path / "entries.jsonl"
+        self.meta_file = self.path / "index.json"
+        self.centroids_file = self.path / "centroids.npy"
+        self.lock_file = self.path / "index.lock"
+        self._reset()
+        self._load()
+
+    # ------------------------------------------------------------------
+    # API pública
+    # ------------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return self._count - self._deleted
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._rows
+
+    def ids(self) -> List[str]:
+        """Ids vivos en orden de inserción."""
+        return [id for id in self._ids if id is not None]
+
+    def get(self, id: str) -> Optional[Dict[str, Any]]:
+        row = self._rows.get(id)
+        return None if row is None else self._meta[row]
+
+    def count(self, namespace: str) -> int:
+        """Vectores vivos de un espacio de nombres."""
+        return self._ns_live[namespace]
+
+    def add(self, id: str, vector: Sequence[float], meta: Optional[Dict[str, Any]] = None, namespace: str = "") -> None:
+        """Añade (o reemplaza) un vector; se normaliza antes de guardarlo."""
+        self.add_many([id], [vector], [meta or {}], namespace)
+
+    def add_many(
+        self,
+        ids: Sequence[str],
+        vectors: Sequence[Sequence[float]],
+        metas: Optional[Sequence[Dict[str, Any]]] = None,
+        namespace: str = "",
+    ) -> None:
+        """Añade varios vectores con una sola escritura por fichero."""
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2 or len(matrix) != len(ids):
+            raise ValueError("Expected one vector per id")
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+        with self._writing():
+            self._add_rows(ids, matrix, metas, namespace)
+
+    def _add_rows(
+        self, ids: Sequence[str], matrix: np.ndarray, metas: Optional[Sequence[Dict[str, Any]]], namespace: str
+    ) -> None:
+        if self.dim is None:
+            self._create(matrix.shape[1])
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(f"Vector dimension {matrix.shape[1]} does not match index dimension {self.dim}")
+
+        for id in ids:
+            if id in self._rows:
+                self.delete(id)
+
+        with open(self.vectors_file, "ab") as f:
+            if self.dtype == "int8":
+                scales = np.abs(matrix).max(axis=1) / 127
+                scales[scales == 0] = 1
+                f.write(np.round(matrix / scales[:, None]).astype(np.int8).tobytes())
+                with open(self.scales_file, "ab") as s:
+                    s.write(scales.astype(np.float32).tobytes())
+            else:
+                f.write(matrix.tobytes())
+
+        metas = metas or [{}] * len(ids)
+        lines = []
+        for offset, (id, meta) in enumerate(zip(ids, metas)):
+            row = self._count + offset
+            lines.append({"op": "add", "row": row, "id": id, "ns": namespace, "meta": meta})
+        self._append_log(lines)
+        first = self._count
+        for record in lines:
+            self._apply(record)
+        if self._centroids is not None:
+            self._lists[first : self._count] = np.argmax(matrix @ self._centroids.T, axis=1)
+        elif self.nlist and len(self) >= self.nlist * IVF_MIN_ROWS_PER_LIST:
+            self.train_ivf()
+
+    def delete(self, id: str) -> bool:
+        """Marca el vector como borrado; el espacio se recupera al compactar."""
+        with self._writing():
+            if id not in self._rows:
+                return False
+            record = {"op": "del", "id": id}
+            self._append_log([record])
+            self._apply(record)
+            if self._deleted > self.compact_ratio * self._count:
+                self.compact()
+            return True
+
+    def search(self, query: Sequence[float], k: int = 10, namespace: Optional[str] = None) -> List[VectorHit]:
+        """Los ``k`` vectores más similares a ``query`` (coseno), opcionalmente dentro de un espacio de nombres."""
+        return self.search_batch([query], k, namespace)[0]
+
+    def search_batch(
+        self, queries: Sequence[Sequence[float]], k: int = 10, namespace: Optional[str] = None
+    ) -> List[List[VectorHit]]:
+        """Búsqueda top-k de varias consultas con un único producto matricial."""
+        self.refresh()
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.dim is None or not len(self) or queries.shape[-1] != self.dim:
+            return [[] for _ in range(len(queries))]
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+
+        valid = self._alive[: self._count].copy()
+        if namespace is not None:
+            ns = self._namespace_ids.get(namespace)
+            if ns is None:
+                return [[] for _ in range(len(queries))]
+            valid &= self._ns[: self._count] == ns
+
+        if self._centroids is None:
+            rows = np.flatnonzero(valid)
+            return [self._top_k(rows, column, k) for column in self._scores(rows, queries).T]
+
+        results = []
+        for query in queries:
+            probe = np.argsort(self._centroids @ query)[-self.nprobe :]
+            rows = np.flatnonzero(valid & np.isin(self._lists[: self._count], probe))
+            results.append(self._top_k(rows, self._scores(rows, query[None, :])[:, 0], k))
+        return results
+
+    def train_ivf(self, nlist: Optional[int] = None) -> None:
+        """Entrena las particiones IVF con k-means esférico sobre las filas vivas."""
+        with self._writing():
+            self._train_ivf(nlist)
+
+    def _train_ivf(self, nlist: Optional[int]) -> None:
+        nlist = nlist or self.nlist
+        rows = np.flatnonzero(self._alive[: self._count])
+        if not nlist or len(rows) < nlist:
+            return
+        data = self._dense(rows)
+        rng = np.random.default_rng(0)
+        centroids = data[rng.choice(len(rows), nlist, replace=False)]
+        for _ in range(IVF_ITERATIONS):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = data[assign == c]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[c] = centroid / (np.linalg.norm(centroid) or 1)
+        self.nlist = nlist
+        self._centroids = centroids.astype(np.float32)
+        np.save(self.centroids_file, self._centroids)
+        self._assign_lists()
+        logger.info(f"Vector index {self.path} trained IVF with {nlist} lists over {len(rows)} rows")
+
+    def compact(self) -> None:
+        """Reescribe los ficheros sin las filas borradas."""
+        with self._writing():
+            self._compact()
+
+    def _compact(self) -> None:
+        rows = np.flatnonzero(self._alive[: self._count])
+        self._map()
+        matrix = np.array(self._matrix[rows]) if len(rows) else np.empty((0, self.dim or 0), _DTYPES[self.dtype])
+        scales = np.array(self._scales[rows]) if self._scales is not None and len(rows) else None
+        records = [
+            {
+                "op": "add",
+                "row": new_row,
+                "id": self._ids[row],
+                "ns": self._ns_names[self._ns[row]],
+                "meta": self._meta[row],
+            }
+            for new_row, row in enumerate(rows)
+        ]
+        tmp = {path: path.with_suffix(path.suffix + ".tmp") for path in (self.vectors_file, self.entries_file)}
+        tmp[self.vectors_file].write_bytes(matrix.tobytes())
+        with open(tmp[self.entries_file], "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if scales is not None:
+            tmp[self.scales_file] = self.scales_file.with_suffix(".bin.tmp")
+            tmp[self.scales_file].write_bytes(scales.astype(np.float32).tobytes())
+        # El registro se reemplaza el último: los lectores recargan al ver que cambió
+        for path in (self.vectors_file, self.scales_file, self.entries_file):
+            if path in tmp:
+                os.replace(tmp[path], path)
+        removed = self._deleted
+        self._reset(keep_centroids=True)
+        self._load()
+        if self.nlist:
+            self.train_ivf()
+        logger.info(f"Vector index {self.path} compacted, {removed} deleted rows removed")
+
+    def refresh(self) -> None:
+        """Incorpora lo que otro proceso haya añadido o borrado desde la última lectura."""
+        if not self.read_only:
+            return
+        try:
+            stat = os.stat(self.entries_file)
+        except FileNotFoundError:
+            if self._count:
+                # Vaciado por otro proceso
+                self._reset()
+                self.dim = None
+            return
+        if stat.st_ino != self._log_inode or stat.st_size < self._log_offset:
+            # Compactado o recreado por el escritor
+            self._reset()
+            self._load()
+        elif stat.st_size > self._log_offset:
+            self._read_log()
+            if self._centroids is not None:
+                self._assign_lists()
+
+    def flush(self) -> None:
+        """Las escrituras van directas a los ficheros; no hay nada que sincronizar."""
+
+    def clear(self) -> None:
+        """Borra el índice en memoria y en disco."""
+        with self._writing():
+            for path in (self.vectors_file, self.scales_file, self.entries_file, self.meta_file, self.centroids_file):
+                if path.exists():
+                    path.unlink()
+            self._reset()
+            self.dim = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rows": self._count,
+            "live": len(self),
+            "deleted": self._deleted,
+            "dim": self.dim,
+            "dtype": self.dtype,
+            "ivf_lists": 0 if self._centroids is None else len(self._centroids),
+            "bytes": self._count * (self.dim or 0) * np.dtype(_DTYPES[self.dtype]).itemsize,
+        }
+
+    # ------------------------------------------------------------------
+    # Internos
+    # ------------------------------------------------------------------
+
+    def _reset(self, keep_centroids: bool = False) -> None:
+        self._count = 0
+        self._deleted = 0
+        self._ids: List[Optional[str]] = []
+        self._meta: List[Optional[Dict[str, Any]]] = []
+        self._rows: Dict[str, int] = {}
+        self._alive = np.zeros(0, dtype=bool)
+        self._ns = np.zeros(0, dtype=np.int32)
+        self._lists = np.zeros(0, dtype=np.int32)
+        self._namespace_ids: Dict[str, int] = {}
+        self._ns_names: List[str] = []
+        self._ns_live: Counter = Counter()
+        self._matrix: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        self._mapped_rows = 0
+        self._log_offset = 0
+        self._log_inode = None
+        if not keep_centroids:
+            self._centroids: Optional[np.ndarray] = None
+
+    def _load(self) -> None:
+        if self.meta_file.exists():
+            info = json.loads(self.meta_file.read_text(encoding="utf-8"))
+            self.dim = info["dim"]
+            if info["dtype"] != self.dtype:
+                logger.info(f"Vector index {self.path} stored as {info['dtype']}, using it instead of {self.dtype}")
+                self.dtype = info["dtype"]
+        if self.entries_file.exists():
+            self._read_log()
+        if not self.read_only and self.dim is not None:
+            self._truncate_unlogged()
+        if self.centroids_file.exists() and self._count:
+            self._centroids = np.load(self.centroids_file)
+            self._assign_lists()
+
+    def _read_log(self) -> None:
+        with open(self.entries_file, "r", encoding="utf-8") as f:
+            self._log_inode = os.fstat(f.fileno()).st_ino
+            f.seek(self._log_offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # línea a medio escribir: se leerá en el próximo refresh
+                self._apply(json.loads(line))
+                self._log_offset += len(line.encode("utf-8"))
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        if record["op"] == "del":
+            row = self._rows.pop(record["id"], None)
+            if row is not None:
+                self._alive[row] = False
+                self._ids[row] = None
+                self._meta[row] = None
+                self._deleted += 1
+                self._ns_live[self._ns_names[self._ns[row]]] -= 1
+            return
+        row = record["row"]
+        self._grow(row + 1)
+        ns = self._namespace_ids.setdefault(record["ns"], len(self._namespace_ids))
+        if ns == len(self._ns_names):
+            self._ns_names.append(record["ns"])
+        self._ids.append(record["id"])
+        self._meta.append(record["meta"])
+        self._rows[record["id"]] = row
+        self._alive[row] = True
+        self._ns[row] = ns
+        self._ns_live[record["ns"]] += 1
+        self._count = row + 1
+
+    def _grow(self, rows: int) -> None:
+        if rows <= len(self._alive):
+            return
+        capacity = max(rows, 2 * len(self._alive), 1024)
+        for name in ("_alive", "_ns", "_lists"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[: len(old)] = old
+            setattr(self, name, new)
+
+    def _append_log(self, records: List[Dict[str, Any]]) -> None:
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        with open(self.entries_file, "a", encoding="utf-8") as f:
+            f.write(data)
+            self._log_inode = os.fstat(f.fileno()).st_ino
+        self._log_offset += len(data.encode("utf-8"))
+
+    def _create(self, dim: int) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.meta_file.write_text(json.dumps({"dim": dim, "dtype": self.dtype}), encoding="utf-8")
+
+    def _truncate_unlogged(self) -> None:
+        """Descarta vectores escritos tras la última alta registrada."""
+        itemsize = np.dtype(_DTYPES[self.dtype]).itemsize
+        for path, size in ((self.vectors_file, self._count * self.dim * itemsize), (self.scales_file, self._count * 4)):
+            if path == self.scales_file and self.dtype != "int8":
+                continue
+            if path.exists() and path.stat().st_size > size:
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+
+    def _map(self) -> None:
+        if self._mapped_rows == self._count:
+            return
+        dtype = _DTYPES[self.dtype]
+        self._matrix = np.memmap(self.vectors_file, dtype=dtype, mode="r", shape=(self._count, self.dim))
+        if self.dtype == "int8":
+            self._scales = np.memmap(self.scales_file, dtype=np.float32, mode="r", shape=(self._count,))
+        self._mapped_rows = self._count
+
+    def _dense(self, rows: np.ndarray) -> np.ndarray:
+        """Filas como float32 (descuantizadas si hace falta)."""
+        self._map()
+        block = np.asarray(self._matrix[rows], dtype=np.float32)
+        if self._scales is not None:
+            block *= np.asarray(self._scales[rows])[:, None]
+        return block
+
+    def _scores(self, rows: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """Matriz (filas x consultas) de similitudes coseno."""
+        scores = np.empty((len(rows), len(queries)), dtype=np.float32)
+        for start in range(0, len(rows), _CHUNK_ROWS):
+            chunk = rows[start : start + _CHUNK_ROWS]
+            scores[start : start + len(chunk)] = self._dense(chunk) @ queries.T
+        return scores
+
+    def _top_k(self, rows: np.ndarray, scores: np.ndarray, k: int) -> List[VectorHit]:
+        if not len(rows):
+            return []
+        if len(rows) > k:
+            best = np.argpartition(-scores, k)[:k]
+        else:
+            best = np.arange(len(rows))
+        best = best[np.argsort(-scores[best])]
+        return [VectorHit(self._ids[rows[i]], float(scores[i]), self._meta[rows[i]]) for i in best]
+
+    def _assign_lists(self) -> None:
+        rows = np.arange(self._count)
+        for start in range(0, len(rows), _CHUNK_ROWS):
+            chunk = rows[start : start + _CHUNK_ROWS]
+            self._lists[chunk] = np.argmax(self._dense(chunk) @ self._centroids.T, axis=1)
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        """
+        Permite escribir durante el bloque.
+
+        En modo compartido toma el cerrojo del directorio (reentrante dentro del
+        proceso), se pone al día con lo escrito por otros procesos y descarta los
+        vectores sin registrar de una escritura interrumpida antes de añadir filas.
+        """
+        if not self.shared or self._writer_depth:
+            self._check_writable()
+            self._writer_depth += 1
+            try:
+                yield
+            finally:
+                self._writer_depth -= 1
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_file, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                self.read_only = False
+                self._writer_depth = 1
+                if self.dim is not None:
+                    self._truncate_unlogged()
+                yield
+            finally:
+                self._writer_depth = 0
+                self.read_only = True
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise PermissionError(f"Vector index {self.path} is open read-only")
@@ -1,19 +1,67 @@
-from typing import Dict, List
+import asyncio
+import json
+import os
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Literal, Optional, TypeVar, Union
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, WebSocket, status
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from sqlalchemy.orm import Session
 
 from sheily_light_api.core.database import get_db, get_db_dep
+from sheily_light_api.dependencies import get_current_user
 from sheily_light_api.models import User, ChatMessage
-from sheily_light_api.core.security import get_current_user
 from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_service import (
     chat_with_local_ai,
     get_chat_history,
+    stream_chat_with_local_ai,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_conversation import (
+    ConversationNotFound,
+    conversation_engine,
+    create_conversation,
+    get_conversation,
+    get_turns,
+    list_conversations,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.search_utils import web_search
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_documents import document_store
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_hedging import chat_hedger
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_intent import intent_classifier
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_persistence import chat_writer
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_response_cache import response_cache
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_retrieval import chat_retrieval
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_semantic_cache import semantic_cache
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_singleflight import inflight_requests
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_websocket import chat_sockets
+from sheily_light_api.sheily_modules.sheily_model_inference.embedding_service import embedding_service
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_options import generation_options
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_timings import (
+    GenerationTiming,
+    generation_metrics,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.model_residency import model_residency
+from sheily_light_api.sheily_modules.sheily_model_inference.model_router import model_router
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_backend_pool import (
+    OllamaUnavailable,
+    ollama_backends,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.inference_scheduler import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    InferenceQueueFull,
+    inference_scheduler,
 )
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
+T = TypeVar("T")
+
+# Cada cuánto se comprueba si el cliente sigue conectado mientras se espera la respuesta
+DISCONNECT_POLL_SECONDS = float(os.getenv("SHEILY_CHAT_DISCONNECT_POLL_SECONDS", "0.25"))
+# Código de nginx para "el cliente cerró la petición": nadie lo recibirá, pero queda en los logs de acceso
+HTTP_CLIENT_CLOSED_REQUEST = 499
+
 
 class ChatPrompt(BaseModel):
     message: str
@@ -21,17 +69,252 @@ class ChatPrompt(BaseModel):
 
 class ChatRequest(BaseModel):
     prompt: str
+    # Conversación multi-turno creada con POST /chat/conversations (opcional)
+    conversation_id: Optional[int] = None
+    # Las exportaciones y procesos por lotes ceden el paso a las peticiones interactivas
+    priority: Literal["interactive", "batch"] = "interactive"
+    # Latencia objetivo en ms: con el nodo cargado se usa un modelo más ligero que la cumpla
+    slo_ms: Optional[float] = Field(None, gt=0)
+
+
+_PRIORITIES = {"interactive": PRIORITY_INTERACTIVE, "batch": PRIORITY_BATCH}
+
+
+class ConversationCreate(BaseModel):
+    title: Optional[str] = None
+
+
+def _conversation_not_found() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+
+
+def _unavailable(e: Union[InferenceQueueFull, OllamaUnavailable]) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail={"error": str(e), "retry_after": e.retry_after},
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
 
+def _client_closed_request() -> HTTPException:
+    return HTTPException(status_code=HTTP_CLIENT_CLOSED_REQUEST, detail="Client closed request")
 
-@router.post("/local", response_model=Dict[str, str])
+
+async def _cancel_on_disconnect(request: Optional[Request], awaitable: Awaitable[T]) -> T:
+    """
+    Espera ``awaitable`` y lo cancela si el cliente se desconecta antes de que termine.
+
+    La cancelación baja hasta la petición HTTP a Ollama, que al cerrarse la conexión
+    deja de generar, y libera el hueco del modelo en el planificador.
+    """
+    task = asyncio.ensure_future(awaitable)
+    if request is None:
+        return await task
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if not task.done() and await request.is_disconnected():
+                raise _client_closed_request()
+        return task.result()
+    finally:
+        if not task.done():
+            task.cancel()
+            # Esperar a que la cancelación termine de propagarse (y se registre el abortado)
+            await asyncio.wait({task})
+
+
+async def _answer(
+    db: Session,
+    user: User,
+    prompt: str,
+    priority: int = PRIORITY_INTERACTIVE,
+    conversation_id: Optional[int] = None,
+    slo_ms: Optional[float] = None,
+    http_request: Optional[Request] = None,
+) -> Dict[str, Any]:
+    try:
+        response = await _cancel_on_disconnect(
+            http_request, chat_with_local_ai(db, user, prompt, priority, conversation_id, slo_ms)
+        )
+    except (InferenceQueueFull, OllamaUnavailable) as e:
+        raise _unavailable(e)
+    except ConversationNotFound:
+        raise _conversation_not_found()
+    if conversation_id is not None:
+        return {"answer": response, "conversation_id": conversation_id}
+    return {"answer": response}
+
+
+@router.post("/local", response_model=Dict[str, Any])
 async def chat_local(
     request: ChatRequest,
+    http_request: Request,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
-) -> Dict[str, str]:
-    """Send a chat message to the local AI and get a response."""
-    response = chat_with_local_ai(db, current_user, request.prompt)
-    return {"answer": response}
+) -> Dict[str, Any]:
+    """Send a chat message to the local AI and get a response; the generation is aborted if the client leaves."""
+    return await _answer(
+        db,
+        current_user,
+        request.prompt,
+        _PRIORITIES[request.priority],
+        request.conversation_id,
+        request.slo_ms,
+        http_request,
+    )
+
+
+def _sse_event(data: Dict[str, str], event: str = None) -> str:
+    """Formatea un evento Server-Sent Events."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _sse_chat_stream(
+    user: User, prompt: str, priority: int, conversation_id: Optional[int] = None, slo_ms: Optional[float] = None
+) -> AsyncIterator[str]:
+    parts = []
+    try:
+        async for token in stream_chat_with_local_ai(user, prompt, priority, conversation_id, slo_ms):
+            parts.append(token)
+            yield _sse_event({"token": token})
+    except OllamaUnavailable:
+        raise
+    except RuntimeError as e:
+        yield _sse_event({"detail": str(e)}, event="error")
+        return
+    yield _sse_event({"answer": "".join(parts).strip()}, event="done")
+
+
+@router.post("/local/stream")
+async def chat_local_stream(
+    request: ChatRequest,
+    http_request: Request,
+    current_user: User = Depends(get_current_user),
+) -> StreamingResponse:
+    """Stream the local AI answer token by token as Server-Sent Events."""
+    events = _sse_chat_stream(
+        current_user, request.prompt, _PRIORITIES[request.priority], request.conversation_id, request.slo_ms
+    )
+    try:
+        # Esperar al primer evento permite responder 503/404 antes de enviar las cabeceras del stream.
+        # Después, StreamingResponse cancela el generador si el cliente se desconecta.
+        first_event = await _cancel_on_disconnect(http_request, events.__anext__())
+    except (InferenceQueueFull, OllamaUnavailable) as e:
+        raise _unavailable(e)
+    except ConversationNotFound:
+        raise _conversation_not_found()
+
+    async def replay() -> AsyncIterator[str]:
+        yield first_event
+        async for event in events:
+            yield event
+
+    return StreamingResponse(
+        replay(),
+        media_type="text/event-stream",
+        # "identity" evita que GZipMiddleware acumule los eventos en su buffer
+        headers={"Cache-Control": "no-cache", "Content-Encoding": "identity", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/ws")
+async def chat_socket(websocket: WebSocket) -> None:
+    """Chat over a persistent WebSocket: authenticated once per connection, generations multiplexed by id."""
+    await chat_sockets.serve(websocket)
+
+
+@router.get("/metrics")
+def chat_metrics(user: User = Depends(get_current_user)) -> Dict[str, Any]:
+    """Operational counters of the chat pipeline."""
+    return {
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "single_flight": inflight_requests.stats(),
+        "scheduler": inference_scheduler.stats(),
+        "backends": ollama_backends.stats(),
+        "models": model_residency.stats(),
+        "model_router": model_router.stats(),
+        "generation_options": generation_options.stats(),
+        "timings": generation_metrics.stats(),
+        "conversations": conversation_engine.stats(),
+        "persistence": chat_writer.stats(),
+        "hedging": chat_hedger.stats(),
+        "websocket": chat_sockets.stats(),
+        "intent": intent_classifier.stats(),
+        "search": web_search.stats(),
+        "retrieval": chat_retrieval.stats(),
+        "documents": document_store.stats(),
+        "embeddings": embedding_service.stats(),
+    }
+
+
+@router.get("/timings")
+def generation_timings(model: Optional[str] = None, user: User = Depends(get_current_user)) -> Dict[str, Any]:
+    """Per-model histograms of time to first token, tokens/sec, model load and prompt evaluation."""
+    return generation_metrics.stats(model)
+
+
+@router.get("/timings/messages")
+def message_timings(
+    limit: int = Query(20, ge=1, le=200),
+    model: Optional[str] = None,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> List[Dict[str, Any]]:
+    """Latency breakdown of the current user's most recent locally generated answers."""
+    query = db.query(ChatMessage).filter(ChatMessage.user_id == user.id, ChatMessage.model.isnot(None))
+    if model is not None:
+        query = query.filter(ChatMessage.model == model)
+    messages = query.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit).all()
+    return [
+        {"id": m.id, "created_at": m.created_at.isoformat(), **GenerationTiming.from_row(m).to_dict()}
+        for m in messages
+    ]
+
+
+@router.post("/conversations", status_code=status.HTTP_201_CREATED)
+def new_conversation(
+    request: ConversationCreate,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> Dict[str, Any]:
+    """Start a multi-turn conversation."""
+    conversation = create_conversation(db, user, request.title)
+    return {"id": conversation.id, "title": conversation.title, "created_at": conversation.created_at.isoformat()}
+
+
+@router.get("/conversations")
+def conversations(
+    limit: int = 20,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> List[Dict[str, Any]]:
+    """List the current user's conversations, most recently active first."""
+    return [
+        {"id": c.id, "title": c.title, "updated_at": c.updated_at.isoformat()}
+        for c in list_conversations(db, user, limit)
+    ]
+
+
+@router.get("/conversations/{conversation_id}")
+def conversation_detail(
+    conversation_id: int,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> Dict[str, Any]:
+    """Get a conversation with its turns in order."""
+    conversation = get_conversation(db, user, conversation_id)
+    if conversation is None:
+        raise _conversation_not_found()
+    return {
+        "id": conversation.id,
+        "title": conversation.title,
+        "turns": [
+            {"prompt": t.prompt, "response": t.response, "created_at": t.created_at.isoformat()}
+            for t in get_turns(db, conversation_id)
+        ],
+    }
 
 
 @router.get("/history")
@@ -46,31 +329,33 @@ def history(
 
 
 @router.post("/")
-def chat_endpoint(
+async def chat_endpoint(
     prompt: ChatPrompt,
+    http_request: Request,
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db_dep),
 ) -> Dict[str, str]:
     """Main chat endpoint that forwards messages to the local AI."""
-    response = chat_with_local_ai(db, user, prompt.message)
-    return {"answer": response}
+    return await _answer(db, user, prompt.message, http_request=http_request)
 
 
 @router.post("/v1/chat")
-def chat_endpoint_alias(
+async def chat_endpoint_alias(
     prompt: ChatPrompt,
+    http_request: Request,
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db_dep),
 ) -> Dict[str, str]:
     """Alias for the main chat endpoint with v1 prefix."""
-    response = chat_with_local_ai(db, user, prompt.message)
-    return {"answer": response}  # Alias para compatibilidad: /api/chat/chat/
+    # Alias para compatibilidad: /api/chat/chat/
+    return await _answer(db, user, prompt.message, http_request=http_request)
 
 
 @router.post("/chat/")
-def chat_endpoint_alias(
+async def chat_endpoint_alias(
     prompt: ChatPrompt,
+    http_request: Request,
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db_dep),
 ):
-    return chat_endpoint(prompt, user, db)
+    return await chat_endpoint(prompt, http_request, user, db)
@@ -0,0 +1,71 @@
+from typing import Any, Dict, List
+
+import aiofiles
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+
+from sheily_light_api.dependencies import get_current_user
+from sheily_light_api.models import User
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_documents import (
+    INGEST_MAX_BYTES,
+    UnsupportedDocument,
+    document_store,
+)
+
+router = APIRouter(prefix="/documents", tags=["documents"])
+
+
+@router.post("", status_code=status.HTTP_202_ACCEPTED, response_model=Dict[str, Any])
+async def upload_document(
+    request: Request,
+    filename: str = Query(..., min_length=1),
+    current_user: User = Depends(get_current_user),
+) -> Dict[str, Any]:
+    """Upload a text or PDF file as the raw request body and start indexing it for the chat."""
+    try:
+        job = document_store.new_upload(current_user.id, filename)
+    except UnsupportedDocument as e:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=str(e))
+
+    # El cuerpo se escribe a disco según llega: nunca está entero en memoria
+    job.path.parent.mkdir(parents=True, exist_ok=True)
+    received = 0
+    try:
+        async with aiofiles.open(job.path, "wb") as f:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if received > INGEST_MAX_BYTES:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"Document larger than {INGEST_MAX_BYTES} bytes",
+                    )
+                await f.write(chunk)
+    except BaseException:
+        document_store.discard(job)
+        raise
+    if not received:
+        document_store.discard(job)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty document")
+
+    return document_store.start(job).to_dict()
+
+
+@router.get("/ingestions/{ingestion_id}", response_model=Dict[str, Any])
+def ingestion_status(ingestion_id: str, current_user: User = Depends(get_current_user)) -> Dict[str, Any]:
+    """Progress of a document ingestion."""
+    job = document_store.get_job(current_user.id, ingestion_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ingestion not found")
+    return job.to_dict()
+
+
+@router.get("", response_model=List[Dict[str, Any]])
+def list_documents(current_user: User = Depends(get_current_user)) -> List[Dict[str, Any]]:
+    """Indexed documents of the current user."""
+    return document_store.list_documents(current_user.id)
+
+
+@router.delete("/{document_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_document(document_id: str, current_user: User = Depends(get_current_user)) -> None:
+    """Remove a document from the chat context."""
+    if not document_store.delete_document(current_user.id, document_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Document not found")
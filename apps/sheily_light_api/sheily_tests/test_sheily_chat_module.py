@@ -1,2 +1,1591 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException, WebSocketDisconnect
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from sheily_light_api import dependencies
+from sheily_light_api.core import database
+from sheily_light_api.core.database import Base, get_db
+from sheily_light_api.dependencies import get_current_user
+from sheily_light_api.models import ChatMessage, TokenBalance, User
+from sheily_light_api.sheily_modules.sheily_chat_module import sheily_chat_local_engine, sheily_chat_service
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_conversation import (
+    ConversationNotFound,
+    SheilyConversationEngine,
+    conversation_engine,
+    create_conversation,
+    get_turns,
+    list_conversations,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.search_utils import SheilyWebSearch, StubSearchProvider
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_documents import (
+    SheilyDocumentStore,
+    chunk_text,
+    document_store,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_hedging import SheilyChatHedger, chat_hedger
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_intent import (
+    BENCHMARK_PROMPTS,
+    SheilyIntentClassifier,
+    benchmark,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_persistence import (
+    MESSAGE_ABORTED,
+    SheilyChatWriteBehind,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_retrieval import (
+    SheilyChatRetrieval,
+    chat_retrieval,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_response_cache import (
+    SheilyChatResponseCache,
+    response_cache,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_semantic_cache import (
+    SheilySemanticCache,
+    semantic_cache,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_singleflight import SheilyChatSingleFlight
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_service import (
+    chat_with_local_ai,
+    stream_chat_with_local_ai,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module import (
+    sheily_ai_health_monitor,
+    sheily_chat_updater,
+    sheily_chat_websocket,
+)
+from sheily_light_api.sheily_modules.sheily_chat_module.sheily_chat_websocket import (
+    WS_CLOSE_IDLE,
+    WS_CLOSE_UNAUTHORIZED,
+    SheilyChatSockets,
+)
+from sheily_light_api.sheily_modules.sheily_auth_module.sheily_jwt_manager import create_access_token
+from sheily_light_api.sheily_modules.sheily_model_inference.embedding_service import SheilyEmbeddingService
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_options import generation_options
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_timings import SheilyGenerationMetrics
+from sheily_light_api.sheily_modules.sheily_model_inference.inference_scheduler import (
+    InferenceQueueFull,
+    inference_scheduler,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.model_router import model_router
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_backend_pool import OllamaBackendPool
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import (
+    close_async_http_client,
+    init_async_http_client,
+)
+
+
 def test_placeholder():
     assert True
+
+
+@pytest.fixture(autouse=True)
+def clean_response_cache(monkeypatch):
+    """Vacía la caché de respuestas, desactiva la semántica, el historial y los documentos y el log del enrutador"""
+    monkeypatch.setattr(semantic_cache, "enabled", False)
+    monkeypatch.setattr(chat_retrieval, "enabled", False)
+    monkeypatch.setattr(document_store, "enabled", False)
+    monkeypatch.setattr(model_router, "log_path", None)
+    response_cache.clear()
+    yield
+    response_cache.clear()
+
+
+@pytest.fixture
+def db_session():
+    """Fixture que provee una base de datos SQLite en memoria con un usuario"""
+    # StaticPool: los hilos de la cola de escritura comparten la misma base en memoria
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    user = User(username="chatuser", hashed_password="x")
+    session.add(user)
+    session.commit()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def stream_session(db_session, monkeypatch):
+    """Hace que el guardado del streaming use la base de datos de prueba"""
+    test_sessions = sessionmaker(bind=db_session.get_bind())
+    monkeypatch.setattr(sheily_chat_service, "SessionLocal", test_sessions)
+    monkeypatch.setattr(database, "SessionLocal", test_sessions)
+    return db_session
+
+
+@pytest.fixture
+def ollama_calls():
+    """Lista donde el Ollama simulado registra los cuerpos recibidos"""
+    return []
+
+
+def _fake_ollama_transport(calls):
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        calls.append(body)
+        if body.get("stream"):
+            words = ["respuesta ", "a ", body["prompt"]]
+            lines = [json.dumps({"response": w, "done": False}) for w in words]
+            lines.append(json.dumps({"response": "", "done": True}))
+            return httpx.Response(200, content="\n".join(lines).encode())
+        return httpx.Response(200, json={"response": f"  respuesta a {body['prompt']}  ", "done": True})
+
+    return httpx.MockTransport(handler)
+
+
+def _run_with_fake_ollama(calls, coro_factory):
+    async def scenario():
+        await init_async_http_client(transport=_fake_ollama_transport(calls))
+        try:
+            return await coro_factory()
+        finally:
+            await close_async_http_client()
+
+    return asyncio.run(scenario())
+
+
+def test_chat_with_local_ai_persists_message(db_session, ollama_calls):
+    """Test que verifica que el chat asíncrono responde y guarda la conversación"""
+    user = db_session.query(User).first()
+
+    answer = _run_with_fake_ollama(ollama_calls, lambda: chat_with_local_ai(db_session, user, "Cuéntame un chiste"))
+
+    assert answer == "respuesta a Cuéntame un chiste"
+    stored = db_session.query(ChatMessage).filter(ChatMessage.user_id == user.id).all()
+    assert len(stored) == 1
+    assert stored[0].response == answer
+
+
+def test_cache_hit_does_not_count_a_routing_decision(db_session, ollama_calls):
+    """Test que verifica que una respuesta servida desde la caché no pasa por el enrutador de modelos"""
+    user = db_session.query(User).first()
+
+    async def ask_twice():
+        await chat_with_local_ai(db_session, user, "Cuéntame un chiste")
+        before = sum(model_router.decisions.values())
+        await chat_with_local_ai(db_session, user, "Cuéntame un chiste")
+        return sum(model_router.decisions.values()) - before
+
+    assert _run_with_fake_ollama(ollama_calls, ask_twice) == 0
+    assert len(ollama_calls) == 1
+
+
+def test_ask_local_ai_selects_code_model(ollama_calls):
+    """Test que verifica la selección del modelo de código"""
+    _run_with_fake_ollama(ollama_calls, lambda: sheily_chat_local_engine.ask_local_ai("tengo un traceback en python"))
+
+    assert ollama_calls[0]["model"] == sheily_chat_local_engine.CODE_MODEL
+
+
+def test_stream_chat_persists_after_completion(stream_session, ollama_calls):
+    """Test que verifica que el streaming entrega tokens y guarda la respuesta completa"""
+    user = stream_session.query(User).first()
+
+    async def consume():
+        return [token async for token in stream_chat_with_local_ai(user, "hola")]
+
+    tokens = _run_with_fake_ollama(ollama_calls, consume)
+
+    assert tokens == ["respuesta ", "a ", "hola"]
+    stored = stream_session.query(ChatMessage).filter(ChatMessage.user_id == user.id).one()
+    assert stored.response == "respuesta a hola"
+
+
+def test_stream_route_emits_server_sent_events(stream_session, ollama_calls):
+    """Test que verifica el endpoint SSE /chat/local/stream"""
+    from sheily_light_api.sheily_routers.sheily_chat_router import router
+
+    user = stream_session.query(User).first()
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[get_current_user] = lambda: user
+
+    async def post_stream():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.post("/chat/local/stream", json={"prompt": "hola"})
+
+    response = _run_with_fake_ollama(ollama_calls, post_stream)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [block for block in response.text.split("\n\n") if block]
+    assert json.loads(events[0].split("data: ", 1)[1]) == {"token": "respuesta "}
+    assert events[-1].startswith("event: done")
+    assert json.loads(events[-1].split("data: ", 1)[1]) == {"answer": "respuesta a hola"}
+
+
+def test_response_cache_normalizes_and_bypasses():
+    """Test que verifica la clave normalizada y la exclusión de prompts en tiempo real"""
+    cache = SheilyChatResponseCache()
+
+    assert cache.key_for("¿Qué puedes hacer?", "llama3") == cache.key_for("  qué   PUEDES hacer ", "llama3")
+    assert cache.key_for("¿Qué puedes hacer?", "llama3") != cache.key_for("¿Qué puedes hacer?", "otro")
+    assert cache.key_for("qué puedes hacer", "llama3", {"temperature": 0.1}) != cache.key_for(
+        "qué puedes hacer", "llama3"
+    )
+    assert cache.key_for("¿cuál es el precio del bitcoin hoy?", "llama3") is None
+    assert cache.stats()["bypassed"] == 1
+
+
+def test_response_cache_lru_and_ttl():
+    """Test que verifica la expulsión LRU y la caducidad por TTL"""
+    now = [0.0]
+    cache = SheilyChatResponseCache(max_entries=2, ttl=10, clock=lambda: now[0])
+
+    async def scenario():
+        await cache.set("a", "A")
+        await cache.set("b", "B")
+        assert await cache.get("a") == "A"  # "a" pasa a ser la más reciente
+        await cache.set("c", "C")  # expulsa "b"
+        assert await cache.get("b") is None
+        now[0] = 11
+        assert await cache.get("a") is None
+
+    asyncio.run(scenario())
+
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+
+def test_repeated_prompt_served_from_cache(db_session, ollama_calls):
+    """Test que verifica que una pregunta repetida no vuelve a llamar al modelo"""
+    user = db_session.query(User).first()
+
+    async def ask_twice():
+        first = await chat_with_local_ai(db_session, user, "¿Qué puedes hacer?")
+        second = await chat_with_local_ai(db_session, user, "qué puedes hacer")
+        return first, second
+
+    first, second = _run_with_fake_ollama(ollama_calls, ask_twice)
+
+    assert first == second
+    assert len(ollama_calls) == 1
+    assert db_session.query(ChatMessage).filter(ChatMessage.user_id == user.id).count() == 2
+
+
+
+def test_generation_options_are_sent_and_part_of_the_cache_key(db_session, ollama_calls, monkeypatch):
+    """Test que verifica que las opciones del usuario llegan a Ollama y que cambiarlas no reutiliza la caché"""
+    user = db_session.query(User).first()
+    ai = {"temperature": 0.2, "max_tokens": 128}
+    monkeypatch.setattr(generation_options, "_user_config", lambda: ai)
+
+    async def ask_with_two_limits():
+        await chat_with_local_ai(db_session, user, "¿Qué puedes hacer?")
+        await chat_with_local_ai(db_session, user, "¿Qué puedes hacer?")
+        ai["max_tokens"] = 512
+        await chat_with_local_ai(db_session, user, "¿Qué puedes hacer?")
+
+    _run_with_fake_ollama(ollama_calls, ask_with_two_limits)
+
+    assert [call["options"]["num_predict"] for call in ollama_calls] == [128, 512]
+    assert ollama_calls[0]["options"]["temperature"] == 0.2
+
+
+def _timed_ollama(request: httpx.Request) -> httpx.Response:
+    """Ollama simulado que devuelve los tiempos de la generación"""
+    body = json.loads(request.content)
+    durations = {
+        "total_duration": 1_500_000_000,
+        "load_duration": 1_000_000_000,
+        "prompt_eval_count": 12,
+        "prompt_eval_duration": 100_000_000,
+        "eval_count": 40,
+        "eval_duration": 400_000_000,
+    }
+    return httpx.Response(200, json={"response": f"respuesta a {body['prompt']}", "done": True, **durations})
+
+
+def test_generation_timings_are_persisted_aggregated_and_queryable(db_session, monkeypatch):
+    """Test que verifica que los tiempos de Ollama se guardan con el mensaje, se agregan y se consultan por API"""
+    from sheily_light_api.sheily_routers.sheily_chat_router import router
+
+    metrics = SheilyGenerationMetrics()
+    monkeypatch.setattr(sheily_chat_local_engine, "generation_metrics", metrics)
+    user = db_session.query(User).first()
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[get_current_user] = lambda: user
+    app.dependency_overrides[get_db] = lambda: db_session
+
+    async def ask_twice_and_query():
+        await chat_with_local_ai(db_session, user, "Cuéntame un chiste")
+        # La segunda se sirve de la caché: no hay generación que desglosar
+        await chat_with_local_ai(db_session, user, "Cuéntame un chiste")
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.get("/chat/timings/messages")
+
+    response = _run_with_fake_ollama_handler(_timed_ollama, ask_twice_and_query)
+
+    stored = db_session.query(ChatMessage).order_by(ChatMessage.id).all()
+    assert [m.model for m in stored] == ["llama3", None]
+    assert (stored[0].load_ms, stored[0].prompt_eval_ms, stored[0].eval_count) == (1000.0, 100.0, 40)
+
+    assert response.status_code == 200
+    [timing] = response.json()
+    assert timing["ttft_ms"] == 1100.0
+    assert timing["tokens_per_sec"] == 100.0
+
+    llama3 = metrics.stats()["llama3"]
+    assert llama3["generations"] == 1
+    assert llama3["load_ms"]["buckets"]["1000"] == 1
+    assert llama3["share"]["load"] == pytest.approx(1000 / 1500)
+
+
+def test_metrics_and_timings_require_authentication(db_session):
+    """Test que verifica que las métricas y los tiempos exigen un JWT válido"""
+    from sheily_light_api.sheily_routers.sheily_chat_router import router
+
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[dependencies.get_db_dep] = lambda: db_session
+    app.dependency_overrides[get_db] = lambda: db_session
+    headers = {"Authorization": f"Bearer {create_access_token('chatuser')}"}
+    paths = ["/chat/metrics", "/chat/timings", "/chat/timings/messages"]
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            anonymous = [(await client.get(path)).status_code for path in paths]
+            authorized = [(await client.get(path, headers=headers)).status_code for path in paths]
+            return anonymous, authorized
+
+    anonymous, authorized = asyncio.run(scenario())
+
+    assert anonymous == [401, 401, 401]
+    assert authorized == [200, 200, 200]
+
+
+# Vectores de juguete: los prompts sobre el mismo tema comparten dirección
+_TOPIC_VECTORS = {"tiempo": [1.0, 0.0, 0.0], "receta": [0.0, 1.0, 0.0]}
+
+
+def _run_with_fake_embeddings(coro_factory):
+    def vector(prompt):
+        return next((v for topic, v in _TOPIC_VECTORS.items() if topic in prompt), [0.0, 0.0, 1.0])
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        inputs = json.loads(request.content)["input"]
+        return httpx.Response(200, json={"embeddings": [vector(prompt) for prompt in inputs]})
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            return await coro_factory()
+        finally:
+            await close_async_http_client()
+
+    return asyncio.run(scenario())
+
+
+def _semantic_cache(tmp_path, capacity):
+    embedder = SheilyEmbeddingService(cache_path=str(tmp_path / "embeddings.sqlite"))
+    return SheilySemanticCache(cache_dir=str(tmp_path / "cache"), capacity=capacity, threshold=0.9, embedder=embedder)
+
+
+def test_semantic_cache_matches_paraphrases_per_model(tmp_path):
+    """Test que verifica que un prompt parafraseado reutiliza la respuesta del mismo modelo"""
+    cache = _semantic_cache(tmp_path, capacity=8)
+
+    async def scenario():
+        await cache.store("dime el tiempo en Madrid", "llama3", "Soleado")
+        same = await cache.lookup("¿qué tiempo hace en Madrid?", "llama3")
+        other_model = await cache.lookup("¿qué tiempo hace en Madrid?", "deepseek-coder:latest")
+        other_topic = await cache.lookup("una receta de tortilla", "llama3")
+        return same, other_model, other_topic
+
+    same, other_model, other_topic = _run_with_fake_embeddings(scenario)
+
+    assert same.answer == "Soleado"
+    assert same.score == pytest.approx(1.0)
+    assert other_model.answer is None
+    assert other_topic.answer is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_semantic_cache_persists_and_evicts(tmp_path):
+    """Test que verifica la persistencia en disco y la expulsión LRU"""
+    cache = _semantic_cache(tmp_path, capacity=2)
+
+    async def fill():
+        await cache.store("el tiempo en Madrid", "llama3", "Lluvia")
+        await cache.store("una receta", "llama3", "Tortilla")
+        await cache.store("otra cosa", "llama3", "Nada")  # expulsa "el tiempo"
+        cache.flush()
+
+    _run_with_fake_embeddings(fill)
+    assert cache.stats()["evictions"] == 1
+
+    reloaded = _semantic_cache(tmp_path, capacity=2)
+
+    async def lookups():
+        return (
+            await reloaded.lookup("dame una receta", "llama3"),
+            await reloaded.lookup("el tiempo", "llama3"),
+        )
+
+    recipe, weather = _run_with_fake_embeddings(lookups)
+
+    assert recipe.answer == "Tortilla"
+    assert weather.answer is None
+    assert reloaded.stats()["entries"] == 2
+
+
+def test_semantic_cache_runs_the_index_off_the_event_loop(tmp_path, monkeypatch):
+    """Test que verifica que las búsquedas, altas y refrescos del índice no se ejecutan en el event loop"""
+    from sheily_light_api.sheily_modules.sheily_vector_store.sheily_vector_index import SheilyVectorIndex
+
+    on_loop = []
+    for name in ("search", "add", "refresh"):
+        original = getattr(SheilyVectorIndex, name)
+
+        def spy(self, *args, _original=original, _name=name, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(_name)
+            except RuntimeError:
+                pass
+            return _original(self, *args, **kwargs)
+
+        monkeypatch.setattr(SheilyVectorIndex, name, spy)
+    cache = _semantic_cache(tmp_path, capacity=8)
+
+    async def scenario():
+        await cache.store("dime el tiempo en Madrid", "llama3", "Soleado")
+        return await cache.lookup("¿qué tiempo hace en Madrid?", "llama3")
+
+    assert _run_with_fake_embeddings(scenario).answer == "Soleado"
+    assert on_loop == []
+
+
+def test_single_flight_runs_identical_requests_once():
+    """Test que verifica que las peticiones simultáneas con la misma clave comparten resultado"""
+    flights = SheilyChatSingleFlight()
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "respuesta"
+
+    async def scenario():
+        return await asyncio.gather(*(flights.do("k", generate) for _ in range(3)))
+
+    assert asyncio.run(scenario()) == ["respuesta"] * 3
+    assert len(calls) == 1
+    assert flights.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 2}
+
+
+def test_single_flight_stream_fans_out_tokens():
+    """Test que verifica que un suscriptor tardío recibe el flujo completo desde el principio"""
+    flights = SheilyChatSingleFlight()
+    started = []
+
+    async def source():
+        started.append(1)
+        for token in ["a", "b", "c"]:
+            yield token
+            await asyncio.sleep(0.01)
+
+    async def consume(delay):
+        await asyncio.sleep(delay)
+        return [token async for token in flights.stream("k", source)]
+
+    async def scenario():
+        return await asyncio.gather(consume(0), consume(0.015))
+
+    first, late = asyncio.run(scenario())
+
+    assert first == late == ["a", "b", "c"]
+    assert len(started) == 1
+    assert flights.stats()["coalesced"] == 1
+
+
+def test_single_flight_cancels_when_all_waiters_leave():
+    """Test que verifica que la generación se aborta solo cuando no queda nadie esperando"""
+    flights = SheilyChatSingleFlight()
+    cancelled = []
+
+    async def generate():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def scenario():
+        first = asyncio.ensure_future(flights.do("k", generate))
+        second = asyncio.ensure_future(flights.do("k", generate))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled  # el segundo llamante sigue esperando
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+    assert cancelled == [1]
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_concurrent_identical_chats_call_model_once(db_session, ollama_calls):
+    """Test que verifica que dos chats idénticos simultáneos generan una sola vez y guardan ambos mensajes"""
+    user = db_session.query(User).first()
+
+    async def ask_concurrently():
+        return await asyncio.gather(
+            chat_with_local_ai(db_session, user, "Explícame la fotosíntesis"),
+            chat_with_local_ai(db_session, user, "explícame la fotosíntesis"),
+        )
+
+    first, second = _run_with_fake_ollama(ollama_calls, ask_concurrently)
+
+    assert first == second
+    assert len(ollama_calls) == 1
+    assert db_session.query(ChatMessage).filter(ChatMessage.user_id == user.id).count() == 2
+
+
+def test_chat_route_returns_503_when_queue_full(db_session, monkeypatch):
+    """Test que verifica la respuesta 503 con Retry-After cuando la cola de inferencia está llena"""
+    from sheily_light_api.core.database import get_db
+    from sheily_light_api.sheily_routers import sheily_chat_router
+
+    async def queue_full(*args, **kwargs):
+        raise InferenceQueueFull("llama3", retry_after=7)
+
+    user = db_session.query(User).first()
+    monkeypatch.setattr(sheily_chat_router, "chat_with_local_ai", queue_full)
+    app = FastAPI()
+    app.include_router(sheily_chat_router.router)
+    app.dependency_overrides[get_current_user] = lambda: user
+    app.dependency_overrides[get_db] = lambda: db_session
+
+    async def post():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.post("/chat/local", json={"prompt": "hola"})
+
+    response = asyncio.run(post())
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "7"
+
+
+def test_conversation_routes_authenticate_with_bearer_token(db_session):
+    """Test que verifica que las rutas de conversaciones resuelven el usuario a partir de un JWT real"""
+    from sheily_light_api.sheily_routers import sheily_chat_router
+
+    app = FastAPI()
+    app.include_router(sheily_chat_router.router)
+    app.dependency_overrides[dependencies.get_db_dep] = lambda: db_session
+    app.dependency_overrides[get_db] = lambda: db_session
+    headers = {"Authorization": f"Bearer {create_access_token('chatuser')}"}
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            created = await client.post("/chat/conversations", json={"title": "viaje"}, headers=headers)
+            listed = await client.get("/chat/conversations", headers=headers)
+            detail = await client.get(f"/chat/conversations/{created.json()['id']}", headers=headers)
+            return created, listed, detail
+
+    created, listed, detail = asyncio.run(scenario())
+
+    assert created.status_code == 201
+    assert [c["title"] for c in listed.json()] == ["viaje"]
+    assert detail.json()["turns"] == []
+
+
+def test_stream_route_fails_fast_when_ollama_circuit_open(stream_session, ollama_calls, monkeypatch):
+    """Test que verifica el 503 inmediato del streaming cuando el circuito de Ollama está abierto"""
+    from sheily_light_api.sheily_routers.sheily_chat_router import router
+
+    pool = OllamaBackendPool(["http://ollama:11434"], eject_seconds=45)
+    pool.backends[0].breaker.trip()
+    monkeypatch.setattr(sheily_chat_service, "ollama_backends", pool)
+    monkeypatch.setattr(sheily_chat_local_engine, "ollama_backends", pool)
+    user = stream_session.query(User).first()
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[get_current_user] = lambda: user
+
+    async def post_stream():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.post("/chat/local/stream", json={"prompt": "hola"})
+
+    response = _run_with_fake_ollama(ollama_calls, post_stream)
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "45"
+    assert ollama_calls == []
+
+
+def _hanging_ollama(events):
+    """Ollama simulado que empieza a responder y no termina; registra si se abortó la petición"""
+
+    async def body():
+        try:
+            yield json.dumps({"response": "respuesta ", "done": False}).encode() + b"\n"
+            await asyncio.sleep(30)
+        finally:
+            events.append("closed")
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        events.append("started")
+        if json.loads(request.content).get("stream"):
+            return httpx.Response(200, content=body())
+        try:
+            await asyncio.sleep(30)
+        finally:
+            events.append("closed")
+
+    return handler
+
+
+class _DisconnectingRequest:
+    """Petición cuyo cliente se desconecta en cuanto Ollama empieza a generar"""
+
+    def __init__(self, events):
+        self.events = events
+
+    async def is_disconnected(self):
+        return "started" in self.events
+
+
+def test_chat_route_aborts_generation_when_client_disconnects(db_session, monkeypatch):
+    """Test que verifica que una desconexión cancela la petición a Ollama y guarda el intercambio como abortado"""
+    from sheily_light_api.sheily_routers import sheily_chat_router
+
+    monkeypatch.setattr(sheily_chat_router, "DISCONNECT_POLL_SECONDS", 0.01)
+    user = db_session.query(User).first()
+    events = []
+
+    async def ask():
+        with pytest.raises(HTTPException) as error:
+            await sheily_chat_router._answer(db_session, user, "hola", http_request=_DisconnectingRequest(events))
+        return error.value
+
+    error = _run_with_fake_ollama_handler(_hanging_ollama(events), ask)
+
+    assert error.status_code == 499
+    assert events == ["started", "closed"]
+    assert inference_scheduler.stats()["llama3"]["active"] == 0
+    stored = db_session.query(ChatMessage).one()
+    assert (stored.status, stored.response, stored.model) == (MESSAGE_ABORTED, "", None)
+    assert sheily_chat_service.get_chat_history(db_session, user) == []
+
+
+def test_cancelled_stream_keeps_partial_answer_out_of_the_conversation(stream_session):
+    """Test que verifica que un stream cancelado cierra el de Ollama y no cuenta como turno de la conversación"""
+    user = stream_session.query(User).first()
+    conversation = create_conversation(stream_session, user)
+    events = []
+
+    async def cancel_after_first_token():
+        received = []
+
+        async def consume():
+            async for token in stream_chat_with_local_ai(user, "hola", conversation_id=conversation.id):
+                received.append(token)
+
+        task = asyncio.ensure_future(consume())
+        while not received:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return received
+
+    received = _run_with_fake_ollama_handler(_hanging_ollama(events), cancel_after_first_token)
+
+    assert received == ["respuesta "]
+    assert events == ["started", "closed"]
+    stored = stream_session.query(ChatMessage).one()
+    assert (stored.status, stored.response, stored.conversation_id) == (MESSAGE_ABORTED, "respuesta", conversation.id)
+    assert get_turns(stream_session, conversation.id) == []
+
+
+class _FakeSocket:
+    """WebSocket en memoria: el test escribe en ``incoming`` (``None`` desconecta) y lee de ``outgoing``"""
+
+    def __init__(self, query_params=None):
+        self.query_params = query_params or {}
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self):
+        frame = await self.incoming.get()
+        if frame is None:
+            raise WebSocketDisconnect(1000)
+        return json.dumps(frame)
+
+    async def send_json(self, frame):
+        await self.outgoing.put(frame)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+async def _receive_until(socket, last):
+    """Mensajes del servidor, sin los latidos, hasta el que cumple ``last``"""
+    frames = []
+    while not frames or not last(frames[-1]):
+        frame = await asyncio.wait_for(socket.outgoing.get(), timeout=5)
+        if frame["type"] != "ping":
+            frames.append(frame)
+    return frames
+
+
+def test_websocket_multiplexes_generations_and_stops_on_request(stream_session, monkeypatch):
+    """Test que verifica el canal WebSocket: autenticación única, generaciones intercaladas, stop y latido"""
+    cancelled = []
+
+    async def fake_stream(user, prompt, priority, conversation_id=None, slo_ms=None):
+        yield f"{user.username}:"
+        if prompt == "largo":
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                cancelled.append(prompt)
+                raise
+        yield prompt
+
+    monkeypatch.setattr(sheily_chat_websocket, "stream_chat_with_local_ai", fake_stream)
+    sockets = SheilyChatSockets(heartbeat_seconds=0.05)
+
+    async def session():
+        socket = _FakeSocket()
+        served = asyncio.ensure_future(sockets.serve(socket))
+        socket.incoming.put_nowait({"type": "auth", "token": create_access_token("chatuser")})
+        assert (await socket.outgoing.get())["type"] == "ready"
+        socket.incoming.put_nowait({"type": "chat", "id": "a", "prompt": "largo"})
+        socket.incoming.put_nowait({"type": "chat", "id": "b", "prompt": "corto"})
+        socket.incoming.put_nowait({"type": "chat", "id": "a", "prompt": "repetido"})
+        frames = await _receive_until(socket, lambda f: f["type"] == "done")
+        if {"type": "token", "id": "a", "token": "chatuser:"} not in frames:
+            frames += await _receive_until(socket, lambda f: f.get("id") == "a")
+        socket.incoming.put_nowait({"type": "stop", "id": "a"})
+        frames += await _receive_until(socket, lambda f: f["type"] == "stopped")
+        socket.incoming.put_nowait({"type": "ping"})
+        frames += await _receive_until(socket, lambda f: f["type"] == "pong")
+        # El latido del servidor llega aunque el cliente no envíe nada
+        assert await asyncio.wait_for(socket.outgoing.get(), timeout=5) == {"type": "ping"}
+        socket.incoming.put_nowait(None)
+        await served
+
+        rejected = _FakeSocket({"token": "invalido"})
+        await sockets.serve(rejected)
+        return frames, rejected.close_code
+
+    frames, close_code = asyncio.run(session())
+
+    assert [f for f in frames if f.get("id") == "b"] == [
+        {"type": "token", "id": "b", "token": "chatuser:"},
+        {"type": "token", "id": "b", "token": "corto"},
+        {"type": "done", "id": "b", "answer": "chatuser:corto"},
+    ]
+    assert [f["status"] for f in frames if f["type"] == "error"] == [409]
+    assert [f for f in frames if f.get("id") == "a" and f["type"] != "error"] == [
+        {"type": "token", "id": "a", "token": "chatuser:"},
+        {"type": "stopped", "id": "a"},
+    ]
+    assert cancelled == ["largo"]
+    assert close_code == WS_CLOSE_UNAUTHORIZED
+    assert sockets.stats() == {"open": 0, "accepted": 1, "rejected": 1, "generations": 2, "stopped": 1}
+
+
+def test_websocket_stays_open_while_generating_and_reports_failures(stream_session, monkeypatch):
+    """Test que verifica que el socket no se cierra por inactividad mientras genera y que los fallos llegan como error"""
+
+    async def fake_stream(user, prompt, priority, conversation_id=None, slo_ms=None):
+        if prompt == "falla":
+            raise KeyError("response")
+        for word in ("una ", "respuesta ", "lenta"):
+            await asyncio.sleep(0.1)
+            yield word
+
+    monkeypatch.setattr(sheily_chat_websocket, "stream_chat_with_local_ai", fake_stream)
+    sockets = SheilyChatSockets(heartbeat_seconds=30, idle_seconds=0.05)
+
+    async def session():
+        socket = _FakeSocket({"token": create_access_token("chatuser")})
+        served = asyncio.ensure_future(sockets.serve(socket))
+        assert (await socket.outgoing.get())["type"] == "ready"
+        socket.incoming.put_nowait({"type": "chat", "id": "a", "prompt": "hola"})
+        frames = await _receive_until(socket, lambda f: f["type"] == "done")
+        socket.incoming.put_nowait({"type": "chat", "id": "b", "prompt": "falla"})
+        frames += await _receive_until(socket, lambda f: f["type"] == "error")
+        # Sin generaciones ni mensajes del cliente sí se cierra
+        await asyncio.wait_for(served, timeout=5)
+        return frames, socket.close_code
+
+    frames, close_code = asyncio.run(session())
+
+    assert frames[-2] == {"type": "done", "id": "a", "answer": "una respuesta lenta"}
+    assert frames[-1] == {"type": "error", "id": "b", "status": 500, "detail": "Generation failed"}
+    assert close_code == WS_CLOSE_IDLE
+
+
+def test_websocket_closes_when_the_token_expires(stream_session, monkeypatch):
+    """Test que verifica que el socket se cierra con 4401 cuando vence el ``exp`` del JWT"""
+    monkeypatch.setattr(sheily_chat_websocket, "token_expiry", lambda token: time.time() + 0.2)
+    sockets = SheilyChatSockets(heartbeat_seconds=30, idle_seconds=30)
+
+    async def session():
+        socket = _FakeSocket({"token": create_access_token("chatuser")})
+        served = asyncio.ensure_future(sockets.serve(socket))
+        assert (await socket.outgoing.get())["type"] == "ready"
+        socket.incoming.put_nowait({"type": "ping"})
+        pong = await socket.outgoing.get()
+        await asyncio.wait_for(served, timeout=5)
+        return pong, socket.close_code
+
+    pong, close_code = asyncio.run(session())
+
+    assert pong == {"type": "pong"}
+    assert close_code == WS_CLOSE_UNAUTHORIZED
+
+
+def test_websocket_logs_generations_that_cannot_reach_the_client(stream_session, monkeypatch, caplog):
+    """Test que verifica que el fallo al entregar el resultado de una generación se recoge y se registra"""
+
+    async def fake_stream(user, prompt, priority, conversation_id=None, slo_ms=None):
+        yield "hola"
+
+    class _ClosingSocket(_FakeSocket):
+        async def send_json(self, frame):
+            if frame["type"] == "done":
+                raise RuntimeError("socket cerrado")
+            await super().send_json(frame)
+
+    monkeypatch.setattr(sheily_chat_websocket, "stream_chat_with_local_ai", fake_stream)
+    sockets = SheilyChatSockets(heartbeat_seconds=30, idle_seconds=30)
+
+    async def session():
+        socket = _ClosingSocket({"token": create_access_token("chatuser")})
+        served = asyncio.ensure_future(sockets.serve(socket))
+        assert (await socket.outgoing.get())["type"] == "ready"
+        socket.incoming.put_nowait({"type": "chat", "id": "a", "prompt": "hola"})
+        await _receive_until(socket, lambda f: f["type"] == "token")
+        await asyncio.sleep(0.05)
+        socket.incoming.put_nowait(None)
+        await served
+
+    with caplog.at_level("WARNING", logger="sheily_chat_websocket"):
+        asyncio.run(session())
+
+    assert any("generation a" in r.getMessage() and "socket cerrado" in r.getMessage() for r in caplog.records)
+
+
+def test_list_available_models_is_cached(monkeypatch):
+    """Test que verifica que la lista de modelos se cachea durante el TTL"""
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        return httpx.Response(200, json={"models": [{"name": "llama3"}]})
+
+    sheily_ai_health_monitor.invalidate_models_cache()
+    models = _run_with_fake_ollama_handler(handler, sheily_ai_health_monitor.list_available_models)
+    again = _run_with_fake_ollama_handler(handler, sheily_ai_health_monitor.list_available_models)
+    monkeypatch.setattr(sheily_ai_health_monitor, "MODELS_CACHE_TTL", 0)
+    _run_with_fake_ollama_handler(handler, sheily_ai_health_monitor.list_available_models)
+    sheily_ai_health_monitor.invalidate_models_cache()
+
+    assert models == again == ["llama3"]
+    assert calls == ["/api/tags", "/api/tags"]
+
+
+def test_download_model_refreshes_the_cached_model_list():
+    """Test que verifica que tras descargar un modelo la lista cacheada lo incluye"""
+    installed = ["llama3"]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/pull":
+            installed.append(json.loads(request.content)["name"])
+            return httpx.Response(200, json={"status": "success"})
+        return httpx.Response(200, json={"models": [{"name": name} for name in installed]})
+
+    async def scenario():
+        await sheily_ai_health_monitor.list_available_models()
+        result = await sheily_chat_updater.download_model("llama3.2:3b")
+        return result, await sheily_ai_health_monitor.list_available_models()
+
+    sheily_ai_health_monitor.invalidate_models_cache()
+    result, models = _run_with_fake_ollama_handler(handler, scenario)
+    sheily_ai_health_monitor.invalidate_models_cache()
+
+    assert result == {"status": "downloaded", "model": "llama3.2:3b"}
+    assert models == ["llama3", "llama3.2:3b"]
+
+
+def _run_with_fake_ollama_handler(handler, coro_factory):
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            return await coro_factory()
+        finally:
+            await close_async_http_client()
+
+    return asyncio.run(scenario())
+
+
+def test_fair_share_weight_follows_token_balance(db_session):
+    """Test que verifica el peso de reparto justo según el saldo de tokens"""
+    user = db_session.query(User).first()
+    assert sheily_chat_service.fair_share_weight(db_session, user) == 1.0
+
+    db_session.add(TokenBalance(user_id=user.id, balance=5000))
+    db_session.commit()
+
+    assert sheily_chat_service.fair_share_weight(db_session, user) == 2.0
+
+
+def _run_with_context_ollama(calls, coro_factory):
+    """Ollama simulado que devuelve un ``context`` distinto en cada llamada"""
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        calls.append(body)
+        answer = {"response": f"respuesta {len(calls)}", "done": True, "context": [len(calls)] * 3}
+        return httpx.Response(200, json=answer)
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            return await coro_factory()
+        finally:
+            await close_async_http_client()
+
+    return asyncio.run(scenario())
+
+
+def test_conversation_reuses_ollama_context_between_turns(db_session, ollama_calls):
+    """Test que verifica que los turnos siguientes envían solo el prompt nuevo con el context previo"""
+    user = db_session.query(User).first()
+    conversation = create_conversation(db_session, user, "charla")
+
+    async def two_turns():
+        await chat_with_local_ai(db_session, user, "Me llamo Ana", conversation_id=conversation.id)
+        return await chat_with_local_ai(db_session, user, "¿Cómo me llamo?", conversation_id=conversation.id)
+
+    answer = _run_with_context_ollama(ollama_calls, two_turns)
+
+    assert answer == "respuesta 2"
+    assert "context" not in ollama_calls[0]
+    assert ollama_calls[1]["context"] == [1, 1, 1]
+    assert ollama_calls[1]["prompt"] == "¿Cómo me llamo?"
+    turns = db_session.query(ChatMessage).filter(ChatMessage.conversation_id == conversation.id).all()
+    assert [t.prompt for t in turns] == ["Me llamo Ana", "¿Cómo me llamo?"]
+
+
+def test_conversation_rebuilds_trimmed_transcript_without_context(db_session, ollama_calls):
+    """Test que verifica la transcripción recortada cuando no hay context reutilizable"""
+    user = db_session.query(User).first()
+    conversation = create_conversation(db_session, user)
+
+    async def turn_after_restart():
+        await chat_with_local_ai(db_session, user, "Me llamo Ana", conversation_id=conversation.id)
+        conversation_engine.forget(conversation.id)  # como tras un reinicio
+        return await chat_with_local_ai(db_session, user, "¿Cómo me llamo?", conversation_id=conversation.id)
+
+    _run_with_context_ollama(ollama_calls, turn_after_restart)
+
+    assert "context" not in ollama_calls[1]
+    assert ollama_calls[1]["prompt"] == "Usuario: Me llamo Ana\nAsistente: respuesta 1\nUsuario: ¿Cómo me llamo?\nAsistente:"
+
+
+def test_conversation_transcript_respects_token_budget():
+    """Test que verifica que solo se conservan los turnos recientes que caben en la ventana"""
+    engine = SheilyConversationEngine()
+    turns = [ChatMessage(prompt="a" * 400, response="b" * 400), ChatMessage(prompt="hola", response="qué tal")]
+
+    transcript = engine.build_transcript(turns, "sigue", budget=50)
+
+    assert transcript == "Usuario: hola\nAsistente: qué tal\nUsuario: sigue\nAsistente:"
+    assert engine.stats()["trimmed_turns"] == 1
+
+
+def test_add_missing_columns_upgrades_existing_chat_table():
+    """Test que verifica que las tablas creadas antes de las conversaciones reciben las columnas nuevas"""
+    from sqlalchemy import inspect, text
+
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE chat_messages (id INTEGER PRIMARY KEY, prompt TEXT, response TEXT)"))
+
+    database.add_missing_columns(engine)
+
+    columns = {column["name"] for column in inspect(engine).get_columns("chat_messages")}
+    assert {"conversation_id", "model"} <= columns
+
+
+def test_conversation_of_other_user_is_not_found(db_session):
+    """Test que verifica que no se puede escribir en la conversación de otro usuario"""
+    owner = db_session.query(User).first()
+    intruder = User(username="intruso", hashed_password="x")
+    db_session.add(intruder)
+    db_session.commit()
+    conversation = create_conversation(db_session, owner)
+
+    with pytest.raises(ConversationNotFound):
+        asyncio.run(chat_with_local_ai(db_session, intruder, "hola", conversation_id=conversation.id))
+
+
+def test_completed_turn_moves_conversation_to_the_top(db_session, ollama_calls):
+    """Test que verifica que al guardar un turno la conversación pasa a ser la más reciente"""
+    user = db_session.query(User).first()
+    older = create_conversation(db_session, user)
+    create_conversation(db_session, user)
+
+    _run_with_fake_ollama(ollama_calls, lambda: chat_with_local_ai(db_session, user, "hola", conversation_id=older.id))
+
+    assert list_conversations(db_session, user)[0].id == older.id
+
+
+def test_write_behind_batches_messages(db_session, tmp_path):
+    """Test que verifica que los mensajes se escriben en lotes fuera de la petición"""
+    user = db_session.query(User).first()
+    writer = SheilyChatWriteBehind(
+        session_factory=sessionmaker(bind=db_session.get_bind()),
+        batch_size=3,
+        flush_interval_ms=20,
+        spool_path=str(tmp_path / "spool.jsonl"),
+    )
+
+    async def scenario():
+        writer.start()
+        for i in range(5):
+            writer.submit(user.id, f"pregunta {i}", f"respuesta {i}", conversation_id=7)
+        assert len(writer.pending_turns(7)) == 5
+        assert db_session.query(ChatMessage).count() == 0
+        await asyncio.sleep(0.1)
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+    assert db_session.query(ChatMessage).count() == 5
+    stats = writer.stats()
+    assert stats["queued"] == 0
+    assert stats["flushed"] == 5
+    assert stats["batches"] == 2
+
+
+def test_write_behind_spools_when_database_fails(db_session, tmp_path):
+    """Test que verifica el volcado a disco si la base de datos falla y su reintento posterior"""
+    user = db_session.query(User).first()
+    spool = tmp_path / "spool.jsonl"
+
+    def broken_session():
+        raise RuntimeError("base de datos caída")
+
+    failing = SheilyChatWriteBehind(session_factory=broken_session, spool_path=str(spool))
+
+    async def drain_while_down():
+        failing.start()
+        failing.submit(user.id, "hola", "adiós")
+        await failing.stop()
+
+    asyncio.run(drain_while_down())
+
+    assert failing.stats()["spooled"] == 1
+    assert spool.exists()
+
+    recovered = SheilyChatWriteBehind(session_factory=sessionmaker(bind=db_session.get_bind()), spool_path=str(spool))
+    asyncio.run(recovered.flush())
+
+    assert not spool.exists()
+    assert recovered.stats()["replayed"] == 1
+    assert db_session.query(ChatMessage).one().prompt == "hola"
+
+
+def test_write_behind_sets_aside_rows_that_cannot_be_written(db_session, tmp_path):
+    """Test que verifica que una fila inválida o una línea rota del volcado no bloquean al resto del lote"""
+    user = db_session.query(User).first()
+    spool = tmp_path / "spool.jsonl"
+    dead = tmp_path / "dead.jsonl"
+    good = {
+        "user_id": user.id,
+        "prompt": "del volcado",
+        "response": "ok",
+        "conversation_id": None,
+        "created_at": "2026-01-01T00:00:00",
+        "timing": None,
+        "status": None,
+    }
+    spool.write_text(
+        json.dumps(good) + "\n" + json.dumps({**good, "created_at": "ayer"}) + "\n" + '{"user_id": 1, "pro',
+        encoding="utf-8",
+    )
+    writer = SheilyChatWriteBehind(
+        session_factory=sessionmaker(bind=db_session.get_bind()), spool_path=str(spool), dead_letter_path=str(dead)
+    )
+
+    async def scenario():
+        writer.start()
+        writer.submit(user.id, "hola", "adiós")
+        writer.submit(user.id, "rota", "adiós", timing={"no_such_column": 1})
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+    assert sorted(m.prompt for m in db_session.query(ChatMessage)) == ["del volcado", "hola"]
+    assert not spool.exists()
+    stats = writer.stats()
+    assert stats["replayed"] == 1
+    assert stats["spooled"] == 0
+    assert stats["dead_lettered"] == 3
+    entries = [json.loads(line) for line in dead.read_text(encoding="utf-8").splitlines()]
+    assert [entry.get("line") or entry["record"]["prompt"] for entry in entries] == [
+        '{"user_id": 1, "pro',
+        "del volcado",
+        "rota",
+    ]
+
+
+def _slow_tokens(delay, tokens, events):
+    async def generate():
+        try:
+            await asyncio.sleep(delay)
+            for token in tokens:
+                yield token
+        except asyncio.CancelledError:
+            events.append("local cancelada")
+            raise
+
+    return generate()
+
+
+def test_hedging_is_opt_in_and_needs_a_configured_central():
+    """Test que verifica que la cobertura está apagada por defecto y sin URL de la central"""
+    assert not SheilyChatHedger(opt_in=False, central_configured=True).enabled
+    assert not SheilyChatHedger(opt_in=True, central_configured=False).enabled
+    assert SheilyChatHedger(opt_in=True, central_configured=True).enabled
+    assert not chat_hedger.enabled
+
+
+def test_hedger_uses_central_when_local_is_slow():
+    """Test que verifica que la central gana la carrera y la generación local se cancela"""
+    hedger = SheilyChatHedger(default_deadline_ms=20, min_deadline_ms=0)
+    events = []
+
+    async def central():
+        events.append("central")
+        return "respuesta central"
+
+    outcome = {}
+
+    async def consume():
+        local = _slow_tokens(5, ["lenta"], events)
+        return [token async for token in hedger.stream("llama3", local, central, outcome)]
+
+    assert asyncio.run(consume()) == ["respuesta central"]
+    assert events == ["central", "local cancelada"]
+    assert outcome == {"source": "central"}
+    assert hedger.stats()["hedge_rate"] == 1.0
+    assert hedger.stats()["win_rate"] == 1.0
+    # La espera hasta que ganó la central cuenta como cota inferior del primer token local
+    assert len(hedger._first_token_ms["llama3"]) == 1
+    assert hedger._first_token_ms["llama3"][0] >= 20
+
+
+def test_hedger_skips_central_when_local_is_fast():
+    """Test que verifica que sin retraso no se lanza la cobertura y el plazo sigue al p95"""
+    hedger = SheilyChatHedger(default_deadline_ms=1000, min_deadline_ms=0, min_samples=3)
+    events = []
+
+    async def central():
+        events.append("central")
+        return "respuesta central"
+
+    async def consume():
+        results = []
+        for _ in range(3):
+            local = _slow_tokens(0, ["rápida ", "local"], events)
+            results.append([token async for token in hedger.stream("llama3", local, central)])
+        return results
+
+    assert asyncio.run(consume()) == [["rápida ", "local"]] * 3
+    assert events == []
+    assert hedger.stats()["hedged"] == 0
+    assert hedger.deadline("llama3") < 1.0
+
+
+def test_hedger_falls_back_to_central_when_local_fails():
+    """Test que verifica que un fallo local con la cobertura en vuelo se resuelve con la central"""
+    hedger = SheilyChatHedger(default_deadline_ms=10, min_deadline_ms=0)
+
+    async def failing_local():
+        await asyncio.sleep(0.05)
+        raise RuntimeError("Error al consultar Ollama")
+        yield  # pragma: no cover
+
+    async def central():
+        await asyncio.sleep(0.1)
+        return "respuesta central"
+
+    async def consume():
+        return [token async for token in hedger.stream("llama3", failing_local(), central)]
+
+    assert asyncio.run(consume()) == ["respuesta central"]
+    assert hedger.stats()["central_wins"] == 1
+
+
+def test_central_answer_is_not_cached_as_the_local_model(db_session, monkeypatch):
+    """Test que verifica que la respuesta de la central no se guarda en la caché con la clave del modelo local"""
+    monkeypatch.setattr(type(chat_hedger), "enabled", property(lambda self: True))
+    monkeypatch.setattr(chat_hedger, "default_deadline_ms", 20)
+    monkeypatch.setattr(chat_hedger, "min_deadline_ms", 0)
+
+    async def central(prompt, user_id):
+        return "respuesta central"
+
+    async def silent_ollama(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(30)
+
+    monkeypatch.setattr(sheily_chat_service, "ask_central", central)
+    user = db_session.query(User).first()
+
+    answer = _run_with_fake_ollama_handler(silent_ollama, lambda: chat_with_local_ai(db_session, user, "Cuéntame algo"))
+
+    assert answer == "respuesta central"
+    options = generation_options.for_model("llama3")
+    assert response_cache.key_for("Cuéntame algo", "llama3", options) not in response_cache._entries
+
+
+class _FailingSearchProvider:
+    def __init__(self):
+        self.calls = 0
+
+    async def search(self, query, num):
+        self.calls += 1
+        raise httpx.ConnectError("sin red")
+
+
+def test_web_search_caches_normalized_queries_and_failures():
+    """Test que verifica la caché positiva por consulta normalizada y la negativa ante fallos"""
+    stub = StubSearchProvider()
+    web = SheilyWebSearch(stub)
+    failing = _FailingSearchProvider()
+    broken = SheilyWebSearch(failing)
+
+    async def scenario():
+        first = await web.search("Precio actual del oro")
+        second = await web.search("  precio ACTUAL del oro?")
+        failed = [await broken.search("precio hoy"), await broken.search("precio hoy")]
+        return first, second, failed
+
+    first, second, failed = asyncio.run(scenario())
+
+    assert first == second and first.startswith("1. Resultado 1")
+    assert stub.calls == 1
+    assert failed == ["", ""]
+    assert failing.calls == 1
+    assert broken.stats()["cache"]["negative_hits"] == 1
+
+
+def test_pending_search_respects_latency_budget():
+    """Test que verifica que una búsqueda lenta no retrasa la respuesta y acaba en la caché"""
+    stub = StubSearchProvider(latency_ms=100)
+    web = SheilyWebSearch(stub)
+
+    async def scenario():
+        late = await web.start("precio hoy").result(budget_ms=10)
+        await asyncio.sleep(0.2)
+        cached = await web.start("precio hoy").result(budget_ms=10)
+        return late, cached
+
+    late, cached = asyncio.run(scenario())
+
+    assert late == ""
+    assert cached.startswith("1. Resultado 1")
+    assert stub.calls == 1
+    assert web.stats()["over_budget"] == 1
+
+
+def test_chat_enriches_prompt_with_stub_search(db_session, ollama_calls, monkeypatch):
+    """Test que verifica que el prompt que llega al modelo incluye los resultados de búsqueda"""
+    monkeypatch.setattr(sheily_chat_service, "web_search", SheilyWebSearch(StubSearchProvider()))
+    user = db_session.query(User).first()
+
+    _run_with_fake_ollama(ollama_calls, lambda: chat_with_local_ai(db_session, user, "¿Qué tiempo hace hoy?"))
+
+    assert "[DATO EN TIEMPO REAL]" in ollama_calls[0]["prompt"]
+    assert "https://example.com/1" in ollama_calls[0]["prompt"]
+
+
+def test_web_search_overlaps_with_personal_recall(db_session, ollama_calls, monkeypatch):
+    """Test que verifica que la búsqueda web ya está en marcha mientras se recupera el contexto personal"""
+    stub = StubSearchProvider(latency_ms=0)
+    monkeypatch.setattr(sheily_chat_service, "web_search", SheilyWebSearch(stub))
+    searches_during_recall = []
+
+    async def slow_recall(user_id, prompt, conversation_id=None):
+        await asyncio.sleep(0.01)
+        searches_during_recall.append(stub.calls)
+        return sheily_chat_service._Recall()
+
+    monkeypatch.setattr(sheily_chat_service, "_recall", slow_recall)
+    user = db_session.query(User).first()
+
+    _run_with_fake_ollama(ollama_calls, lambda: chat_with_local_ai(db_session, user, "¿Qué tiempo hace hoy?"))
+
+    assert searches_during_recall == [1]
+    assert "[DATO EN TIEMPO REAL]" in ollama_calls[0]["prompt"]
+
+
+def _history(user_id):
+    exchanges = [
+        ("¿Cómo configuro el router wifi?", "Entra en 192.168.1.1 y cambia el canal del router wifi."),
+        ("Receta de tortilla de patatas", "Bate huevos, fríe las patatas y cuaja la tortilla."),
+        ("¿Qué es la fotosíntesis?", "Es el proceso por el que las plantas convierten luz en energía."),
+    ]
+    return [(i, {"user_id": user_id, "prompt": p, "response": r}) for i, (p, r) in enumerate(exchanges, 1)]
+
+
+def test_retrieval_ranks_history_with_bm25_and_persists(db_session, tmp_path):
+    """Test que verifica la búsqueda BM25 por usuario y la recarga del índice desde disco"""
+    sessions = sessionmaker(bind=db_session.get_bind())
+    index = SheilyChatRetrieval(str(tmp_path), enabled=True, min_score=0.1, session_factory=sessions)
+    index.index_messages(_history(user_id=1))
+
+    hits = index.search(1, "el router wifi pierde la conexión")
+    assert [hit.message_id for hit in hits] == [1]
+    assert index.search(2, "router wifi") == []
+
+    reloaded = SheilyChatRetrieval(str(tmp_path), enabled=True, min_score=0.1, session_factory=sessions)
+    assert reloaded.search(1, "tortilla de patatas")[0].message_id == 2
+    assert reloaded.stats()["indexed"] == 0  # cargado del registro, sin reindexar
+
+
+def test_retrieval_workers_share_user_shards(db_session, tmp_path):
+    """Test que verifica que dos workers ven lo que indexa el otro sin duplicar líneas en el registro"""
+    sessions = sessionmaker(bind=db_session.get_bind())
+    history = _history(user_id=1)
+    first = SheilyChatRetrieval(str(tmp_path), enabled=True, min_score=0.1, session_factory=sessions)
+    second = SheilyChatRetrieval(str(tmp_path), enabled=True, min_score=0.1, session_factory=sessions)
+    first.index_messages(history[:1])
+    assert second.search(1, "router wifi")[0].message_id == 1
+
+    first.index_messages(history[1:])
+    second.index_messages(history)  # el mismo lote llega también al otro worker
+
+    assert second.search(1, "tortilla de patatas")[0].message_id == 2
+    assert len((tmp_path / "user_1.jsonl").read_text(encoding="utf-8").splitlines()) == 3
+    shard = second._shards[1]
+    assert shard.total_len == sum(shard.doc_len.values())
+
+
+def test_retrieval_catches_up_with_messages_saved_while_not_indexed(db_session, tmp_path):
+    """Test que verifica que al cargar un fragmento solo se indexan los mensajes nuevos"""
+    user = db_session.query(User).first()
+    db_session.add(ChatMessage(user_id=user.id, prompt="¿Quién pintó el Guernica?", response="Pablo Picasso."))
+    db_session.commit()
+    sessions = sessionmaker(bind=db_session.get_bind())
+    index = SheilyChatRetrieval(str(tmp_path), enabled=True, min_score=0.1, session_factory=sessions)
+
+    assert index.search(user.id, "guernica picasso")[0].response == "Pablo Picasso."
+    assert index.stats()["indexed"] == 1
+
+
+def test_retrieval_loading_one_user_does_not_block_others(db_session, tmp_path):
+    """Test que verifica que la carga del fragmento de un usuario no bloquea las búsquedas de otro"""
+    sessions = sessionmaker(bind=db_session.get_bind())
+    slow, entered, release = threading.Event(), threading.Event(), threading.Event()
+
+    def slow_sessions():
+        if slow.is_set() and not entered.is_set():
+            # La puesta al día del usuario 1 se queda esperando a la base de datos
+            entered.set()
+            release.wait(5)
+        return sessions()
+
+    index = SheilyChatRetrieval(str(tmp_path), enabled=True, min_score=0.1, session_factory=slow_sessions)
+    index.index_messages(_history(user_id=2))
+    slow.set()
+    loading = threading.Thread(target=index.search, args=(1, "router wifi"))
+    loading.start()
+    assert entered.wait(5)
+
+    hits = index.search(2, "router wifi")
+    still_loading = loading.is_alive()
+    release.set()
+    loading.join(5)
+
+    assert [hit.message_id for hit in hits] == [1]
+    assert still_loading
+
+
+def test_chat_injects_relevant_history_into_prompt(db_session, ollama_calls, tmp_path, monkeypatch):
+    """Test que verifica que el historial relevante se añade al prompt y la respuesta se cachea solo para el usuario"""
+    monkeypatch.setattr(chat_retrieval, "enabled", True)
+    monkeypatch.setattr(chat_retrieval, "index_dir", tmp_path)
+    monkeypatch.setattr(chat_retrieval, "min_score", 0.1)
+    monkeypatch.setattr(chat_retrieval, "_session_factory", sessionmaker(bind=db_session.get_bind()))
+    monkeypatch.setattr(chat_retrieval, "_shards", type(chat_retrieval._shards)())
+    user = db_session.query(User).first()
+
+    async def scenario():
+        await chat_with_local_ai(db_session, user, "Mi perro se llama Toby")
+        await chat_with_local_ai(db_session, user, "Receta de gazpacho")
+        first = await chat_with_local_ai(db_session, user, "¿Cómo se llama mi perro?")
+        generations = len(ollama_calls)
+        again = await chat_with_local_ai(db_session, user, "¿cómo se llama mi perro")
+        return first, again, generations
+
+    first, again, generations = _run_with_fake_ollama(ollama_calls, scenario)
+
+    assert "[CONVERSACIONES ANTERIORES RELEVANTES]" in ollama_calls[-1]["prompt"]
+    assert "Toby" in ollama_calls[-1]["prompt"]
+    # La repetición del mismo usuario sale de su caché; la respuesta personal no se comparte con otros
+    assert again == first and len(ollama_calls) == generations
+    options = generation_options.for_model("llama3")
+    assert response_cache.key_for("¿Cómo se llama mi perro?", "llama3", options) not in response_cache._entries
+    assert response_cache.key_for("¿Cómo se llama mi perro?", "llama3", options, f"user:{user.id}") in (
+        response_cache._entries
+    )
+
+
+def test_chunk_text_overlaps_and_joins_words_split_across_blocks():
+    """Test que verifica el solapamiento de fragmentos y las palabras partidas entre bloques"""
+    chunks = list(chunk_text(["uno dos tr", "es cuatro cinco seis"], size=3, overlap=1))
+
+    assert chunks == ["uno dos tres", "tres cuatro cinco", "cinco seis"]
+
+
+def test_uploaded_document_is_indexed_and_used_in_chat(db_session, tmp_path, monkeypatch):
+    """Test que verifica la subida, la ingesta por lotes y el uso de los fragmentos en el chat"""
+    from sheily_light_api.sheily_routers import sheily_documents_router
+
+    store = SheilyDocumentStore(
+        index_dir=str(tmp_path / "documents"),
+        uploads_dir=str(tmp_path / "uploads"),
+        embedder=SheilyEmbeddingService(cache_path=str(tmp_path / "embeddings.sqlite")),
+        chunk_tokens=8,
+        chunk_overlap=2,
+        batch_size=2,
+    )
+    monkeypatch.setattr(sheily_chat_service, "document_store", store)
+    monkeypatch.setattr(sheily_documents_router, "document_store", store)
+    user = db_session.query(User).first()
+    app = FastAPI()
+    app.include_router(sheily_documents_router.router)
+    app.dependency_overrides[dependencies.get_current_user] = lambda: user
+    prompts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        if request.url.path == "/api/embed":
+            vectors = [[1.0, 0.0] if "garantía" in text else [0.0, 1.0] for text in body["input"]]
+            return httpx.Response(200, json={"embeddings": vectors})
+        prompts.append(body["prompt"])
+        return httpx.Response(200, json={"response": "Tres años.", "done": True})
+
+    manual = "Manual del robot. " + "Texto de relleno sin interés. " * 20 + "La garantía dura tres años."
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            rejected = await client.post("/documents", params={"filename": "virus.exe"}, content=b"MZ")
+            created = await client.post("/documents", params={"filename": "manual.txt"}, content=manual.encode())
+            await store.wait()
+            job = await client.get(f"/documents/ingestions/{created.json()['id']}")
+            await chat_with_local_ai(db_session, user, "¿Cuánto dura la garantía?")
+            listed = await client.get("/documents")
+            deleted = await client.delete(f"/documents/{created.json()['id']}")
+            return rejected, created, job.json(), listed.json(), deleted, store.list_documents(user.id)
+
+    rejected, created, job, listed, deleted, remaining = _run_with_fake_ollama_handler(handler, scenario)
+
+    assert rejected.status_code == 415
+    assert created.status_code == 202
+    assert job["status"] == "done" and job["progress"] == 1.0 and job["chunks"] > 3
+    assert "[DOCUMENTOS DEL USUARIO]" in prompts[-1]
+    assert "garantía dura tres años" in prompts[-1]
+    assert listed == [{"id": created.json()["id"], "filename": "manual.txt", "chunks": job["chunks"]}]
+    assert deleted.status_code == 204
+    assert remaining == []
+    assert not any((tmp_path / "uploads").iterdir())
+
+
+def test_documents_routes_authenticate_with_bearer_token(db_session, tmp_path, monkeypatch):
+    """Test que verifica que las rutas de documentos resuelven el usuario a partir de un JWT real"""
+    from sheily_light_api.sheily_routers import sheily_documents_router
+
+    store = SheilyDocumentStore(index_dir=str(tmp_path / "documents"), uploads_dir=str(tmp_path / "uploads"))
+    monkeypatch.setattr(sheily_documents_router, "document_store", store)
+    app = FastAPI()
+    app.include_router(sheily_documents_router.router)
+    app.dependency_overrides[dependencies.get_db_dep] = lambda: db_session
+    token = create_access_token("chatuser")
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            listed = await client.get("/documents", headers={"Authorization": f"Bearer {token}"})
+            anonymous = await client.get("/documents")
+            return listed, anonymous
+
+    listed, anonymous = asyncio.run(scenario())
+
+    assert listed.status_code == 200
+    assert listed.json() == []
+    assert anonymous.status_code == 401
+
+
+_LABELED_PROMPTS = [
+    ("¿Es difícil aprender a tocar la guitarra?", "general"),
+    ("Dame ideas para un formulario de inscripción a la boda", "general"),
+    ("Quiero escribir un blog de viajes por Asturias", "general"),
+    ("Tengo un error con el coche, hace un ruido raro", "general"),
+    ("Resume el último capítulo del libro", "search"),
+    ("¿Cuánto vale un euro en dólares?", "search"),
+    ("tengo un traceback en python", "code"),
+    ("¿Cómo hago un git rebase sin perder commits?", "code"),
+    ("Mi script de bash falla al leer stdin", "code"),
+    ("Revisa este código: for i in range(10): print(i)", "code"),
+    ("Explica qué hace config.yaml en el proyecto", "code"),
+]
+
+
+def test_intent_classifier_labels_prompts_and_caches_decisions():
+    """Test que verifica la intención de prompts etiquetados y la caché de decisiones"""
+    classifier = SheilyIntentClassifier()
+
+    for prompt, label in _LABELED_PROMPTS:
+        intent = classifier.classify(prompt)
+        assert intent.label == label, prompt
+        assert 0.0 < intent.confidence <= 1.0
+
+    assert classifier.classify("¿Qué versión de Python salió hoy?").needs_search
+    assert classifier.classify("¿Qué versión de Python salió hoy?").label == "code"
+    assert classifier.stats()["hits"] == 1
+    assert classifier.stats()["misses"] == len(_LABELED_PROMPTS) + 1
+
+
+def test_intent_benchmark_reports_cost_per_prompt():
+    """Test que verifica que el micro-benchmark mide el coste por prompt con y sin caché"""
+    result = benchmark(BENCHMARK_PROMPTS, rounds=5)
+
+    assert result["prompts"] == len(BENCHMARK_PROMPTS)
+    assert result["score_us"] > result["cached_us"] > 0
@@ -0,0 +1,795 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from sheily_light_api.sheily_modules.sheily_model_inference import ollama_client
+from sheily_light_api.sheily_modules.sheily_model_inference.inference_scheduler import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    InferenceQueueFull,
+    SheilyInferenceScheduler,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.circuit_breaker import CircuitBreaker
+from sheily_light_api.sheily_modules.sheily_model_inference.embedding_service import SheilyEmbeddingService
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_options import SheilyGenerationOptions
+from sheily_light_api.sheily_modules.sheily_model_inference.generation_timings import Histogram
+from sheily_light_api.sheily_modules.sheily_model_inference import model_router as model_router_module
+from sheily_light_api.sheily_modules.sheily_model_inference.model_residency import ModelResidencyManager
+from sheily_light_api.sheily_modules.sheily_model_inference.model_router import SheilyModelRouter
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_backend_pool import (
+    OllamaBackendPool,
+    OllamaUnavailable,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_client import (
+    AsyncOllamaClient,
+    close_async_http_client,
+    get_async_http_client,
+    init_async_http_client,
+)
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_config import get_parallel_slots, get_tuned_profile
+from sheily_light_api.sheily_modules.sheily_model_inference.ollama_tuner import SheilyOllamaTuner, write_tuned_config
+from sheily_light_api.sheily_modules.sheily_monitoring_module.sheily_monitoring_manager import monitoring_manager
+
+
+def _fake_ollama(requests_seen):
+    """Transporte que simula las rutas básicas de Ollama"""
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests_seen.append(request)
+        if request.url.path == "/api/generate":
+            body = json.loads(request.content)
+            return httpx.Response(200, json={"response": f"eco: {body['prompt']}", "done": True})
+        if request.url.path == "/api/tags":
+            return httpx.Response(200, json={"models": [{"name": "llama3"}, {"name": "deepseek-coder:latest"}]})
+        return httpx.Response(404)
+
+    return httpx.MockTransport(handler)
+
+
+def test_async_client_generate_and_tags():
+    """Test que verifica generate y list_models sobre el pool compartido"""
+    seen = []
+
+    async def scenario():
+        await init_async_http_client(transport=_fake_ollama(seen))
+        try:
+            client = AsyncOllamaClient("http://ollama.test:11434")
+            answer = await client.generate("llama3", "hola")
+            models = await client.list_models()
+        finally:
+            await close_async_http_client()
+        return answer, models
+
+    answer, models = asyncio.run(scenario())
+
+    assert answer == "eco: hola"
+    assert models == ["llama3", "deepseek-coder:latest"]
+    assert json.loads(seen[0].content)["stream"] is False
+    assert str(seen[0].url) == "http://ollama.test:11434/api/generate"
+
+
+def test_shared_http_client_is_reused():
+    """Test que verifica que todas las llamadas comparten el mismo cliente HTTP"""
+
+    async def scenario():
+        shared = await init_async_http_client(transport=_fake_ollama([]))
+        try:
+            assert get_async_http_client() is shared
+            assert AsyncOllamaClient().http is shared
+        finally:
+            await close_async_http_client()
+        assert ollama_client._shared_http_client is None
+
+    asyncio.run(scenario())
+
+
+def test_async_client_raises_on_http_error():
+    """Test que verifica que los errores HTTP de Ollama se propagan"""
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(lambda request: httpx.Response(500)))
+        try:
+            await AsyncOllamaClient().generate("llama3", "hola")
+        finally:
+            await close_async_http_client()
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(scenario())
+
+
+def test_async_client_generate_stream_yields_chunks():
+    """Test que verifica que generate_stream entrega los fragmentos NDJSON en orden"""
+    lines = [{"response": "Ho", "done": False}, {"response": "la", "done": False}, {"response": "", "done": True}]
+    body = "\n".join(json.dumps(line) for line in lines).encode()
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=body)))
+        try:
+            return [chunk async for chunk in AsyncOllamaClient().generate_stream("llama3", "hola")]
+        finally:
+            await close_async_http_client()
+
+    chunks = asyncio.run(scenario())
+
+    assert [c["response"] for c in chunks] == ["Ho", "la", ""]
+    assert chunks[-1]["done"] is True
+
+
+def test_scheduler_caps_concurrency_and_orders_by_priority():
+    """Test que verifica el límite de concurrencia por modelo y el orden por prioridad"""
+    scheduler = SheilyInferenceScheduler(max_concurrency=1, max_queue=4)
+    order = []
+
+    async def job(name, priority, delay=0.01):
+        async with scheduler.slot("llama3", priority):
+            order.append(name)
+            await asyncio.sleep(delay)
+
+    async def scenario():
+        first = asyncio.ensure_future(job("primero", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        batch = asyncio.ensure_future(job("lote", PRIORITY_BATCH))
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(job("interactivo", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        assert scheduler.stats()["llama3"]["queued"] == 2
+        await asyncio.gather(first, batch, interactive)
+
+    asyncio.run(scenario())
+
+    assert order == ["primero", "interactivo", "lote"]
+    stats = scheduler.stats()["llama3"]
+    assert stats["active"] == 0
+    assert stats["admitted"] == 3
+    assert stats["wait_ms_p95"] > 0
+
+
+def test_scheduler_rejects_when_queue_is_full():
+    """Test que verifica el rechazo inmediato con Retry-After cuando la cola está llena"""
+    scheduler = SheilyInferenceScheduler(max_concurrency=1, max_queue=1)
+
+    async def hold(release):
+        async with scheduler.slot("llama3"):
+            await release.wait()
+
+    async def scenario():
+        release = asyncio.Event()
+        running = [asyncio.ensure_future(hold(release)) for _ in range(2)]
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(InferenceQueueFull) as excinfo:
+                async with scheduler.slot("llama3"):
+                    pass
+            # Los demás modelos tienen su propio carril
+            async with scheduler.slot("deepseek-coder:latest"):
+                pass
+        finally:
+            release.set()
+            await asyncio.gather(*running)
+        return excinfo.value
+
+    error = asyncio.run(scenario())
+
+    assert error.retry_after >= 1
+    assert scheduler.stats()["llama3"]["rejected"] == 1
+
+
+def test_scheduler_forgets_cancelled_waiters():
+    """Test que verifica que una petición cancelada en cola no consume hueco"""
+    scheduler = SheilyInferenceScheduler(max_concurrency=1, max_queue=2)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot("llama3"):
+                await release.wait()
+
+        running = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        waiting = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler.stats()["llama3"]["queued"] == 0
+        release.set()
+        await running
+
+    asyncio.run(scenario())
+
+    assert scheduler.stats()["llama3"]["active"] == 0
+
+
+def test_load_ollama_config_reads_n_parallel(tmp_path):
+    """Test que verifica la lectura de n_parallel desde ollama-config.json"""
+    config_file = tmp_path / "ollama-config.json"
+    config_file.write_text(json.dumps({"n_parallel": 3}))
+
+    assert get_parallel_slots(str(config_file)) == 3
+    assert get_parallel_slots(str(tmp_path / "missing.json")) == 1
+
+
+def _serve_in_order(scheduler, requests):
+    """Encola las peticiones (flujo, peso) tras una que ocupa el hueco y devuelve el orden de servicio"""
+    order = []
+
+    async def job(flow, weight):
+        async with scheduler.slot("llama3", flow=flow, weight=weight):
+            order.append(flow)
+            await asyncio.sleep(0)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot("llama3", flow="inicial"):
+                await release.wait()
+
+        running = asyncio.ensure_future(hold())
+        await asyncio.sleep(0)
+        jobs = []
+        for flow, weight in requests:
+            jobs.append(asyncio.ensure_future(job(flow, weight)))
+            await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(running, *jobs)
+
+    asyncio.run(scenario())
+    return order
+
+
+def test_scheduler_shares_slots_fairly_between_users():
+    """Test que verifica que un usuario con muchas peticiones no retrasa a los demás"""
+    scheduler = SheilyInferenceScheduler(max_concurrency=1, max_queue=16)
+
+    order = _serve_in_order(scheduler, [("pesado", 1)] * 4 + [("normal", 1)])
+
+    assert order.index("normal") == 1
+
+
+def test_scheduler_weights_users_by_tier():
+    """Test que verifica que un peso mayor atiende más peticiones por ronda"""
+    scheduler = SheilyInferenceScheduler(max_concurrency=1, max_queue=16)
+
+    order = _serve_in_order(scheduler, [("premium", 2)] * 4 + [("basico", 1)] * 2)
+
+    assert order == ["premium", "premium", "basico", "premium", "premium", "basico"]
+
+
+def test_scheduler_limits_queue_per_user():
+    """Test que verifica que un usuario no puede ocupar toda la cola"""
+    scheduler = SheilyInferenceScheduler(max_concurrency=1, max_queue=8, max_queue_per_flow=1)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold(flow):
+            async with scheduler.slot("llama3", flow=flow):
+                await release.wait()
+
+        running = [asyncio.ensure_future(hold("pesado")) for _ in range(2)]
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(InferenceQueueFull):
+                async with scheduler.slot("llama3", flow="pesado"):
+                    pass
+            running.append(asyncio.ensure_future(hold("otro")))
+            await asyncio.sleep(0)
+            assert scheduler.stats()["llama3"]["users_waiting"] == 2
+        finally:
+            release.set()
+            await asyncio.gather(*running)
+
+    asyncio.run(scenario())
+
+
+def test_backend_pool_prefers_least_outstanding():
+    """Test que verifica que el pool envía las peticiones al backend menos cargado"""
+    pool = OllamaBackendPool(["http://a:11434", "http://b:11434"])
+
+    async def scenario():
+        async with pool.lease() as first:
+            second = pool.choose()
+            return first.base_url, second.url
+
+    first, second = asyncio.run(scenario())
+
+    assert first != second
+
+
+def test_backend_pool_keeps_conversation_affinity():
+    """Test que verifica que una conversación repite backend salvo sobrecarga"""
+    pool = OllamaBackendPool(["http://a:11434", "http://b:11434", "http://c:11434"], affinity_slack=2)
+
+    assert len({pool.choose("conversacion-1").url for _ in range(10)}) == 1
+    assert len({pool.choose(f"conversacion-{i}").url for i in range(30)}) == 3
+
+    preferred = pool.choose("conversacion-1")
+    preferred.outstanding = 5
+    assert pool.choose("conversacion-1") is not preferred
+    assert pool.stats()["affinity_breaks"] == 1
+
+
+def test_backend_pool_ejects_failing_backend_and_readmits_on_probe():
+    """Test que verifica la expulsión por fallos pasivos y la readmisión por sondeo activo"""
+    pool = OllamaBackendPool(["http://caido:11434", "http://sano:11434"], max_failures=2)
+    down = {"caido"}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host in down:
+            return httpx.Response(503)
+        if request.url.path == "/api/tags":
+            return httpx.Response(200, json={"models": []})
+        return httpx.Response(200, json={"response": "ok", "done": True})
+
+    broken = pool.backends[0]
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            for _ in range(2):
+                broken.outstanding = -1  # fuerza la elección del backend caído
+                with pytest.raises(httpx.HTTPStatusError):
+                    async with pool.lease() as client:
+                        await client.generate("llama3", "hola")
+                broken.outstanding += 1
+            chosen_while_down = {pool.choose().url for _ in range(5)}
+            down.clear()
+            await pool.probe_all()
+        finally:
+            await close_async_http_client()
+        return chosen_while_down
+
+    chosen_while_down = asyncio.run(scenario())
+
+    assert chosen_while_down == {"http://sano:11434"}
+    stats = {b["url"]: b for b in pool.stats()["backends"]}
+    assert stats["http://caido:11434"]["ejections"] == 1
+    assert stats["http://caido:11434"]["available"] is True
+
+
+def test_circuit_breaker_opens_half_opens_and_closes():
+    """Test que verifica las transiciones cerrado, abierto y semiabierto del circuit breaker"""
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.can_attempt()
+    assert breaker.retry_after() == 10
+
+    now[0] = 10
+    assert breaker.state == "half_open" and breaker.can_attempt()
+    breaker.on_attempt()
+    assert not breaker.can_attempt()  # solo una petición de prueba a la vez
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.reset_timeout == 20
+
+    now[0] = 30
+    breaker.on_attempt()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.reset_timeout == 10
+    assert breaker.opens == 2
+
+
+def test_backend_pool_fails_fast_when_all_circuits_open():
+    """Test que verifica que sin backends disponibles se falla al instante y el sondeo cierra el circuito"""
+    pool = OllamaBackendPool(["http://a:11434"], max_failures=1, eject_seconds=60)
+    calls = []
+    down = [True]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.path)
+        if down[0]:
+            raise httpx.ConnectError("connection refused")
+        return httpx.Response(200, json={"models": []})
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            await pool.probe_all()
+            assert pool.health_state()["healthy"] is False
+            with pytest.raises(OllamaUnavailable) as exc:
+                async with pool.lease() as client:
+                    await client.generate("llama3", "hola")
+            assert calls == ["/api/tags"]  # la generación no llegó a salir
+            down[0] = False
+            await pool.probe_all()
+            return exc.value
+        finally:
+            await close_async_http_client()
+
+    error = asyncio.run(scenario())
+
+    assert error.retry_after == 60
+    assert pool.health_state()["healthy"] is True
+    assert pool.stats()["rejected"] == 1
+
+
+def test_residency_preloads_with_keep_alive_and_splits_cold_load():
+    """Test que verifica la precarga con keep_alive y la separación de la latencia de carga en frío"""
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        seen.append(body)
+        load = 2_500_000_000 if body["prompt"] == "" else 1_000_000
+        durations = {"load_duration": load, "total_duration": load + 500_000_000}
+        return httpx.Response(200, json={"response": "", "done": True, **durations})
+
+    residency = ModelResidencyManager(config={"preload_models": ["llama3"], "keep_alive": {"llama3": "30m"}})
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            await residency.preload()
+            result = await AsyncOllamaClient().generate_raw("llama3", "hola", **residency.generate_params("llama3"))
+            residency.record_generation("llama3", result)
+        finally:
+            await close_async_http_client()
+
+    asyncio.run(scenario())
+
+    assert [body["keep_alive"] for body in seen] == ["30m", "30m"]
+    stats = residency.stats()
+    assert stats["loaded"] == ["llama3"]
+    assert stats["cold_load"]["count"] == 1
+    assert stats["cold_load"]["avg_ms"] == pytest.approx(2500)
+    assert stats["generation"]["count"] == 2
+    assert stats["generation"]["avg_ms"] == pytest.approx(500)
+
+
+def test_residency_unloads_least_recently_used_under_memory_pressure(monkeypatch):
+    """Test que verifica la descarga del modelo menos usado cuando falta memoria"""
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/ps":
+            return httpx.Response(200, json={"models": [{"name": "llama3"}, {"name": "deepseek-coder:latest"}]})
+        seen.append(json.loads(request.content))
+        return httpx.Response(200, json={"response": "", "done": True})
+
+    residency = ModelResidencyManager(config={})
+    residency.record_generation("deepseek-coder:latest", {})
+    residency.record_generation("llama3", {})
+    pressure = [False]
+    monkeypatch.setattr(monitoring_manager, "is_memory_pressure", lambda: pressure[0])
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            await residency.refresh()
+            assert await residency.relieve_memory_pressure() is None
+            pressure[0] = True
+            return await residency.relieve_memory_pressure()
+        finally:
+            await close_async_http_client()
+
+    unloaded = asyncio.run(scenario())
+
+    assert unloaded == "deepseek-coder:latest"
+    assert seen == [{"model": "deepseek-coder:latest", "prompt": "", "stream": False, "keep_alive": 0}]
+    assert residency.stats()["loaded"] == ["llama3"]
+
+
+def test_residency_is_tracked_per_backend_of_the_pool(monkeypatch):
+    """Test que verifica que los modelos residentes y las descargas se siguen por backend del pool"""
+    resident = {"a": [{"name": "llama3"}, {"name": "deepseek-coder:latest"}], "b": [{"name": "llama3.2:3b"}]}
+    unloads = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/ps":
+            return httpx.Response(200, json={"models": resident[request.url.host]})
+        unloads.append((request.url.host, json.loads(request.content)["model"]))
+        return httpx.Response(200, json={"response": "", "done": True})
+
+    pool = OllamaBackendPool(["http://a:11434", "http://b:11434"])
+    residency = ModelResidencyManager(pool, config={})
+    residency.record_generation("llama3", {}, "http://a:11434")
+    monkeypatch.setattr(monitoring_manager, "is_memory_pressure", lambda: True)
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            await residency.refresh()
+            return await residency.relieve_memory_pressure()
+        finally:
+            await close_async_http_client()
+
+    unloaded = asyncio.run(scenario())
+
+    assert unloaded == "deepseek-coder:latest"
+    assert unloads == [("a", "deepseek-coder:latest")]
+    assert residency.stats()["backends"] == {"http://a:11434": ["llama3"], "http://b:11434": ["llama3.2:3b"]}
+    assert residency.is_loaded("llama3.2:3b")
+    pool.backends[1].breaker.trip()
+    assert not residency.is_loaded("llama3.2:3b")
+
+
+def test_residency_matches_names_with_and_without_latest_tag():
+    """Test que verifica que ``llama3`` de la configuración y ``llama3:latest`` de /api/ps son el mismo modelo"""
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"models": [{"name": "llama3:latest"}, {"name": "deepseek-coder"}]})
+
+    pool = OllamaBackendPool(["http://a:11434"])
+    residency = ModelResidencyManager(pool, config={})
+    residency.record_generation("llama3", {}, "http://a:11434")
+
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            await residency.refresh()
+        finally:
+            await close_async_http_client()
+
+    asyncio.run(scenario())
+
+    assert residency.stats()["backends"] == {"http://a:11434": ["deepseek-coder", "llama3"]}
+    assert residency.is_loaded("llama3:latest")
+    assert residency.is_loaded("deepseek-coder:latest")
+    residency.record_generation("llama3:latest", {}, "http://a:11434")
+    assert residency.stats()["loaded"] == ["deepseek-coder", "llama3"]
+
+
+def _run_with_ollama_handler(handler, coro_factory):
+    async def scenario():
+        await init_async_http_client(transport=httpx.MockTransport(handler))
+        try:
+            return await coro_factory()
+        finally:
+            await close_async_http_client()
+
+    return asyncio.run(scenario())
+
+
+def test_embedding_service_dedups_batches_and_caches(tmp_path):
+    """Test que verifica que los textos repetidos o ya cacheados no vuelven a Ollama y los lotes están acotados"""
+    service = SheilyEmbeddingService(cache_path=str(tmp_path / "emb.sqlite"), batch_size=3, concurrency=2)
+    sent = []
+    active = {"now": 0, "max": 0}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/api/embed"
+        inputs = json.loads(request.content)["input"]
+        sent.extend(inputs)
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        await asyncio.sleep(0.01)
+        active["now"] -= 1
+        return httpx.Response(200, json={"embeddings": [[float(len(text)), 1.0] for text in inputs]})
+
+    texts = [f"mensaje {'x' * i}" for i in range(10)]
+    first = _run_with_ollama_handler(handler, lambda: service.embed_many(texts + texts[:4]))
+    assert sorted(sent) == sorted(texts)
+    assert active["max"] == 2
+    assert [v[0] for v in first] == [float(len(t)) for t in texts + texts[:4]]
+
+    sent.clear()
+    reopened = SheilyEmbeddingService(cache_path=str(tmp_path / "emb.sqlite"))
+    again = _run_with_ollama_handler(handler, lambda: reopened.embed_many(texts[:5] + ["nuevo"]))
+    assert sent == ["nuevo"]
+    assert again[0].tolist() == first[0].tolist()
+    assert service.stats()["duplicates"] == 4
+    assert reopened.stats()["cache_hits"] == 5
+
+
+def test_embedding_service_falls_back_to_single_text_endpoint(tmp_path):
+    """Test que verifica el uso de /api/embeddings cuando el servidor no tiene /api/embed"""
+    service = SheilyEmbeddingService(cache_path=str(tmp_path / "emb.sqlite"), batch_size=2)
+    paths = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        paths.append(request.url.path)
+        if request.url.path == "/api/embeddings":
+            return httpx.Response(200, json={"embedding": [len(json.loads(request.content)["prompt"]), 0.0]})
+        return httpx.Response(404)
+
+    vectors = _run_with_ollama_handler(handler, lambda: service.embed_many(["a", "bb", "ccc"]))
+
+    assert [v[0] for v in vectors] == [1.0, 2.0, 3.0]
+    assert paths.count("/api/embeddings") == 3
+    assert service.stats()["multi_input"] is False
+    assert service.stats()["single_requests"] == 3
+
+
+_ROUTER_CATALOG = {
+    "general": [
+        {"name": "llama3", "tokens_per_sec": 30, "load_ms": 4000},
+        {"name": "llama3.2:3b", "tokens_per_sec": 60, "load_ms": 1500},
+    ],
+    "code": [{"name": "deepseek-coder:latest", "tokens_per_sec": 35, "load_ms": 3500}],
+}
+
+
+@pytest.fixture
+def node(monkeypatch):
+    """Carga del nodo, modelos residentes y espera en cola controlados por el test"""
+    state = {"load": {"cpu_percent": 10.0, "memory_percent": 40.0}, "loaded": {"llama3", "llama3.2:3b"}, "wait": {}}
+    monkeypatch.setattr(monitoring_manager, "get_load", lambda: dict(state["load"]))
+    monkeypatch.setattr(model_router_module, "ROUTER_LOAD_TTL", 0)
+    monkeypatch.setattr(model_router_module.model_residency, "is_loaded", lambda model: model in state["loaded"])
+    monkeypatch.setattr(
+        model_router_module.inference_scheduler, "estimated_wait", lambda model: state["wait"].get(model, 0.0)
+    )
+    return state
+
+
+def _router(tmp_path, installed=("llama3", "llama3.2:3b", "deepseek-coder:latest")):
+    router = SheilyModelRouter(
+        catalog=_ROUTER_CATALOG, slo_ms=10000, expected_tokens=100, log_path=str(tmp_path / "router.jsonl")
+    )
+    router.installed = set(installed)
+    return router
+
+
+def test_model_router_degrades_under_queue_wait_and_recovers_with_hysteresis(tmp_path, node):
+    """Test que verifica la degradación al modelo ligero cuando la cola impide el SLO y la vuelta con margen"""
+    router = _router(tmp_path)
+
+    assert router.choose("general").model == "llama3"
+
+    node["wait"]["llama3"] = 8.0
+    decision = router.choose("general")
+    assert (decision.model, decision.reason) == ("llama3.2:3b", "slo")
+
+    # Cumple el SLO pero no el margen de recuperación: sigue en el modelo ligero
+    node["wait"]["llama3"] = 5.5
+    assert router.choose("general").model == "llama3.2:3b"
+
+    node["wait"]["llama3"] = 1.0
+    assert router.choose("general").model == "llama3"
+    stats = router.stats()
+    assert (stats["degradations"], stats["recoveries"], stats["degraded"]) == (1, 1, {})
+
+    # Sin alternativa instalada se usa el preferido aunque no llegue
+    node["wait"]["deepseek-coder:latest"] = 30.0
+    decision = router.choose("code")
+    assert (decision.model, decision.reason) == ("deepseek-coder:latest", "best_effort")
+
+
+def test_model_router_hysteresis_ignores_per_request_slo_and_plan_has_no_effects(tmp_path, node):
+    """Test que verifica que un SLO propio no degrada a los demás y que ``plan`` no cuenta ni registra"""
+    router = _router(tmp_path)
+    node["wait"]["llama3"] = 5.5
+
+    # Un SLO estricto de una petición elige el modelo ligero solo para ella
+    assert router.choose("general", slo_ms=2000).model == "llama3.2:3b"
+    assert router.choose("general").model == "llama3"
+    assert router.stats()["degraded"] == {}
+
+    planned = router.plan("general", slo_ms=2000)
+    assert planned.model == "llama3.2:3b"
+    assert sum(router.stats()["decisions"].values()) == 2
+    router.commit(planned)
+    assert router.stats()["decisions"] == {"llama3.2:3b": 2, "llama3": 1}
+    assert len((tmp_path / "router.jsonl").read_text().splitlines()) == 3
+
+
+def test_model_router_avoids_cold_loads_under_memory_pressure_and_logs_decisions(tmp_path, node):
+    """Test que verifica que sin memoria no se carga un modelo en frío y que cada decisión se registra"""
+    node["loaded"].discard("llama3")
+    router = _router(tmp_path)
+    assert router.choose("general").model == "llama3"
+
+    node["load"]["memory_percent"] = 95.0
+    assert router.choose("general").model == "llama3.2:3b"
+
+    # Los modelos no instalados no son candidatos
+    assert _router(tmp_path, installed=()).choose("general").model == "llama3"
+
+    router.record("llama3.2:3b", {"eval_count": 120, "eval_duration": 1_000_000_000})
+    assert router.stats()["profiles"]["llama3.2:3b"]["tokens_per_sec"] == 120.0
+
+    lines = [json.loads(line) for line in (tmp_path / "router.jsonl").read_text().splitlines()]
+    assert [line["model"] for line in lines] == ["llama3", "llama3.2:3b", "llama3"]
+    assert lines[1]["memory_pressure"] is True
+    assert lines[1]["estimates_ms"]["llama3"] is None
+    assert lines[1]["loaded"] == ["llama3.2:3b"]
+
+
+def test_generation_options_merge_node_model_and_user_profiles():
+    """Test que verifica la prioridad nodo < modelo < usuario y que las opciones se compilan una vez"""
+    config = {
+        "num_ctx": 4096,
+        "batch_size": 512,
+        "temp": 0.7,
+        "seed": -1,
+        "n_predict": -1,
+        "rope_freq_base": 10000.0,
+        "model_options": {"deepseek-coder:latest": {"temperature": 0.1, "top_p": 0.9, "num_ctx": "oops"}},
+    }
+    ai = {"context_window": 8192, "max_tokens": 1024}
+    options = SheilyGenerationOptions(config=config, user_config=lambda: ai, tuned=lambda model: {})
+
+    assert options.for_model("llama3") == {"num_ctx": 8192, "num_batch": 512, "temperature": 0.7, "num_predict": 1024}
+    coder = options.for_model("deepseek-coder:latest")
+    assert coder == {"num_ctx": 8192, "num_batch": 512, "temperature": 0.1, "top_p": 0.9, "num_predict": 1024}
+    assert options.for_model("deepseek-coder:latest") is coder
+    assert options.stats()["compilations"] == 2
+
+    # Un cambio en la configuración del usuario se aplica en la siguiente petición
+    ai["max_tokens"] = 0
+    assert "num_predict" not in options.for_model("llama3")
+    assert options.stats()["compilations"] == 3
+
+
+def _stand_in_ollama(slots=2):
+    """Servidor simulado cuya velocidad depende de las opciones recibidas y que atiende ``slots`` peticiones a la vez"""
+    thread_speed = {2: 0.4, 4: 1.0, 8: 0.6}
+    batch_speed = {256: 0.5, 512: 1.0}
+    ctx_speed = {2048: 1.0, 4096: 0.95, 8192: 0.9}
+    state = {"num_ctx": 0, "busy": asyncio.Semaphore(slots)}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/ps":
+            # Como Ollama real: /api/ps informa la etiqueta aunque se pidiera "llama3"
+            return httpx.Response(200, json={"models": [{"name": "llama3:latest", "size": state["num_ctx"] * 1000}]})
+        options = json.loads(request.content)["options"]
+        state["num_ctx"] = options["num_ctx"]
+        speed = thread_speed[options["num_thread"]] * batch_speed[options["num_batch"]] * ctx_speed[options["num_ctx"]]
+        tokens = options["num_predict"]
+        async with state["busy"]:
+            # El doble de lo que declara eval_duration: margen frente al ruido del reloj
+            await asyncio.sleep(tokens / speed / 500)
+        return httpx.Response(
+            200,
+            json={
+                "response": "x",
+                "done": True,
+                "prompt_eval_count": 10,
+                "prompt_eval_duration": 5_000_000,
+                "eval_count": tokens,
+                "eval_duration": int(tokens / speed * 1_000_000),
+            },
+        )
+
+    return handler
+
+
+def test_tuner_picks_fastest_profile_within_memory_and_writes_it(tmp_path):
+    """Test que verifica que el ajuste elige la combinación más rápida que cabe en memoria y la guarda por modelo"""
+    grid = {"num_thread": [2, 4, 8], "num_batch": [256, 512], "num_ctx": [2048, 4096, 8192], "parallel": [1, 2]}
+    tuner = SheilyOllamaTuner(
+        AsyncOllamaClient(), prompts=["uno", "dos"], max_tokens=32, tolerance=0.8, memory_budget_bytes=5_000_000
+    )
+
+    result = _run_with_ollama_handler(_stand_in_ollama(), lambda: tuner.tune("llama3", grid))
+
+    assert result.best.options == {"num_thread": 4, "num_batch": 512, "num_ctx": 4096}
+    assert result.best.parallel == 2
+    assert result.best.eval_tokens_per_sec == pytest.approx(950, rel=0.01)
+    assert any(trial.options["num_ctx"] == 8192 and not trial.ok for trial in result.trials)
+
+    path = tmp_path / "ollama-tuned.json"
+    path.write_text(json.dumps({"models": {"deepseek-coder:latest": {"n_parallel": 1}}}))
+    write_tuned_config([result], str(path))
+    assert get_tuned_profile("deepseek-coder:latest", str(path)) == {"n_parallel": 1}
+    profile = get_tuned_profile("llama3", str(path))
+    assert profile["n_parallel"] == 2
+    assert get_parallel_slots(str(tmp_path / "missing.json"), model="llama3") == 1
+
+    # El perfil medido se aplica sobre ollama-config.json y limita la ventana que pida el usuario
+    options = SheilyGenerationOptions(
+        config={"num_thread": 8, "batch_size": 256},
+        user_config=lambda: {"context_window": 8192},
+        tuned=lambda model: profile if model == "llama3" else {},
+    )
+    assert options.for_model("llama3") == {"num_thread": 4, "num_batch": 512, "num_ctx": 4096}
+    assert options.for_model("llama3.2:3b") == {"num_thread": 8, "num_batch": 256, "num_ctx": 8192}
+
+
+def test_histogram_counts_buckets_and_interpolates_quantiles():
+    """Test que verifica los recuentos acumulados por intervalo y los cuantiles interpolados"""
+    histogram = Histogram([10, 100, 1000])
+    for value in [5, 50, 60, 70, 2000]:
+        histogram.add(value)
+
+    summary = histogram.summary()
+    assert summary["buckets"] == {"10": 1, "100": 4, "1000": 4, "+Inf": 5}
+    assert summary["avg"] == 437.0
+    assert histogram.quantile(0.5) == pytest.approx(10 + 90 * 1.5 / 3)
+    assert histogram.quantile(1.0) == 2000
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from sheily_light_api.sheily_modules.sheily_vector_store.sheily_vector_index import SheilyVectorIndex
+
+
+def _random_vectors(n, dim=16, seed=0):
+    return np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+
+
+def test_top_k_cosine_search_by_namespace(tmp_path):
+    """Test que verifica la búsqueda top-k por coseno y el filtrado por espacio de nombres"""
+    index = SheilyVectorIndex(str(tmp_path))
+    index.add("norte", [1.0, 0.0, 0.0], {"texto": "n"}, namespace="llama3")
+    index.add("noreste", [1.0, 1.0, 0.0], namespace="llama3")
+    index.add("este", [0.0, 1.0, 0.0], namespace="deepseek")
+
+    hits = index.search([2.0, 0.1, 0.0], k=2, namespace="llama3")
+
+    assert [hit.id for hit in hits] == ["norte", "noreste"]
+    assert hits[0].score == pytest.approx(0.9988, abs=1e-3)
+    assert hits[0].meta == {"texto": "n"}
+    assert [hit.id for hit in index.search([0.0, 1.0, 0.0], k=5, namespace="deepseek")] == ["este"]
+    assert index.search([0.0, 1.0, 0.0], namespace="otro") == []
+
+
+def test_batched_search_matches_single_queries_with_int8(tmp_path):
+    """Test que verifica la búsqueda por lotes y que la cuantización int8 conserva el ranking"""
+    vectors = _random_vectors(200)
+    exact = SheilyVectorIndex(str(tmp_path / "f32"))
+    quantized = SheilyVectorIndex(str(tmp_path / "i8"), dtype="int8")
+    ids = [f"v{i}" for i in range(len(vectors))]
+    exact.add_many(ids, vectors)
+    quantized.add_many(ids, vectors)
+
+    queries = vectors[:5] + 0.01
+    batched = quantized.search_batch(queries, k=3)
+
+    assert [hits[0].id for hits in batched] == [f"v{i}" for i in range(5)]
+    assert [hit.id for hit in batched[2]] == [hit.id for hit in quantized.search(queries[2], k=3)]
+    assert [hit.id for hit in exact.search(queries[0], k=3)] == [hit.id for hit in batched[0]]
+    assert quantized.stats()["bytes"] == exact.stats()["bytes"] // 4
+
+
+def test_tombstones_compaction_and_reload(tmp_path):
+    """Test que verifica las lápidas, la compactación y la recarga desde disco"""
+    index = SheilyVectorIndex(str(tmp_path), compact_ratio=0.5)
+    vectors = _random_vectors(10)
+    index.add_many([f"v{i}" for i in range(10)], vectors)
+
+    index.delete("v0")
+    assert "v0" not in index
+    assert index.stats()["deleted"] == 1
+    assert index.search(vectors[0], k=1)[0].id != "v0"
+
+    for i in range(1, 6):
+        index.delete(f"v{i}")  # supera el umbral y compacta
+    assert index.stats()["rows"] == len(index) == 4
+
+    reloaded = SheilyVectorIndex(str(tmp_path))
+    assert reloaded.ids() == ["v6", "v7", "v8", "v9"]
+    assert reloaded.search(vectors[7], k=1)[0].id == "v7"
+
+
+def test_ivf_partitions_find_nearest_neighbours(tmp_path):
+    """Test que verifica que la búsqueda IVF encuentra los vecinos recorriendo solo algunas particiones"""
+    vectors = _random_vectors(400, dim=8, seed=1)
+    index = SheilyVectorIndex(str(tmp_path), nlist=8, nprobe=3)
+    index.add_many([f"v{i}" for i in range(len(vectors))], vectors)
+
+    assert index.stats()["ivf_lists"] == 8
+    found = sum(index.search(vectors[i], k=1)[0].id == f"v{i}" for i in range(50))
+    assert found == 50
+
+
+def test_read_only_reader_sees_writer_appends(tmp_path):
+    """Test que verifica que un worker de solo lectura recoge lo que añade el escritor"""
+    writer = SheilyVectorIndex(str(tmp_path))
+    writer.add("a", [1.0, 0.0])
+    reader = SheilyVectorIndex(str(tmp_path), read_only=True)
+
+    writer.add("b", [0.0, 1.0])
+
+    assert reader.search([0.0, 1.0], k=1)[0].id == "b"
+    with pytest.raises(PermissionError):
+        reader.add("c", [1.0, 1.0])
+
+
+def test_shared_workers_write_the_same_index(tmp_path):
+    """Test que verifica que dos workers con el índice compartido escriben y ven las altas y bajas del otro"""
+    first = SheilyVectorIndex(str(tmp_path), shared=True)
+    second = SheilyVectorIndex(str(tmp_path), shared=True)
+
+    first.add("a", [1.0, 0.0], namespace="user:1")
+    second.add("b", [0.0, 1.0], namespace="user:2")
+    first.add("c", [1.0, 1.0], namespace="user:1")
+
+    assert second.search([1.0, 1.0], k=1)[0].id == "c"
+    assert first.search([0.0, 1.0], k=1)[0].id == "b"
+    assert second.delete("a")
+    first.refresh()
+    assert "a" not in first
+    assert first.count("user:1") == 1
+    # Cada alta ocupó su propia fila: nada se pisó en disco
+    reopened = SheilyVectorIndex(str(tmp_path))
+    assert reopened.ids() == ["b", "c"]
+    assert reopened.search([0.0, 1.0], k=1)[0].id == "b"
+
+
+def test_unlogged_vectors_are_discarded_on_open(tmp_path):
+    """Test que verifica que un vector escrito sin su alta en el registro se descarta al reabrir"""
+    index = SheilyVectorIndex(str(tmp_path))
+    index.add("a", [1.0, 0.0])
+    with open(index.vectors_file, "ab") as f:
+        f.write(np.array([0.0, 1.0], dtype=np.float32).tobytes())  # caída antes de registrar
+
+    reopened = SheilyVectorIndex(str(tmp_path))
+    reopened.add("b", [0.0, 1.0])
+
+    assert reopened.search([0.0, 1.0], k=1)[0].id == "b"
+    assert index.vectors_file.stat().st_size == 2 * 2 * 4
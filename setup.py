@@ -17,6 +17,7 @@ requirements = [
     "psutil==5.9.8",
     "PyYAML==6.0.1",
     "APScheduler==3.10.4",
+    "numpy>=1.24",
     "aiohttp>=3.9.0",
     "aioredis>=2.0.0",
     "pydantic>=1.10.0",